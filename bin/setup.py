@@ -73,6 +73,21 @@ def copySampleRobots(roboDir,arenaDir):
         shutil.rmtree(sampleDst)
     return shutil.copytree(sampleSrc,sampleDst)
 
+def buildEngine( roboDir, javacPath ):
+    print("Building the battle engine...")
+    engineDir = os.path.abspath(os.path.join(os.path.dirname(__file__),'..','lib','engine'))
+    try:
+        subprocess.check_call([
+            javacPath,
+            '-cp', os.path.join(roboDir,'libs','*'),
+            '-d', engineDir,
+            os.path.join(engineDir,'ArenaEngine.java'),
+        ])
+        return engineDir
+    except Exception as e:
+        print('Error building the battle engine: {0}'.format(e), file=sys.stderr)
+        return False
+
 def configureArena( roboDir ):
     arenaDir = os.path.abspath(os.path.realpath(os.path.join(os.path.dirname(__file__),'..','arena')))
 
@@ -91,6 +106,7 @@ if __name__ == '__main__':
     # create any necessary directories
     # detect java
     # install robocode
+    # build the battle engine
     # copy the sample robots
 
     javaInfo = detectJava('java',re.compile(r'java version "([^"]+)"',re.I))
@@ -104,6 +120,9 @@ if __name__ == '__main__':
     if not roboDir:
         sys.exit(1)
 
+    if not buildEngine(roboDir,javacInfo.path):
+        sys.exit(1)
+
     arenaDir = configureArena(roboDir)
     if not arenaDir:
         sys.exit(1)
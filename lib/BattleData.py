@@ -5,27 +5,49 @@ import re
 import json
 import csv
 import sys
+import os
+import time
+import random
+import gzip
+import copy
+import concurrent.futures
 from datetime import datetime
+from contextlib import contextmanager
 
 class DBRecord:
     '''
     instances of this class resemble a database record
+
+    Each subclass lists its table's <columns>, which (with anything else
+    the subclass keeps) are its __slots__: records have no per-instance
+    __dict__, which matters when holding a tournament's worth of them.
     '''
+    __slots__ = ()
+    columns = ()
+
     def __init__(self, db_rec):
-        for col in db_rec.keys():
-            setattr(self,col,db_rec[col])
+        for col in self.columns:
+            try:
+                setattr(self,col,db_rec[col])
+            except (IndexError,KeyError):
+                # not selected
+                setattr(self,col,None)
 
     def __str__(self):
-        non_internal = re.compile(r'^[^_]')
         return '[{0} {1}]'.format(
             self.__class__.__name__,
             ' '.join(
                 [ '{0}({1})'.format(attr,getattr(self,attr))
-                  for attr in filter(non_internal.match,vars(self).keys()) ]),
+                  for attr in self.__class__.__slots__
+                  if not attr.startswith('_') ]),
         )
             
 
 class Battle(DBRecord):
+    columns = ( 'BattleID', 'Priority', 'State', 'Started', 'Finished',
+                'Properties', 'Winner', 'Obsolete', 'Recording', 'Recorded' )
+    __slots__ = ( 'db', ) + columns + ( '_robots', )
+
     def __init__(self, record, db):
         self.db = db
         self._robots = [] # <Robot>
@@ -51,188 +73,2378 @@ class Battle(DBRecord):
 
 
 class Robot(DBRecord):
+    columns = ( 'RobotID', 'Name', 'LastUpdated' )
+    __slots__ = ( 'db', ) + columns
+
     def __init__(self, record, db):
         self.db = db
         super().__init__(record)
 
 
-class BattleDB:
-    def __init__( self, db_file ):
+class BattleRobot(DBRecord):
+    '''
+    One competitor's results in one battle.
+    '''
+    # The typed result columns, and the Robocode results field (as stored
+    #   in Results) that each is taken from.
+    resultFields = (
+        ( 'Place',          '_Place' ),
+        ( 'TotalScore',     '_Score' ),
+        ( 'Survival',       'Survival' ),
+        ( 'SurvivalBonus',  'Surv Bonus' ),
+        ( 'BulletDamage',   'Bullet Dmg' ),
+        ( 'BulletBonus',    'Bullet Bonus' ),
+        ( 'RamDamage',      'Ram Dmg * 2' ),
+        ( 'RamBonus',       'Ram Bonus' ),
+        ( 'Firsts',         '1sts' ),
+        ( 'Seconds',        '2nds' ),
+        ( 'Thirds',         '3rds' ),
+    )
+    _number = re.compile(r'-?\d+')
+
+    columns = ( 'BattleID', 'RobotID', 'RobotUpdated', 'Score', 'Results' ) + \
+              tuple( col for col,field in resultFields )
+    __slots__ = columns
+
+    def getResults( self ):
+        return json.loads(self.Results) if self.Results else {}
+
+    @staticmethod
+    def typedResults( results ):
+        '''
+        Return a dict of the typed result columns from a dict of Robocode
+        results (None for anything missing or unparseable).
+        '''
+        return { col:BattleRobot.number(results.get(field))
+                 for col,field in BattleRobot.resultFields }
+
+    @staticmethod
+    def number( value ):
+        '''
+        Return the integer at the start of a Robocode results value, such
+        as '1234 (56%)' (None if there isn't one).
+        '''
+        if isinstance(value,str):
+            match = BattleRobot._number.search(value)
+            return int(match.group(0)) if match else None
+        return value
+
+
+class LeaderboardEntry(DBRecord):
+    '''
+    One robot's totals over its finished, non-obsolete battles.
+    '''
+    columns = ( 'RobotID', 'Name', 'Battles', 'Wins', 'TotalScore',
+                'AverageScore' )
+    __slots__ = columns
+
+
+class RatingEntry(DBRecord):
+    '''
+    One robot version's rating in one rating system.
+    '''
+    columns = ( 'RobotID', 'Name', 'RobotUpdated', 'System', 'Rating',
+                'Battles' )
+    __slots__ = columns
+
+
+class Rollup(DBRecord):
+    '''
+    One robot version's totals over its archived battles.
+    '''
+    columns = ( 'RobotID', 'RobotUpdated', 'Battles', 'Obsolete', 'Wins',
+                'TotalScore', 'FirstFinished', 'LastFinished' )
+    __slots__ = columns
+
+
+class Recording(DBRecord):
+    '''
+    A battle's recording in the recording store (see RecordingStore.py).
+    '''
+    columns = ( 'BattleID', 'Hash', 'Size', 'Stored', 'Recorded',
+                'Matchup' )
+    __slots__ = columns
+
+
+class BattleQuery:
+    '''
+    A query over the battles, built up a step at a time; each step returns
+    a new query, so they can be shared and extended:
+
+        finished = battledb.QueryBattles(State='finished',Obsolete=0)
+        finished.filter(robot=robot).count()
+        finished.filter(Finished__ge='2014-10-20').orderBy('-Finished').limit(10).all()
+        battledb.QueryBattles(BattleID=[1,2,3]).values('BattleID','Winner')
+
+    filter() takes <column>=<value> (a list, tuple, set or range means IN,
+      None means IS NULL) or <column>__<op>=<value> (see operators), plus
+      robot=<Robot, RobotID, or a list of them>: battles with that
+      competitor.  Every value is a bound parameter.
+    '''
+    operators = {
+        'eq'      : '=',
+        'ne'      : '<>',
+        'lt'      : '<',
+        'le'      : '<=',
+        'gt'      : '>',
+        'ge'      : '>=',
+        'in'      : 'IN',
+        'between' : 'BETWEEN',
+        'like'    : ' LIKE ',
+    }
+
+    def __init__( self, db, filters=(), where=(), order=None, limit=None,
+                  offset=None ):
+        self.db = db
+        # (column, op, value), as given to filter()
+        self._filters = tuple(filters)
+        # (sql, params), as given to where()
+        self._where = tuple(where)
+        # ('Column' or '-Column', ...), ending with BattleID
+        self._order = order
+        self._limit = limit
+        self._offset = offset
+
+    def __str__( self ):
+        return '[BattleQuery {0} {1}]'.format(*self.sql())
+
+    def _copy( self, **changes ):
+        state = {
+            'filters' : self._filters,
+            'where'   : self._where,
+            'order'   : self._order,
+            'limit'   : self._limit,
+            'offset'  : self._offset,
+        }
+        state.update(changes)
+        return BattleQuery(self.db,**state)
+
+    @staticmethod
+    def _column( column ):
+        if column not in Battle.columns:
+            raise KeyError('Unknown Battles column: {0}'.format(column))
+        return column
+
+    def filter( self, **conditions ):
+        '''
+        Add <conditions> (see above); they must all hold.
+        '''
+        filters = list(self._filters)
+        for field,value in sorted(conditions.items()):
+            column,_,op = field.partition('__')
+            if isinstance(value,(list,tuple,set,frozenset,range)) and op == '':
+                op = 'in'
+            if isinstance(value,(Robot,Battle)):
+                value = value.RobotID if isinstance(value,Robot) else value.BattleID
+
+            if column == 'robot':
+                robots = value if isinstance(value,(list,tuple,set,frozenset)) \
+                         else [value]
+                filters.append(('robot','in',
+                                [ r.RobotID if isinstance(r,Robot) else r for r in robots ]))
+                continue
+
+            self._column(column)
+            op = op or 'eq'
+            if op not in BattleQuery.operators:
+                raise ValueError('Unknown operator: {0}'.format(field))
+            if op == 'in' and not isinstance(value,range):
+                value = list(value)
+            elif op == 'between':
+                value = tuple(value)
+            filters.append((column,op,value))
+        return self._copy(filters=filters)
+
+    def where( self, sql, *params ):
+        '''
+        Add an SQL condition (on the Battles table), with its parameters.
+          Only for a backend with SQL (BattleDB.NotSupported otherwise).
+        '''
+        self.db.requireSQL('SQL conditions')
+        return self._copy(where=self._where+((sql,params),))
+
+    def orderBy( self, *columns ):
+        '''
+        Order by <columns> ('-Column' for descending).  BattleID is always
+          the last key.
+        '''
+        for column in columns:
+            self._column(column[1:] if column.startswith('-') else column)
+        if 'BattleID' not in columns:
+            columns += ( 'BattleID', )
+        return self._copy(order=columns)
+
+    def limit( self, limit, offset=None ):
+        return self._copy(limit=limit,offset=offset)
+
+    def sql( self ):
+        '''
+        Return (where,params).
+        '''
+        conds = []
+        params = []
+        for column,op,value in self._filters:
+            if column == 'robot':
+                conds.append('BattleID IN ( SELECT BattleID FROM BattleRobots WHERE RobotID IN ({0}) )'.format(
+                    ','.join('?'*len(value))))
+                params.extend(value)
+            elif value is None and op in ('eq','ne'):
+                conds.append('{0} IS {1}NULL'.format(
+                    column, 'NOT ' if op == 'ne' else ''))
+            elif op == 'in':
+                if isinstance(value,range) and value.step == 1:
+                    conds.append('{0} BETWEEN ? AND ?'.format(column))
+                    params.extend([value.start,value.stop-1])
+                else:
+                    value = list(value)
+                    conds.append('{0} IN ({1})'.format(
+                        column,','.join('?'*len(value))))
+                    params.extend(value)
+            elif op == 'between':
+                conds.append('{0} BETWEEN ? AND ?'.format(column))
+                params.extend(value)
+            else:
+                conds.append('{0}{1}?'.format(column,BattleQuery.operators[op]))
+                params.append(value)
+        for sql,sqlParams in self._where:
+            conds.append('( {0} )'.format(sql))
+            params.extend(sqlParams)
+        return ' AND '.join(conds) or '1', params
+
+    def orderSQL( self ):
+        '''
+        Return the ORDER BY keys.
+        '''
+        if self._order is None:
+            return 'BattleID'
+        return ', '.join( '{0} DESC'.format(column[1:]) if column.startswith('-')
+                          else column
+                          for column in self._order )
+
+    def _select( self, columns ):
+        where,params = self.sql()
+        sql = 'SELECT {0} FROM Battles WHERE {1} ORDER BY {2}'.format(
+            columns, where, self.orderSQL())
+        if self._limit is not None:
+            sql += ' LIMIT {0:d} OFFSET {1:d}'.format(self._limit,self._offset or 0)
+        return sql,params
+
+    def all( self ):
+        '''
+        Return the matching battles (BattleData.Battle, with competitors).
+        '''
+        return self.db._loadBattles(self)
+
+    def iter( self, batchSize=1000 ):
+        '''
+        Generate the matching battles, loading <batchSize> at a time (see
+          BattleDB.IterBattles()).  Only in BattleID order, without a limit.
+        '''
+        if self._order is not None or self._limit is not None:
+            raise ValueError('iter() pages by BattleID: no orderBy() or limit()')
+        return self.db._iterBattles(self,batchSize)
+
+    def __iter__( self ):
+        return self.iter()
+
+    def values( self, *columns ):
+        '''
+        Return just <columns> (default: all of them) of the matching
+          battles, as rows (sqlite3.Row, or the like: by index or by name).
+        '''
+        return self.db.backend.values(self,[ self._column(c) for c in columns ]
+                                           or list(Battle.columns))
+
+    def ids( self ):
+        return [ row[0] for row in self.values('BattleID') ]
+
+    def count( self ):
+        return self.db.backend.count(self)
+
+    def exists( self ):
+        return self.db.backend.count(self.limit(1)) > 0
+
+
+# Connections that were inherited across a fork(). They must never be used
+#   or closed by the child, so they are kept here rather than collected.
+_inherited = []
+
+
+class QueryStats:
+    '''
+    Per statement template (the SQL with its whitespace and lists of
+    parameters collapsed): the number of calls, the time spent executing
+    and fetching, the rows returned (or changed), and a histogram of the
+    latencies.
+
+    Statements slower than <slowQuery> seconds are written, with their
+    EXPLAIN QUERY PLAN, to the file <slowLog> (default: sys.stderr).
+    '''
+    _space = re.compile(r'\s+')
+    _list = re.compile(r'\?(\s*,\s*\?)+')
+
+    # latency histogram buckets: [0,1us), [1,2us), [2,4us), ... [2^21us,)
+    buckets = 23
+
+    def __init__( self, slowQuery=None, slowLog=None ):
+        self.slowQuery = slowQuery
+        self.slowLog = slowLog
+        self.debug = False
+        self.reset()
+
+    def reset( self ):
+        self.templates = {}
+        self._normalized = {}
+
+    def template( self, sql ):
+        try:
+            return self._normalized[sql]
+        except KeyError:
+            pass
+        template = self._list.sub('?,...',self._space.sub(' ',sql).strip())
+        self._normalized[sql] = template
+        return template
+
+    def record( self, template, seconds, rows ):
+        try:
+            stats = self.templates[template]
+        except KeyError:
+            stats = self.templates[template] = [ 0, 0.0, 0, 0.0,
+                                                 [0]*QueryStats.buckets ]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] += rows
+        stats[3] = max(stats[3],seconds)
+        bucket = min(int(seconds*1e6).bit_length(),QueryStats.buckets-1)
+        stats[4][bucket] += 1
+
+    def slow( self, conn, sql, params, seconds, rows ):
+        '''
+        Log a slow statement, with its query plan.
+        '''
+        try:
+            plan = [ '    {0}'.format(row[-1]) for row in
+                     conn.cursor(sqlite3.Cursor).execute(
+                         'EXPLAIN QUERY PLAN '+sql, params) ]
+        except (sqlite3.Error,ValueError) as e:
+            plan = [ '    (no plan: {0})'.format(e) ]
+        entry = '[SLOW QUERY] {0:.3f}s {1} rows {2}\n  {3}\n  params: {4}\n{5}\n'.format(
+            seconds, rows,
+            datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+            self.template(sql), params, '\n'.join(plan))
+        if self.slowLog is None:
+            print(entry,file=sys.stderr)
+        else:
+            with open(self.slowLog,'a') as log:
+                print(entry,file=log)
+
+    def snapshot( self ):
+        '''
+        Return a list of dicts (one per template, the most total time
+        first): template, calls, seconds, mean, max, rows, histogram (the
+        number of calls per latency bucket; see histogramBounds()).
+        '''
+        return sorted([
+            { 'template'   : template,
+              'calls'      : calls,
+              'seconds'    : seconds,
+              'mean'       : seconds/calls,
+              'max'        : longest,
+              'rows'       : rows,
+              'histogram'  : list(histogram) }
+            for template,(calls,seconds,rows,longest,histogram)
+            in self.templates.items()
+        ], key=lambda s: s['seconds'], reverse=True)
+
+    @staticmethod
+    def histogramBounds():
+        '''
+        The upper bound (seconds) of each histogram bucket.
+        '''
+        return [ (1 << b)/1e6 for b in range(QueryStats.buckets-1) ] + \
+               [ float('inf') ]
+
+
+class _Cursor(sqlite3.Cursor):
+    '''
+    A cursor that times its statement (execution and fetching) and counts
+    its rows into its connection's QueryStats.
+    '''
+    _sql = None
+
+    def execute( self, sql, params=() ):
+        self._finish()
+        stats = self.connection.stats
+        if stats.debug:
+            print('[SQLITE3.EXECUTE]\n  query: {0}\n  params: {1}'.format(sql,params))
+        self._sql = sql
+        self._params = params
+        self._rows = 0
+        start = time.perf_counter()
+        try:
+            super().execute(sql,params)
+        finally:
+            self._elapsed = time.perf_counter() - start
+        if self.description is None:
+            # nothing to fetch
+            self._rows = max(self.rowcount,0)
+            self._finish()
+        return self
+
+    def executemany( self, sql, seq_of_params ):
+        self._finish()
+        stats = self.connection.stats
+        if stats.debug:
+            print('[SQLITE3.EXECUTEMANY]\n  query: {0}'.format(sql))
+        start = time.perf_counter()
+        try:
+            super().executemany(sql,seq_of_params)
+        finally:
+            stats.record(stats.template(sql),time.perf_counter()-start,
+                         max(self.rowcount,0))
+        return self
+
+    def _finish( self ):
+        if self._sql is None:
+            return
+        sql = self._sql
+        self._sql = None
+        stats = self.connection.stats
+        stats.record(stats.template(sql),self._elapsed,self._rows)
+        if stats.slowQuery is not None and self._elapsed >= stats.slowQuery:
+            stats.slow(self.connection,sql,self._params,self._elapsed,self._rows)
+
+    def __next__( self ):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._elapsed += time.perf_counter() - start
+            self._finish()
+            raise
+        self._elapsed += time.perf_counter() - start
+        self._rows += 1
+        return row
+
+    def fetchone( self ):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._elapsed += time.perf_counter() - start
+        if row is None:
+            self._finish()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany( self, size=None ):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._elapsed += time.perf_counter() - start
+        self._rows += len(rows)
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall( self ):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._elapsed += time.perf_counter() - start
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def close( self ):
+        self._finish()
+        super().close()
+
+    def __del__( self ):
+        # A cursor that wasn't read to the end
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+
+class _Connection(sqlite3.Connection):
+    '''
+    A connection whose statements all go through _Cursor, whichever way
+    they're executed.
+    '''
+    stats = None
+
+    def cursor( self, factory=_Cursor ):
+        return super().cursor(factory)
+
+    def execute( self, sql, params=() ):
+        return self.cursor().execute(sql,params)
+
+    def executemany( self, sql, seq_of_params ):
+        return self.cursor().executemany(sql,seq_of_params)
+
+class SQLiteBackend:
+    '''
+    BattleDB's storage in an SQLite database (the default backend).
+
+    A backend holds the connection and its transactions, and the
+    primitives BattleDB's core API is built on: robots, scheduling,
+    claiming and completing battles, obsolescence, the leaderboard and the
+    battle queries (given as a BattleQuery).  BattleDB does the rest --
+    checking arguments, the identity map of robots, the hooks, and making
+    the records -- so any object with the same methods (e.g.
+    MemoryBattleData.MemoryBackend) serves the same API.
+
+    Everything else BattleDB does (execute(), SQL conditions, ratings,
+    recordings, archiving and export) is SQL on this backend's <conn>; a
+    backend without SQL (<sql> False) rejects it with BattleDB.NotSupported.
+    '''
+    sql = True
+    synchronousLevels = ( 'OFF', 'NORMAL', 'FULL', 'EXTRA' )
+
+    leaderboardOrders = {
+        'wins'    : 'Wins DESC, AverageScore DESC',
+        'score'   : 'TotalScore DESC',
+        'average' : 'AverageScore DESC, Wins DESC',
+    }
+
+    def __init__( self, db_file, busyTimeout=30.0, synchronous='NORMAL',
+                  journalMode='WAL', lockRetries=5, slowQuery=None,
+                  slowLog=None ):
+        '''
+        <busyTimeout> is how long (seconds) SQLite itself waits on a locked
+           database before giving up; a write transaction that still can't
+           get the lock is retried (with backoff) up to <lockRetries> times.
+        <synchronous> is the PRAGMA synchronous level.
+        <journalMode> is the PRAGMA journal_mode (None leaves it alone).
+        <slowQuery> is the time (seconds) above which a statement is logged,
+           with its query plan, to the file <slowLog> (default: stderr).
+           Every statement is counted and timed in queryStats (see stats()).
+        '''
+        if synchronous is not None and synchronous.upper() not in SQLiteBackend.synchronousLevels:
+            raise ValueError('Unknown synchronous level: {0}'.format(synchronous))
+
         self.db_file = db_file
+        self.busyTimeout = busyTimeout
+        self.synchronous = synchronous
+        self.journalMode = journalMode
+        self.lockRetries = lockRetries
         self.conn = None
+        self._pid = None
         self._debug = False
+        self.queryStats = QueryStats(slowQuery,slowLog)
+        # Called (without arguments) once the current transaction commits;
+        #   see afterCommit().
+        self._afterCommit = []
+        self._lockStats = {
+            'transactions'  : 0,
+            'retries'       : 0,
+            'waited'        : 0.0,
+            'maxWait'       : 0.0,
+        }
 
     def __del__( self ):
-        if self.conn:
+        if self.conn and self._pid == os.getpid():
             self.conn.close()
 
+    def __getstate__( self ):
+        # A connection can't be pickled (or shared): each process opens its own.
+        state = self.__dict__.copy()
+        state['conn'] = None
+        state['_pid'] = None
+        state['_afterCommit'] = []
+        return state
+
+    def __str__( self ):
+        return '[SQLiteBackend file({0})]'.format(self.db_file)
+
+    def connect( self ):
+        '''
+        Open the connection, unless this process already has.  Return True
+          if it was opened (the schema is then for the caller to check).
+        '''
+        if self.conn is not None:
+            if self._pid == os.getpid():
+                return False
+            # Inherited across a fork(): leave it alone, and open our own.
+            _inherited.append(self.conn)
+            self.conn = None
+
+        self.conn = sqlite3.connect(self.db_file,
+                                    timeout = self.busyTimeout,
+                                    # autocommit
+                                    isolation_level = None,
+                                    factory = _Connection)
+        self.conn.stats = self.queryStats
+        self._pid = os.getpid()
+        self.conn.row_factory = sqlite3.Row
+
+        # (only takes effect on a new database; see BattleDB.Archive())
+        self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        if self.journalMode is not None:
+            self.conn.execute('PRAGMA journal_mode={0}'.format(self.journalMode)).fetchall()
+        if self.synchronous is not None:
+            self.conn.execute('PRAGMA synchronous={0}'.format(self.synchronous.upper()))
+        return True
+
+    def close( self ):
+        '''
+        Close the connection (the next query opens a new one).  It can only
+          be closed by the thread that opened it: a copy of the BattleDB
+          used by another thread is closed there.
+        '''
+        if self.conn is not None and self._pid == os.getpid():
+            self.conn.close()
+        self.conn = None
+
+    def stats( self ):
+        '''
+        Return a snapshot of this process's statement statistics (see
+        QueryStats.snapshot()).
+        '''
+        return self.queryStats.snapshot()
+
+    def lockStats( self ):
+        '''
+        Return a dict describing the time this process has spent waiting for
+        the write lock:
+           transactions: the number of write transactions started
+           retries:      the number of times the lock couldn't be taken
+           waited:       the total time (seconds) spent acquiring the lock
+           maxWait:      the longest single wait (seconds)
+        '''
+        return dict(self._lockStats)
+
+
+    def _begin( self ):
+        '''
+        Start a write transaction, retrying with exponential backoff while
+        the database stays locked.
+        '''
+        start = time.perf_counter()
+        delay = 0.05
+        retries = 0
+        while True:
+            try:
+                self.conn.execute('BEGIN IMMEDIATE')
+                break
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) or retries >= self.lockRetries:
+                    raise
+                retries += 1
+                if self._debug:
+                    print('Database locked; retry #{0} in {1:.2f}s'.format(retries,delay))
+                time.sleep(delay * random.uniform(0.5,1.5))
+                delay = min(delay * 2, 5.0)
+
+        waited = time.perf_counter() - start
+        self._lockStats['transactions'] += 1
+        self._lockStats['retries'] += retries
+        self._lockStats['waited'] += waited
+        self._lockStats['maxWait'] = max(self._lockStats['maxWait'],waited)
+
+
+    @contextmanager
+    def transaction( self ):
+        '''
+        Run the enclosed statements in a single transaction, holding the
+        write lock from the start. Commit on success, roll back on an
+        exception.
+
+        Nested use joins the enclosing transaction.
+
+        Once it has committed, the callbacks given to afterCommit() are
+        called, together, holding the write lock again.
+        '''
+        self.connect()
+        if self.conn.in_transaction:
+            yield self.conn
+            return
+
+        self._begin()
+        self._afterCommit = []
+        try:
+            yield self.conn
+            self.conn.execute('COMMIT')
+        except:
+            self._afterCommit = []
+            if self.conn.in_transaction:
+                self.conn.execute('ROLLBACK')
+            raise
+
+        callbacks,self._afterCommit = self._afterCommit,[]
+        if callbacks:
+            with self.transaction():
+                for callback in callbacks:
+                    callback()
+
+    def afterCommit( self, callback ):
+        '''
+        Call <callback>() once the current transaction has committed (at
+          once, outside a transaction); if it's rolled back, never.
+
+        This is for state kept outside the database (e.g. HeadToHead's
+          array), which a rollback can't undo.  The callbacks still hold the
+          write lock, so they're serialized like the transaction itself.
+        '''
+        self.connect()
+        if self.conn.in_transaction:
+            self._afterCommit.append(callback)
+        else:
+            callback()
+
+    @contextmanager
+    def savepoint( self ):
+        '''
+        Within a transaction: an exception undoes just the enclosed
+          statements.
+        '''
+        self.conn.execute('SAVEPOINT result')
+        try:
+            yield
+        except:
+            self.conn.execute('ROLLBACK TO result')
+            raise
+        finally:
+            self.conn.execute('RELEASE result')
+
+
+    #
+    # Robots
+    #
+
+    def robotsVersion( self ):
+        '''
+        Return what the robots BattleDB has loaded are only good for: the
+          database file, its schema version, and its data_version (which
+          changes whenever another connection commits a change).
+        '''
+        try:
+            st = os.stat(self.db_file)
+            fileID = (st.st_dev,st.st_ino)
+        except (OSError,ValueError):
+            # e.g. ':memory:'
+            fileID = None
+        return ( fileID,
+                 self.conn.execute('PRAGMA schema_version').fetchone()[0],
+                 self.conn.execute('PRAGMA data_version').fetchone()[0] )
+
+    def robotRecords( self, ids=None, name=None ):
+        '''
+        Return the Robots records: every one, those with the RobotIDs
+          <ids>, or the one named <name>.
+        '''
+        if name is not None:
+            return self.conn.execute('''
+               SELECT *
+               FROM Robots
+               WHERE Name=?
+               ;
+            ''',[name]).fetchall()
+        if ids is not None:
+            ids = list(ids)
+            return [ record
+                     for i in range(0,len(ids),500)
+                     for record in self.conn.execute('''
+                        SELECT *
+                        FROM Robots
+                        WHERE RobotID IN ({0})
+                        ;
+                     '''.format(','.join('?'*len(ids[i:i+500]))),ids[i:i+500]) ]
+        return self.conn.execute('SELECT * FROM Robots').fetchall()
+
+    def insertRobot( self, name, lastUpdated ):
+        '''
+        Add a robot, and return its RobotID.
+        '''
+        return self.conn.execute('''
+           INSERT INTO Robots
+           (Name,LastUpdated)
+           VALUES (?,?)
+        ''', [name,lastUpdated]).lastrowid
+
+    def updateRobot( self, robotID, lastUpdated ):
+        self.conn.execute('''
+           UPDATE Robots
+           SET LastUpdated=?
+           WHERE RobotID=?
+        ''', [lastUpdated,robotID])
+
+
+    #
+    # Leaderboard
+    #
+
+    def leaderboard( self, order ):
+        '''
+        Return the Leaderboard records (with each robot's Name and
+          AverageScore) of the robots with any battles that count, in
+          <order> (see leaderboardOrders).
+        '''
+        return self.conn.execute('''
+           SELECT Leaderboard.RobotID, Name, Battles, Wins, TotalScore,
+                  CAST(TotalScore AS REAL)/Battles AS AverageScore
+           FROM Leaderboard
+             INNER JOIN Robots
+             ON Leaderboard.RobotID=Robots.RobotID
+           WHERE Battles > 0
+           ORDER BY {0}, Name
+           ;
+        '''.format(self.leaderboardOrders[order])).fetchall()
+
+
+    #
+    # Battles
+    #
+
+    def obsolesce( self, robotID=None, ids=False ):
+        '''
+        Make obsolete the finished battles with a competitor that has since
+          been updated (only <robotID>'s, if given), and return their
+          BattleIDs (with <ids>) or the number of them.
+        '''
+        if robotID is None:
+            where = '''
+                BattleID IN (
+                   SELECT BattleRobots.BattleID
+                   FROM BattleRobots
+                     INNER JOIN Robots
+                     ON BattleRobots.RobotID=Robots.RobotID
+                   WHERE Robots.LastUpdated > BattleRobots.RobotUpdated
+                     AND BattleRobots.RobotUpdated <> ''
+                )
+            '''
+            params = []
+        else:
+            # (only that robot's battles)
+            where = '''
+                BattleID IN (
+                   SELECT BattleID
+                   FROM BattleRobots
+                   WHERE RobotID=?
+                     AND RobotUpdated <> ''
+                     AND RobotUpdated < (
+                            SELECT LastUpdated
+                            FROM Robots
+                            WHERE RobotID=?
+                         )
+                )
+            '''
+            params = [robotID,robotID]
+        where = '''
+            {0}
+            AND Obsolete=0
+            AND State='finished'
+        '''.format(where)
+
+        with self.transaction():
+            if not ids:
+                return self.conn.execute(
+                    'UPDATE Battles SET Obsolete=1 WHERE {0}'.format(where),
+                    params).rowcount
+
+            battleIDs = [ record['BattleID'] for record in self.conn.execute(
+                              'SELECT BattleID FROM Battles WHERE {0}'.format(where),
+                              params) ]
+            self.conn.executemany(
+                'UPDATE Battles SET Obsolete=1 WHERE BattleID=?',
+                [ (id,) for id in battleIDs ])
+            return battleIDs
+
+    def loadBattles( self, query, known ):
+        '''
+        Return (battles, competitors, robots) for the battles matching
+          <query> (a BattleQuery), in its order: their Battles records,
+          (BattleID, RobotID) for each of their competitors (by BattleID,
+          RobotID), and the Robots records of those competitors whose
+          RobotIDs aren't in <known>.
+
+        Each is fetched with a single set-based query, all from the same
+          snapshot of the database, so the number of queries doesn't
+          depend on the number of battles.
+        '''
+        where,params = query.sql()
+        order = 'ORDER BY {0}'.format(query.orderSQL())
+        if query._limit is not None:
+            order += ' LIMIT {0:d} OFFSET {1:d}'.format(query._limit,query._offset or 0)
+        selected = 'SELECT BattleID FROM Battles WHERE {0} {1}'.format(where,order)
+
+        # Read everything from the same snapshot of the database.
+        snapshot = not self.conn.in_transaction
+        if snapshot:
+            self.conn.execute('BEGIN')
+        try:
+            battles = self.conn.execute('''
+               SELECT *
+               FROM Battles
+               WHERE {0}
+               {1}
+               ;
+            '''.format(where,order),params).fetchall()
+            if not battles:
+                return [], [], []
+
+            pairs = self.conn.execute('''
+               SELECT BattleID, RobotID
+               FROM BattleRobots
+               WHERE BattleID IN ( {0} )
+               ORDER BY BattleID, RobotID
+               ;
+            '''.format(selected),params).fetchall()
+
+            # Only the robots that aren't known yet
+            robots = []
+            if any( record['RobotID'] not in known for record in pairs ):
+                robots = self.conn.execute('''
+                   SELECT *
+                   FROM Robots
+                   WHERE RobotID IN (
+                      SELECT RobotID
+                      FROM BattleRobots
+                      WHERE BattleID IN ( {0} )
+                   )
+                   ;
+                '''.format(selected),params).fetchall()
+        finally:
+            if snapshot:
+                self.conn.execute('COMMIT')
+
+        return battles, pairs, robots
+
+    def values( self, query, columns ):
+        '''
+        Return <columns> of the battles matching <query>.
+        '''
+        return self.conn.execute(*query._select(','.join(columns))).fetchall()
+
+    def count( self, query ):
+        sql,params = query._select('1')
+        return self.conn.execute('SELECT COUNT(*) FROM ( {0} )'.format(sql),
+                                 params).fetchone()[0]
+
+    def battleResults( self, battleIDs, counted=False ):
+        '''
+        Return the BattleRobots records of the battles <battleIDs>, by
+          BattleID and RobotID; with <counted>, only of those that are
+          finished and not obsolete.
+        '''
+        battleIDs = list(battleIDs)
+        records = []
+        for i in range(0,len(battleIDs),500):
+            chunk = battleIDs[i:i+500]
+            where = 'BattleID IN ({0})'.format(','.join('?'*len(chunk)))
+            if counted:
+                where = '''
+                    BattleID IN (
+                       SELECT BattleID
+                       FROM Battles
+                       WHERE {0} AND State='finished' AND Obsolete=0
+                    )
+                '''.format(where)
+            records.extend(self.conn.execute('''
+               SELECT *
+               FROM BattleRobots
+               WHERE {0}
+               ORDER BY BattleID, RobotID
+               ;
+            '''.format(where),chunk))
+        return records
+
+    def scheduleBattles( self, competitors, properties ):
+        '''
+        Add scheduled battles between <competitors> (lists of RobotIDs),
+          with <properties> (JSON, one per battle), and return their
+          BattleIDs (a range).  KeyError if a RobotID isn't a robot's.
+        '''
+        with self.transaction():
+            known = { record['RobotID']
+                      for record in self.conn.execute('SELECT RobotID FROM Robots') }
+            for comps in competitors:
+                for robotID in comps:
+                    if robotID not in known:
+                        raise KeyError("GetRobot() no robot with ID '{0}' found".format(robotID))
+
+            # Nobody else can insert while we hold the write lock, so the
+            #   new BattleIDs can be assigned here rather than read back
+            #   one at a time.
+            #   (Archived BattleIDs aren't reused.)
+            first = self.conn.execute('''
+                SELECT MAX( IFNULL((SELECT MAX(BattleID) FROM Battles),0),
+                            IFNULL((SELECT MAX(LastBattleID) FROM Archives),0) )+1
+            ''').fetchone()[0]
+            ids = range(first,first+len(competitors))
+
+            self.conn.executemany('''
+               INSERT INTO Battles
+               (BattleID,State,Priority,Started,Finished,Properties,Winner,Obsolete)
+               VALUES (?,'scheduled',-1,'','',?,-1,0)
+               ;
+            ''',zip(ids,properties))
+
+            self.conn.executemany('''
+                INSERT INTO BattleRobots
+                (BattleID,RobotID,RobotUpdated,Score,Results)
+                VALUES (?,?,'',-1,'')
+                ;
+            ''',[ (battleID,robotID)
+                   for battleID,comps in zip(ids,competitors)
+                   for robotID in comps ])
+        return ids
+
+    def updateBattle( self, battleID, **columns ):
+        '''
+        Set <columns> of a battle.
+        '''
+        names = sorted(columns)
+        self.conn.execute('UPDATE Battles SET {0} WHERE BattleID=?'.format(
+            ', '.join( '{0}=?'.format(BattleQuery._column(name))
+                       for name in names )),
+            [ columns[name] for name in names ] + [battleID])
+
+    def newVersionBattles( self, battleIDs, firsts ):
+        '''
+        Return the set of <battleIDs> that are among the first <firsts>
+          battles of a competitor's version.
+        '''
+        # (counting no more than <firsts> earlier battles of each)
+        return { record['BattleID'] for record in self.conn.execute('''
+            SELECT DISTINCT BattleID
+            FROM BattleRobots
+            WHERE BattleID IN ({0})
+              AND ( SELECT COUNT(*)
+                    FROM ( SELECT 1
+                           FROM BattleRobots AS Earlier
+                           WHERE Earlier.RobotID=BattleRobots.RobotID
+                             AND Earlier.RobotUpdated=BattleRobots.RobotUpdated
+                             AND Earlier.BattleID<BattleRobots.BattleID
+                           LIMIT ? ) ) < ?
+        '''.format(','.join('?'*len(battleIDs))),list(battleIDs)+[firsts,firsts]) }
+
+    def claimBattles( self, count, started ):
+        '''
+        Mark (up to) <count> scheduled battles as running, highest Priority
+          first, and return their BattleIDs.
+        '''
+        return self._claim('''
+            BattleID IN (
+               SELECT BattleID
+               FROM Battles
+               WHERE State='scheduled'
+               ORDER BY Priority DESC, BattleID
+               LIMIT ?
+            )
+        ''',[count],started)
+
+    def startBattle( self, battleID, started ):
+        '''
+        Mark battle <battleID> as running, if it's scheduled; return
+          whether it was.
+
+        The check and the update are one conditional UPDATE, so only one
+          caller can ever start a given battle.
+        '''
+        return bool(self._claim('BattleID=?',[battleID],started))
+
+    def _claim( self, where, params, started ):
+        '''
+        Mark the scheduled battles matching <where> as running, and record
+        the version of each competitor. Return the claimed BattleIDs.
+        '''
+        update = '''
+            UPDATE Battles
+            SET State='running',
+                Started=?
+            WHERE ( {0} )
+              AND State='scheduled'
+        '''.format(where)
+
+        with self.transaction():
+            if sqlite3.sqlite_version_info >= (3,35,0):
+                claimed = [ record['BattleID']
+                            for record in self.conn.execute(
+                                update + ' RETURNING BattleID',
+                                [started] + list(params)) ]
+            else:
+                # No RETURNING: the write lock keeps the SELECT and the
+                #   UPDATE consistent.
+                claimed = [ record['BattleID']
+                            for record in self.conn.execute('''
+                               SELECT BattleID
+                               FROM Battles
+                               WHERE ( {0} )
+                                 AND State='scheduled'
+                            '''.format(where),params) ]
+                self.conn.execute(update,[started] + list(params))
+
+            if claimed:
+                # Update the BattleRobot.RobotUpdated
+                self.conn.execute('''
+                    UPDATE BattleRobots
+                    SET RobotUpdated=(
+                        SELECT LastUpdated
+                        FROM Robots
+                        WHERE RobotID=BattleRobots.RobotID
+                    )
+                    WHERE BattleID IN ({0})
+                '''.format(','.join('?'*len(claimed))),claimed)
+
+        return claimed
+
+    def completeBattle( self, battleID, battleData, winner, results ):
+        '''
+        Record a running battle's results: <battleData> (as for
+          BattleDB.BattleCompleted()), the RobotID of the <winner>, and
+          <results>, { RobotID: (Score, Results, Results parsed) }.  It's
+          obsolete at once if a competitor was updated while it ran.
+        '''
+        with self.transaction():
+            # Update the BattleRobot results (before the battle is finished:
+            #   that's when they're added to the Leaderboard)
+            for robotID,(score,text,parsed) in results.items():
+                typed = BattleRobot.typedResults(parsed)
+                self.conn.execute('''
+                    UPDATE BattleRobots
+                    SET Score=?,
+                        Results=?,
+                        {0}
+                    WHERE BattleID=? AND RobotID=?
+                '''.format(','.join([ '{0}=?'.format(col)
+                                      for col,field in BattleRobot.resultFields ])),
+                  [ score, text ] +
+                  [ typed[col] for col,field in BattleRobot.resultFields ] +
+                  [ battleID, robotID ])
+
+            # Change the Battle.State.  A competitor may have been updated
+            #   while the battle ran, making it obsolete already.
+            self.conn.execute('''
+                UPDATE Battles
+                SET State='finished',
+                    Started=?,
+                    Finished=?,
+                    Winner=?,
+                    Properties=?,
+                    Recording=IFNULL(?,Recording),
+                    Recorded=?,
+                    Obsolete = CASE WHEN EXISTS (
+                         SELECT 1
+                         FROM BattleRobots
+                           INNER JOIN Robots
+                           ON BattleRobots.RobotID=Robots.RobotID
+                         WHERE BattleRobots.BattleID=Battles.BattleID
+                           AND Robots.LastUpdated > BattleRobots.RobotUpdated
+                           AND BattleRobots.RobotUpdated <> ''
+                      ) THEN 1 ELSE Obsolete END
+                WHERE BattleID=?
+            ''',[battleData['Started'],
+                 battleData['Finished'],
+                 winner,
+                 battleData['Properties'], # these should be definitive
+                 battleData.get('Recording'),
+                 battleData.get('Recorded'),
+
+                 battleID])
+
+
+class BattleDB:
+    synchronousLevels = SQLiteBackend.synchronousLevels
+
+    def __init__( self, db_file, busyTimeout=30.0, synchronous='NORMAL',
+                  journalMode='WAL', lockRetries=5, slowQuery=None,
+                  slowLog=None, backend=None ):
+        '''
+        <backend> stores the robots and battles (see SQLiteBackend); by
+           default, an SQLiteBackend on the database file <db_file>, with
+           the rest of the arguments:
+        <busyTimeout> is how long (seconds) SQLite itself waits on a locked
+           database before giving up; a write transaction that still can't
+           get the lock is retried (with backoff) up to <lockRetries> times.
+        <synchronous> is the PRAGMA synchronous level.
+        <journalMode> is the PRAGMA journal_mode (None leaves it alone).
+        <slowQuery> is the time (seconds) above which a statement is logged,
+           with its query plan, to the file <slowLog> (default: stderr).
+           Every statement is counted and timed in queryStats (see stats()).
+        '''
+        if backend is None:
+            backend = SQLiteBackend(db_file,busyTimeout,synchronous,
+                                    journalMode,lockRetries,slowQuery,slowLog)
+
+        self.db_file = db_file
+        self.backend = backend
+        self._debug = False
+        self.lastObsoleted = 0
+        # Called as hook(battledb,battleID) when a battle's results are
+        #   recorded, within the same transaction.
+        self.completedHooks = []
+        # Called as hook(battledb,battleIDs) when finished battles are made
+        #   obsolete (by UpdateRobot() or the Obsolesce*() methods).
+        self.obsoletedHooks = []
+        self.flushRobots()
+
+    def close( self ):
+        '''
+        Close the backend's connection (the next query opens a new one).  It
+          can only be closed by the thread that opened it: a copy of the
+          BattleDB used by another thread is closed there.
+        '''
+        self.backend.close()
+
+    def __getstate__( self ):
+        # Each copy (in another process or thread) has its own connection...
+        state = self.__dict__.copy()
+        state['backend'] = copy.copy(self.backend)
+        # ... and keeps its own robots
+        state['_robotsByID'] = {}
+        state['_robotsByName'] = {}
+        state['_robotsValid'] = None
+        return state
+
     def __str__( self ):
         return '[BattleDB file({0})]'.format(
             self.db_file,
         )
 
-    def execute( self, *args ):
-        if self._debug:
-            print('[SQLITE3.EXECUTE]\n  query: {0}\n  params: {1}'.format(args[0],args[1]))
+    @property
+    def conn( self ):
+        '''
+        The backend's SQL connection (BattleDB.NotSupported without SQL).
+        '''
+        return self.backend.conn
+
+    @property
+    def queryStats( self ):
+        return self.backend.queryStats
+
+    class NotSupported(Exception):
+        '''
+        The backend can't do that: it has no SQL (see requireSQL()).
+        '''
+
+    def requireSQL( self, what ):
+        '''
+        Raise BattleDB.NotSupported, about <what>, unless the backend has SQL.
+        '''
+        if not self.backend.sql:
+            raise BattleDB.NotSupported('{0} need an SQL backend, not {1}'.format(
+                what,self.backend))
+
+    def execute( self, sql, params=() ):
+        self.connect()
+        return self.conn.execute(sql,params)
+
+    def executemany( self, sql, seq_of_params ):
+        self.connect()
+        return self.conn.executemany(sql,seq_of_params)
 
-        return self.conn.execute(*args)
+    def stats( self ):
+        '''
+        Return a snapshot of this process's statement statistics (see
+        QueryStats.snapshot()).
+        '''
+        return self.backend.stats()
 
     def debug( self, state=None ):
         if state is None:
             self._debug = not self._debug
         else:
             self._debug = state
+        # every statement is printed
+        self.backend._debug = self._debug
+        self.queryStats.debug = self._debug
         print('Debug: {0}'.format(self._debug))
 
-    def connect( self ):
-        if self.conn is not None:
-            return
-
-        self.conn = sqlite3.connect(self.db_file,
-                                    # autocommit
-                                    isolation_level = None)
-        self.conn.row_factory = sqlite3.Row
-
-        self.conn.execute('''
-            CREATE TABLE IF NOT EXISTS Robots (
-               RobotID INTEGER PRIMARY KEY,
-               Name TEXT,
-               LastUpdated Text
-            );
-            ''')
+    # The original (user_version 0) schema.
+    schema = [
+        '''
+        CREATE TABLE IF NOT EXISTS Robots (
+           RobotID INTEGER PRIMARY KEY,
+           Name TEXT,
+           LastUpdated Text
+        );
+        ''',
 
         # State: scheduled,running,finished
         # Started/Finish: ISO timestamps
         # Obsolete: boolean
-        self.conn.execute('''
-            CREATE TABLE IF NOT EXISTS Battles (
-               BattleID INTEGER PRIMARY KEY,
-               Priority INTEGER,
-               State TEXT,
-               Started TEXT,
-               Finished TEXT,
-               Properties TEXT,
-               Winner INTEGER,
-               Obsolete INTEGER
-            );
-            ''')
+        '''
+        CREATE TABLE IF NOT EXISTS Battles (
+           BattleID INTEGER PRIMARY KEY,
+           Priority INTEGER,
+           State TEXT,
+           Started TEXT,
+           Finished TEXT,
+           Properties TEXT,
+           Winner INTEGER,
+           Obsolete INTEGER
+        );
+        ''',
 
         # Score: -1 means no results
         # Results: stringified dict of properties
-        self.conn.execute('''
-            CREATE TABLE IF NOT EXISTS BattleRobots (
-               BattleID INTEGER,
-               RobotID INTEGER,
-               RobotUpdated TEXT,
-               Score INTEGER,
-               Results TEXT,
-               PRIMARY KEY(BattleID,RobotID)
+        '''
+        CREATE TABLE IF NOT EXISTS BattleRobots (
+           BattleID INTEGER,
+           RobotID INTEGER,
+           RobotUpdated TEXT,
+           Score INTEGER,
+           Results TEXT,
+           PRIMARY KEY(BattleID,RobotID)
+        );
+        ''',
+    ]
+
+    # Schema migrations: (user_version, description, steps)
+    #   Each step is either a SQL statement or a callable that is passed
+    #   the BattleDB. The steps for a version are applied in a single
+    #   transaction, which also sets PRAGMA user_version.
+    #   Never edit a released migration; append a new one.
+    migrations = [
+        (1, 'secondary indexes', [
+            '''
+            CREATE INDEX IF NOT EXISTS Battles_State_Obsolete
+            ON Battles (State,Obsolete);
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS BattleRobots_RobotID
+            ON BattleRobots (RobotID);
+            ''',
+            lambda db: db._checkRobotNames(),
+            '''
+            CREATE UNIQUE INDEX IF NOT EXISTS Robots_Name
+            ON Robots (Name);
+            ''',
+        ]),
+        (2, 'claim order index', [
+            '''
+            CREATE INDEX IF NOT EXISTS Battles_State_Priority
+            ON Battles (State,Priority DESC,BattleID);
+            ''',
+        ]),
+        (3, 'typed result columns', [
+            'ALTER TABLE BattleRobots ADD COLUMN Place INTEGER',
+            'ALTER TABLE BattleRobots ADD COLUMN TotalScore INTEGER',
+            'ALTER TABLE BattleRobots ADD COLUMN Survival INTEGER',
+            'ALTER TABLE BattleRobots ADD COLUMN SurvivalBonus INTEGER',
+            'ALTER TABLE BattleRobots ADD COLUMN BulletDamage INTEGER',
+            'ALTER TABLE BattleRobots ADD COLUMN BulletBonus INTEGER',
+            'ALTER TABLE BattleRobots ADD COLUMN RamDamage INTEGER',
+            'ALTER TABLE BattleRobots ADD COLUMN RamBonus INTEGER',
+            'ALTER TABLE BattleRobots ADD COLUMN Firsts INTEGER',
+            'ALTER TABLE BattleRobots ADD COLUMN Seconds INTEGER',
+            'ALTER TABLE BattleRobots ADD COLUMN Thirds INTEGER',
+            '''
+            UPDATE BattleRobots
+            SET Score=CAST(Score AS INTEGER)
+            WHERE typeof(Score)='text' AND Score GLOB '[0-9]*'
+            ''',
+            lambda db: db._backfillResults(),
+        ]),
+        # One row per robot, totalled over its finished, non-obsolete
+        #   battles.  The triggers keep it up to date as battles finish,
+        #   become obsolete, or are deleted, touching only the battle's
+        #   competitors.
+        (4, 'leaderboard', [
+            '''
+            CREATE TABLE IF NOT EXISTS Leaderboard (
+               RobotID INTEGER PRIMARY KEY,
+               Battles INTEGER NOT NULL DEFAULT 0,
+               Wins INTEGER NOT NULL DEFAULT 0,
+               TotalScore INTEGER NOT NULL DEFAULT 0
             );
-            ''')
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS Leaderboard_Add
+            AFTER UPDATE OF State, Obsolete ON Battles
+            WHEN NEW.State='finished' AND NEW.Obsolete=0
+             AND NOT ( OLD.State='finished' AND OLD.Obsolete=0 )
+            BEGIN
+               INSERT INTO Leaderboard (RobotID,Battles,Wins,TotalScore)
+               SELECT RobotID, 1, RobotID=NEW.Winner, Score
+               FROM BattleRobots
+               WHERE BattleID=NEW.BattleID
+               ON CONFLICT (RobotID) DO UPDATE
+               SET Battles = Battles + 1,
+                   Wins = Wins + excluded.Wins,
+                   TotalScore = TotalScore + excluded.TotalScore;
+            END;
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS Leaderboard_Remove
+            AFTER UPDATE OF State, Obsolete ON Battles
+            WHEN OLD.State='finished' AND OLD.Obsolete=0
+             AND NOT ( NEW.State='finished' AND NEW.Obsolete=0 )
+            BEGIN
+               UPDATE Leaderboard
+               SET Battles = Battles - 1,
+                   Wins = Wins - ( RobotID=OLD.Winner ),
+                   TotalScore = TotalScore - (
+                      SELECT Score
+                      FROM BattleRobots
+                      WHERE BattleID=OLD.BattleID
+                        AND BattleRobots.RobotID=Leaderboard.RobotID )
+               WHERE RobotID IN (
+                  SELECT RobotID FROM BattleRobots WHERE BattleID=OLD.BattleID );
+            END;
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS Leaderboard_Delete
+            BEFORE DELETE ON Battles
+            WHEN OLD.State='finished' AND OLD.Obsolete=0
+            BEGIN
+               UPDATE Leaderboard
+               SET Battles = Battles - 1,
+                   Wins = Wins - ( RobotID=OLD.Winner ),
+                   TotalScore = TotalScore - (
+                      SELECT Score
+                      FROM BattleRobots
+                      WHERE BattleID=OLD.BattleID
+                        AND BattleRobots.RobotID=Leaderboard.RobotID )
+               WHERE RobotID IN (
+                  SELECT RobotID FROM BattleRobots WHERE BattleID=OLD.BattleID );
+            END;
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS Leaderboard_Score
+            AFTER UPDATE OF Score ON BattleRobots
+            WHEN EXISTS ( SELECT 1 FROM Battles
+                          WHERE BattleID=NEW.BattleID
+                            AND State='finished' AND Obsolete=0 )
+            BEGIN
+               UPDATE Leaderboard
+               SET TotalScore = TotalScore - OLD.Score + NEW.Score
+               WHERE RobotID=NEW.RobotID;
+            END;
+            ''',
+            '''
+            DELETE FROM Leaderboard;
+            ''',
+            '''
+            INSERT INTO Leaderboard (RobotID,Battles,Wins,TotalScore)
+            SELECT BattleRobots.RobotID,
+                   COUNT(*),
+                   TOTAL(BattleRobots.RobotID=Battles.Winner),
+                   TOTAL(BattleRobots.Score)
+            FROM BattleRobots
+              INNER JOIN Battles
+              ON BattleRobots.BattleID=Battles.BattleID
+            WHERE Battles.State='finished' AND Battles.Obsolete=0
+            GROUP BY BattleRobots.RobotID;
+            ''',
+        ]),
+        # Ratings (see Rating.py) are per robot version: a RobotUpdated.
+        (5, 'ratings', [
+            '''
+            CREATE TABLE IF NOT EXISTS Ratings (
+               RobotID INTEGER NOT NULL,
+               RobotUpdated TEXT NOT NULL,
+               System TEXT NOT NULL,
+               Rating REAL NOT NULL,
+               Battles INTEGER NOT NULL DEFAULT 0,
+               PRIMARY KEY (System,RobotID,RobotUpdated)
+            ) WITHOUT ROWID;
+            ''',
+        ]),
+        # Archive() moves battles to an archive database, leaving totals
+        #   per robot version in Rollups and a record of each run in
+        #   Archives.
+        (6, 'archive', [
+            '''
+            CREATE TABLE IF NOT EXISTS Rollups (
+               RobotID INTEGER NOT NULL,
+               RobotUpdated TEXT NOT NULL,
+               Battles INTEGER NOT NULL DEFAULT 0,
+               Obsolete INTEGER NOT NULL DEFAULT 0,
+               Wins INTEGER NOT NULL DEFAULT 0,
+               TotalScore INTEGER NOT NULL DEFAULT 0,
+               FirstFinished TEXT,
+               LastFinished TEXT,
+               PRIMARY KEY (RobotID,RobotUpdated)
+            ) WITHOUT ROWID;
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS Archives (
+               ArchiveID INTEGER PRIMARY KEY,
+               Archived TEXT,
+               File TEXT,
+               Battles INTEGER,
+               LastBattleID INTEGER
+            );
+            ''',
+        ]),
+        # Battles' recordings in the recording store (RecordingStore.py),
+        #   by the Hash of their contents.  Size is the recording's, Stored
+        #   what it takes compressed; Matchup is the competitors' RobotIDs,
+        #   for keeping the latest few of each matchup.
+        (7, 'recordings', [
+            '''
+            CREATE TABLE IF NOT EXISTS Recordings (
+               BattleID INTEGER PRIMARY KEY,
+               Hash TEXT NOT NULL,
+               Size INTEGER,
+               Stored INTEGER,
+               Recorded TEXT,
+               Matchup TEXT
+            );
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS Recordings_Hash
+            ON Recordings (Hash);
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS Recordings_Matchup
+            ON Recordings (Matchup,BattleID DESC);
+            ''',
+        ]),
+        # Recording: the recording policy a battle ran under (see
+        #   Robocode.RecordingPolicy), or 'rerun' for one scheduled to be
+        #   recorded; Recorded: whether it was.  The index finds a robot
+        #   version's first battles (GetNewVersionBattles()).
+        (8, 'recording policy', [
+            lambda db: db._addColumn('Battles','Recording TEXT'),
+            lambda db: db._addColumn('Battles','Recorded INTEGER'),
+            '''
+            CREATE INDEX IF NOT EXISTS BattleRobots_Version
+            ON BattleRobots (RobotID,RobotUpdated,BattleID);
+            ''',
+        ]),
+    ]
+
+    def connect( self ):
+        '''
+        Connect the backend, unless this process already has; a new SQL
+          connection also brings the schema up to date.
+        '''
+        if not self.backend.connect():
+            return
+
+        # (a new connection's data_version says nothing about the old one's)
+        self.flushRobots()
+        if self.backend.sql:
+            for statement in self.__class__.schema:
+                self.conn.execute(statement)
+            self.migrate()
+        self._checkRobots()
+
+
+    def lockStats( self ):
+        '''
+        Return a dict describing the time this process has spent waiting for
+        the write lock (see SQLiteBackend.lockStats()).
+        '''
+        return self.backend.lockStats()
+
+
+    def transaction( self ):
+        '''
+        Return a context manager running the enclosed calls in a single
+        transaction, holding the write lock from the start. Commit on
+        success, roll back on an exception.
+
+        Nested use joins the enclosing transaction.
+
+        Once it has committed, the callbacks given to afterCommit() are
+        called, together, holding the write lock again.
+        '''
+        self.connect()
+        return self.backend.transaction()
+
+    def afterCommit( self, callback ):
+        '''
+        Call <callback>() once the current transaction has committed (at
+          once, outside a transaction); if it's rolled back, never.
+
+        This is for state kept outside the database (e.g. HeadToHead's
+          array), which a rollback can't undo.  The callbacks still hold the
+          write lock, so they're serialized like the transaction itself.
+        '''
+        self.connect()
+        self.backend.afterCommit(callback)
+
+
+    def _backfillResults( self ):
+        '''
+        Fill in the typed result columns from the Results of every
+        recorded battle.
+        '''
+        update = '''
+            UPDATE BattleRobots
+            SET {0}
+            WHERE BattleID=? AND RobotID=?
+        '''.format(','.join([ '{0}=?'.format(col)
+                              for col,field in BattleRobot.resultFields ]))
+
+        records = self.conn.execute('''
+            SELECT BattleID, RobotID, Results
+            FROM BattleRobots
+            WHERE Results<>''
+        ''')
+        while True:
+            chunk = records.fetchmany(10000)
+            if not chunk:
+                break
+            rows = []
+            for record in chunk:
+                typed = BattleRobot.typedResults(json.loads(record['Results']))
+                rows.append([ typed[col] for col,field in BattleRobot.resultFields ] +
+                            [ record['BattleID'], record['RobotID'] ])
+            self.conn.executemany(update,rows)
+
+
+    def _addColumn( self, table, column ):
+        '''
+        ALTER TABLE <table> ADD COLUMN <column> (a definition), unless it's
+        already there.
+        '''
+        name = column.split()[0]
+        if name not in [ row['name'] for row in self.conn.execute(
+                'PRAGMA table_info({0})'.format(table)) ]:
+            self.conn.execute('ALTER TABLE {0} ADD COLUMN {1}'.format(table,column))
+
+
+    def schemaVersion( self ):
+        self.connect()
+        return self.conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+    def migrate( self ):
+        '''
+        Upgrade the database in place to the latest schema version.
+        '''
+        for version,descr,steps in self.__class__.migrations:
+            if version <= self.conn.execute('PRAGMA user_version').fetchone()[0]:
+                continue
+
+            # Take the write lock before checking again: another process
+            #   may have migrated the database in the meantime.
+            with self.transaction():
+                current = self.conn.execute('PRAGMA user_version').fetchone()[0]
+                if version <= current:
+                    continue
+                if self._debug:
+                    print('Migrating {0} to version {1}: {2}'.format(
+                        self.db_file,version,descr))
+                for step in steps:
+                    if callable(step):
+                        step(self)
+                    else:
+                        self.conn.execute(step)
+                self.conn.execute('PRAGMA user_version={0:d}'.format(version))
+
+
+    def _checkRobotNames( self ):
+        '''
+        Robots' names must be unique (for the Robots_Name index): fail, naming
+          them, if any aren't.  Which of a name's robots to keep (and what to
+          do with their battles) isn't for a migration to decide.
+        '''
+        duplicates = self.conn.execute('''
+            SELECT Name, GROUP_CONCAT(RobotID) AS RobotIDs
+            FROM Robots
+            GROUP BY Name
+            HAVING COUNT(*) > 1
+            ORDER BY Name
+        ''').fetchall()
+        if duplicates:
+            raise sqlite3.IntegrityError(
+                '{0}: robot names must be unique, remove the duplicates: {1}'.format(
+                    self.db_file,
+                    ', '.join( '{0} (RobotIDs {1})'.format(row['Name'],row['RobotIDs'])
+                               for row in duplicates )))
+
+
+    #
+    # Robots
+    #
+
+    def UpdateRobot( self, lastUpdated=None, name=None, id=None, obsolesce=True ):
+        '''
+        Create a robot (by <name>) or record that robot <id> was updated.
+
+        Updating a robot makes its finished battles against the previous
+        version obsolete (unless <obsolesce> is False); the number of them
+        is left in <self.lastObsoleted>.
+        '''
+        self.connect()
+        self.lastObsoleted = 0
+
+        if lastUpdated is None:
+            lastUpdated = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        elif lastUpdated.__class__ == datetime:
+            lastUpdated = lastUpdated.strftime('%Y-%m-%dT%H:%M:%S')
+
+        if id is None:
+            if name is None:
+                raise ValueError('UpdateRobot() cannot create new robot without a name')
+            with self.transaction():
+                # ensure that names are unique
+                error = None
+                try:
+                    orig = self.GetRobot(name=name)
+                    error = ValueError('UpdateRobot() cannot create new robot with duplicate name ({0}): {1}'.format(name,orig))
+                except:
+                    # good
+                    pass
+                else:
+                    # we couldn't throw this exception within the try clause
+                    raise error
+
+                # new robot
+                robotID = self.backend.insertRobot(name,lastUpdated)
+            return self.GetRobot(id=robotID)
+
+        else:
+            # updated robot
+            with self.transaction():
+                self.backend.updateRobot(id,lastUpdated)
+                if obsolesce:
+                    self.lastObsoleted = self.ObsolesceRobotBattles(id)
+            if id in self._robotsByID:
+                self._robotsByID[id].LastUpdated = lastUpdated
+            return self.GetRobot(id=id)
+
+
+    #
+    # The robots are kept in an identity map: every lookup of a given robot
+    #   returns the same BattleData.Robot, and GetRobot() only goes to the
+    #   database the first time. UpdateRobot() keeps the map current, and it
+    #   is dropped on a new connection and whenever the schema changes, the
+    #   database file is replaced, or another connection commits a change
+    #   (see SQLiteBackend.robotsVersion()). GetRobots() always re-reads (and
+    #   refreshes) every robot.
+    #
+
+    def flushRobots( self ):
+        '''
+        Forget every known robot.
+        '''
+        self._robotsByID = {}
+        self._robotsByName = {}
+        self._robotsValid = None
+
+
+    def _checkRobots( self ):
+        '''
+        Flush the known robots if the schema, the database file or its data
+        changed (see SQLiteBackend.robotsVersion()).
+        '''
+        valid = self.backend.robotsVersion()
+        if valid != self._robotsValid:
+            self.flushRobots()
+            self._robotsValid = valid
+
+
+    def _robot( self, record ):
+        '''
+        Return the one BattleData.Robot for the Robots <record>, adding it to
+        (or refreshing it in) the identity map.
+        '''
+        robot = self._robotsByID.get(record['RobotID'])
+        if robot is None:
+            robot = Robot(record,self)
+            self._robotsByID[robot.RobotID] = robot
+        else:
+            robot.Name = record['Name']
+            robot.LastUpdated = record['LastUpdated']
+        self._robotsByName[robot.Name] = robot
+        return robot
+
+
+    def GetRobots( self ):
+        self.connect()
+        self._checkRobots()
+        return [
+            self._robot(record)
+            for record in self.backend.robotRecords()
+            ]
+
+
+    def GetRobot( self, name=None, id=None ):
+        if name is None and id is None:
+            raise ValueError('GetRobot() called with neither name or id')
+
+        self.connect()
+        self._checkRobots()
+
+        if id is not None:
+            if id in self._robotsByID:
+                return self._robotsByID[id]
+            for record in self.backend.robotRecords(ids=[id]):
+                return self._robot(record)
+            raise KeyError("GetRobot() no robot with ID '{0}' found".format(id))
+        if name is not None:
+            if name in self._robotsByName:
+                return self._robotsByName[name]
+            for record in self.backend.robotRecords(name=name):
+                return self._robot(record)
+            raise KeyError("GetRobot() no robot with name '{0}' found".format(name))
+
+
+    #
+    # Leaderboard
+    #
+
+    leaderboardOrders = SQLiteBackend.leaderboardOrders
+
+    def GetLeaderboard( self, order='wins' ):
+        '''
+        Return a list of BattleData.LeaderboardEntry, one per robot with any
+          finished, non-obsolete battles, best first (see leaderboardOrders).
 
+        The Leaderboard table is kept up to date as battles finish or become
+          obsolete, so this doesn't depend on the number of battles.
+        '''
+        self.connect()
+        return [
+            LeaderboardEntry(record)
+            for record in self.backend.leaderboard(order)
+        ]
 
 
     #
-    # Robots
+    # Ratings
     #
 
-    def UpdateRobot( self, lastUpdated=None, name=None, id=None ):
-        self.connect()
+    def GetRatings( self, system, current=True ):
+        '''
+        Return a list of BattleData.RatingEntry from the rating <system>
+          (see Rating.py), best first.
 
-        if lastUpdated is None:
-            lastUpdated = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
-        elif lastUpdated.__class__ == datetime:
-            lastUpdated = lastUpdated.strftime('%Y-%m-%dT%H:%M:%S')
+        With <current>, only the robots' current versions; otherwise every
+          rated version.
+        '''
+        self.connect()
+        return [
+            RatingEntry(record)
+            for record in self.conn.execute('''
+               SELECT Ratings.*, Name
+               FROM Ratings
+                 INNER JOIN Robots
+                 ON Ratings.RobotID=Robots.RobotID
+               WHERE System=?
+                 {0}
+               ORDER BY Rating DESC, Name
+               ;
+            '''.format('AND Ratings.RobotUpdated=Robots.LastUpdated'
+                       if current else ''),[system])
+        ]
 
-        if id is None:
-            if name is None:
-                raise ValueError('UpdateRobot() cannot create new robot without a name')
-            # ensure that names are unique
-            error = None
-            try:
-                orig = self.GetRobot(name=name)
-                error = ValueError('UpdateRobot() cannot create new robot with duplicate name ({0}): {1}'.format(name,orig))
-            except:
-                # good
-                pass
-            else:
-                # we couldn't throw this exception within the try clause
-                raise error
+    def GetRating( self, robot, system, version=None ):
+        '''
+        Return <robot>'s BattleData.RatingEntry from <system> for its
+          <version> (a RobotUpdated; default: the current one).
+        '''
+        self.connect()
+        if robot.__class__ != Robot:
+            # assume <robot> is the ID
+            robot = self.GetRobot(id=robot)
+        if version is None:
+            version = robot.LastUpdated
 
-            # new robot
-            insert = self.conn.execute('''
-               INSERT INTO Robots
-               (Name,LastUpdated)
-               VALUES (?,?)
-            ''', [name,lastUpdated])
-            return self.GetRobot(id=insert.lastrowid)
+        for record in self.conn.execute('''
+           SELECT Ratings.*, Name
+           FROM Ratings
+             INNER JOIN Robots
+             ON Ratings.RobotID=Robots.RobotID
+           WHERE System=? AND Ratings.RobotID=? AND RobotUpdated=?
+           ;
+        ''',[system,robot.RobotID,version]):
+            return RatingEntry(record)
+        raise KeyError("GetRating() no {0} rating for '{1}' ({2})".format(
+            system,robot.Name,version))
 
-        else:
-            # updated robot
-            self.conn.execute('''
-               UPDATE Robots
-               SET LastUpdated=?
-               WHERE RobotID=?
-            ''', [lastUpdated,id])
-            return self.GetRobot(id=id)
+    #
+    # Recordings
+    #
 
+    def AddRecordings( self, recordings ):
+        '''
+        Index the stored recordings of battles: <recordings> is a sequence
+          of (BattleID, Hash, Size, Stored) (see RecordingStore.put()).  A
+          battle's earlier recording is replaced.
 
-    def GetRobots( self ):
+        Return the hashes that are no longer recorded for any battle (whose
+          files can go).
+        '''
         self.connect()
-        return [
-            Robot(record,self)
-            for record in self.conn.execute('SELECT * FROM Robots').fetchall()
-            ]
-            
+        recorded = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        replaced = set()
+        with self.transaction() as conn:
+            for battleID,digest,size,stored in recordings:
+                for record in conn.execute('''
+                    SELECT Hash FROM Recordings WHERE BattleID=? AND Hash<>?
+                ''',[battleID,digest]):
+                    replaced.add(record['Hash'])
+                conn.execute('''
+                    INSERT OR REPLACE INTO Recordings
+                    (BattleID,Hash,Size,Stored,Recorded,Matchup)
+                    VALUES (?,?,?,?,?,
+                       (SELECT group_concat(RobotID)
+                        FROM ( SELECT RobotID FROM BattleRobots
+                               WHERE BattleID=? ORDER BY RobotID )))
+                ''',[battleID,digest,size,stored,recorded,battleID])
+            return self._unrecorded(replaced)
+
+    def _unrecorded( self, hashes ):
+        '''
+        Those of <hashes> that no battle is recorded by.
+        '''
+        return [ digest for digest in sorted(hashes)
+                 if self.conn.execute('SELECT 1 FROM Recordings WHERE Hash=?',
+                                      [digest]).fetchone() is None ]
 
-    def GetRobot( self, name=None, id=None ):
-        if name is None and id is None:
-            raise ValueError('GetRobot() called with neither name or id')
+    def UnusedRecordings( self, hashes ):
+        '''
+        Return those of the recording <hashes> that no battle is recorded by
+          (whose files can go).
+        '''
+        self.connect()
+        return self._unrecorded(hashes)
 
+    def GetRecording( self, battle ):
+        '''
+        Return the BattleData.Recording of <battle> (or its ID).
+        '''
         self.connect()
+        if battle.__class__ == Battle:
+            battle = battle.BattleID
+        for record in self.conn.execute('''
+           SELECT * FROM Recordings WHERE BattleID=?
+        ''',[battle]):
+            return Recording(record)
+        raise KeyError("GetRecording() no recording of battle '{0}'".format(battle))
 
-        if id is not None:
+    def GetRecordings( self, robot=None ):
+        '''
+        Return a list of BattleData.Recording, newest first: every one, or
+          those of <robot>'s battles.
+        '''
+        self.connect()
+        if robot is None:
+            where,params = '',[]
+        else:
+            if robot.__class__ == Robot:
+                robot = robot.RobotID
+            where = '''WHERE BattleID IN (
+                          SELECT BattleID FROM BattleRobots WHERE RobotID=? )'''
+            params = [robot]
+        return [
+            Recording(record)
             for record in self.conn.execute('''
                SELECT *
-               FROM Robots
-               WHERE RobotID=?
+               FROM Recordings
+               {0}
+               ORDER BY BattleID DESC
                ;
-            ''',[id]):
-                return Robot(record,self)
-            raise KeyError("GetRobot() no robot with ID '{0}' found".format(id))
-        if name is not None:
+            '''.format(where),params)
+        ]
+
+    def ExpireRecordings( self, keep=None ):
+        '''
+        Drop the recordings of obsolete battles (and of archived ones, see
+          Archive()) and, with <keep>, all but the latest <keep> of each
+          matchup.
+
+        Return (the number of recordings dropped, the hashes that are no
+          longer recorded for any battle).
+        '''
+        self.connect()
+        with self.transaction() as conn:
+            conn.execute('''
+                CREATE TEMP TABLE IF NOT EXISTS Expiring (
+                   BattleID INTEGER PRIMARY KEY,
+                   Hash TEXT
+                )
+            ''')
+            conn.execute('DELETE FROM temp.Expiring')
+            conn.execute('''
+                INSERT INTO temp.Expiring (BattleID,Hash)
+                SELECT Recordings.BattleID, Hash
+                FROM Recordings
+                  LEFT JOIN Battles
+                  ON Recordings.BattleID=Battles.BattleID
+                WHERE Battles.BattleID IS NULL OR Battles.Obsolete=1
+            ''')
+            if keep is not None:
+                conn.execute('''
+                    INSERT OR IGNORE INTO temp.Expiring (BattleID,Hash)
+                    SELECT BattleID, Hash
+                    FROM ( SELECT Recordings.BattleID, Hash,
+                                  ROW_NUMBER() OVER (
+                                     PARTITION BY Matchup
+                                     ORDER BY Recordings.BattleID DESC ) AS Newer
+                           FROM Recordings
+                             INNER JOIN Battles
+                             ON Recordings.BattleID=Battles.BattleID
+                           WHERE Battles.Obsolete=0 )
+                    WHERE Newer > ?
+                ''',[keep])
+            dropped = conn.execute('''
+                DELETE FROM Recordings
+                WHERE BattleID IN ( SELECT BattleID FROM temp.Expiring )
+            ''').rowcount
+            hashes = { record['Hash'] for record in
+                       conn.execute('SELECT DISTINCT Hash FROM temp.Expiring') }
+            conn.execute('DROP TABLE temp.Expiring')
+            return dropped, self._unrecorded(hashes)
+
+    #
+    # Archive
+    #
+
+    def archiveFile( self ):
+        '''
+        The default archive database: <name>.archive<ext> next to this one.
+        '''
+        root,ext = os.path.splitext(self.db_file)
+        return '{0}.archive{1}'.format(root,ext)
+
+    def Archive( self, archiveFile=None, olderThan=None, batchSize=1000,
+                 vacuum=True ):
+        '''
+        Move the obsolete battles, and the finished ones that finished before
+          <olderThan> (if given), with their BattleRobots, into the archive
+          database <archiveFile> (see archiveFile()).  Returns the number of
+          battles moved.
+
+        The archive is a BattleDB database itself, so the history can be
+          queried by opening it as one.  Here, Rollups keeps each robot
+          version's totals over its archived battles, and Archives records
+          each run.
+
+        Archived battles that weren't obsolete leave the Leaderboard (which
+          covers the battles in this database), and are given to the
+          obsoletedHooks as they no longer count either.
+
+        Battles are moved <batchSize> at a time, each batch in its own
+          transaction.  Afterwards the freed pages are released with an
+          incremental VACUUM (<vacuum>); a database created before
+          auto_vacuum was turned on gets one full VACUUM first.
+        '''
+        if archiveFile is None:
+            archiveFile = self.archiveFile()
+        if isinstance(olderThan,datetime):
+            olderThan = olderThan.strftime('%Y-%m-%dT%H:%M:%S')
+
+        # Create (or migrate) the archive's schema.
+        self.requireSQL('Archiving')
+        archive = BattleDB(archiveFile,
+                           busyTimeout = self.backend.busyTimeout,
+                           journalMode = self.backend.journalMode)
+        archive.connect()
+        del(archive)
+
+        self.connect()
+        columns = {
+            table: ','.join( row['name'] for row in self.conn.execute(
+                'PRAGMA main.table_info({0})'.format(table)) )
+            for table in ('Robots','Battles','BattleRobots')
+        }
+        where = "State='finished' AND ( Obsolete=1 OR Finished < ? )"
+        params = [ olderThan if olderThan is not None else '' ]
+
+        self.conn.execute('ATTACH DATABASE ? AS archive',[archiveFile])
+        try:
+            self.conn.execute('''
+                CREATE TEMP TABLE IF NOT EXISTS Archiving (
+                   BattleID INTEGER PRIMARY KEY
+                )
+            ''')
+            moved = 0
+            last = 0
+            archiveID = None
+            while True:
+                with self.transaction() as conn:
+                    conn.execute('DELETE FROM temp.Archiving')
+                    count = conn.execute('''
+                        INSERT INTO temp.Archiving (BattleID)
+                        SELECT BattleID
+                        FROM main.Battles
+                        WHERE {0}
+                        ORDER BY BattleID
+                        LIMIT ?
+                    '''.format(where),params+[batchSize]).rowcount
+                    if count == 0:
+                        break
+                    self._archiveBatch(conn,columns)
+                    moved += count
+                    last = max(last,conn.execute(
+                        'SELECT MAX(BattleID) FROM temp.Archiving').fetchone()[0])
+                    # Recorded with each batch: if the run is interrupted,
+                    #   the moved battles' IDs still aren't reused (see
+                    #   ScheduleBattles()) and they aren't ingested again.
+                    if archiveID is None:
+                        archiveID = conn.execute('''
+                            INSERT INTO Archives (Archived,File,Battles,LastBattleID)
+                            VALUES (?,?,?,?)
+                        ''',[datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+                             archiveFile, moved, last]).lastrowid
+                    else:
+                        conn.execute('''
+                            UPDATE Archives SET Battles=?, LastBattleID=?
+                            WHERE ArchiveID=?
+                        ''',[moved, last, archiveID])
+                if count < batchSize:
+                    break
+        finally:
+            self.conn.execute('DROP TABLE IF EXISTS temp.Archiving')
+            self.conn.execute('DETACH DATABASE archive')
+
+        if vacuum:
+            if self.conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                # only possible by rebuilding the database, once
+                self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                self.conn.execute('VACUUM')
+            self.conn.execute('PRAGMA incremental_vacuum').fetchall()
+
+        return moved
+
+    def _archiveBatch( self, conn, columns ):
+        '''
+        Move the battles in temp.Archiving (within a transaction).
+        '''
+        battles = 'SELECT BattleID FROM temp.Archiving'
+
+        # Copy (replacing anything left by an interrupted run)
+        conn.execute('''
+            INSERT OR REPLACE INTO archive.Robots ({0})
+            SELECT {0}
+            FROM main.Robots
+            WHERE RobotID IN (
+               SELECT RobotID FROM main.BattleRobots WHERE BattleID IN ( {1} ) )
+        '''.format(columns['Robots'],battles))
+        for table in ('Battles','BattleRobots'):
+            conn.execute('''
+                INSERT OR REPLACE INTO archive.{0} ({1})
+                SELECT {1}
+                FROM main.{0}
+                WHERE BattleID IN ( {2} )
+            '''.format(table,columns[table],battles))
+
+        conn.execute('''
+            INSERT INTO main.Rollups
+            (RobotID,RobotUpdated,Battles,Obsolete,Wins,TotalScore,
+             FirstFinished,LastFinished)
+            SELECT BattleRobots.RobotID,
+                   BattleRobots.RobotUpdated,
+                   COUNT(*),
+                   TOTAL(Battles.Obsolete),
+                   TOTAL(BattleRobots.RobotID=Battles.Winner),
+                   TOTAL(BattleRobots.Score),
+                   MIN(Battles.Finished),
+                   MAX(Battles.Finished)
+            FROM main.BattleRobots
+              INNER JOIN main.Battles
+              ON BattleRobots.BattleID=Battles.BattleID
+            WHERE Battles.BattleID IN ( {0} )
+            GROUP BY BattleRobots.RobotID, BattleRobots.RobotUpdated
+            ON CONFLICT (RobotID,RobotUpdated) DO UPDATE
+            SET Battles = Battles + excluded.Battles,
+                Obsolete = Obsolete + excluded.Obsolete,
+                Wins = Wins + excluded.Wins,
+                TotalScore = TotalScore + excluded.TotalScore,
+                FirstFinished = MIN(FirstFinished,excluded.FirstFinished),
+                LastFinished = MAX(LastFinished,excluded.LastFinished)
+        '''.format(battles))
+
+        if self.obsoletedHooks:
+            counted = [ record['BattleID'] for record in conn.execute('''
+                SELECT BattleID
+                FROM main.Battles
+                WHERE BattleID IN ( {0} ) AND Obsolete=0
+            '''.format(battles)) ]
+            for hook in self.obsoletedHooks:
+                hook(self,counted)
+
+        # The battles first: the Leaderboard trigger reads their BattleRobots.
+        conn.execute('DELETE FROM main.Battles WHERE BattleID IN ( {0} )'.format(battles))
+        conn.execute('DELETE FROM main.BattleRobots WHERE BattleID IN ( {0} )'.format(battles))
+
+    def GetRollups( self, robot ):
+        '''
+        Return a list of BattleData.Rollup: <robot>'s totals over its
+          archived battles, one per version (RobotUpdated).
+        '''
+        self.connect()
+        if robot.__class__ == Robot:
+            robot = robot.RobotID
+        return [
+            Rollup(record)
             for record in self.conn.execute('''
                SELECT *
-               FROM Robots
-               WHERE Name=?
+               FROM Rollups
+               WHERE RobotID=?
+               ORDER BY RobotUpdated
                ;
-            ''',[name]):
-                return Robot(record,self)
-            raise KeyError("GetRobot() no robot with name '{0}' found".format(name))
+            ''',[robot])
+        ]
+
+
+    #
+    # Export
+    #
 
-    def dump( self, ofile=sys.stdout, otype='json' ):
+    # Exportable tables, in dependency order, and the column each one's
+    # time range (since/until) applies to.  BattleRobots rows go with their
+    # Battle, so they are selected by the battle's Finished time.
+    exportTables = [ 'Robots', 'Battles', 'BattleRobots' ]
+    exportTimes = {
+        'Robots'       : 'LastUpdated',
+        'Battles'      : 'Finished',
+        'BattleRobots' : None,
+    }
+    exportTypes = { 'ndjson':'ndjson', 'json':'ndjson', 'csv':'csv' }
+
+    def _exportQuery( self, table, columns=None, since=None, until=None ):
         '''
-        Dump the database contents.
+        Return (sql,params) selecting <table>'s rows (just <columns>, if
+          given) whose time is in [since,until).
         '''
+        if table not in self.exportTables:
+            raise KeyError('Unknown table: {0}'.format(table))
+
         self.connect()
+        known = [ row['name'] for row in
+                  self.execute('PRAGMA table_info({0})'.format(table)) ]
+        if columns:
+            unknown = [ col for col in columns if col not in known ]
+            if unknown:
+                raise KeyError('Unknown {0} column(s): {1}'.format(
+                    table,', '.join(unknown)))
+        else:
+            columns = known
+
+        conditions = []
+        params = []
+        timeCol = self.exportTimes[table]
+        for value,op in ((since,'>='),(until,'<')):
+            if value is None:
+                continue
+            if isinstance(value,datetime):
+                value = value.strftime('%Y-%m-%dT%H:%M:%S')
+            if timeCol is None:
+                conditions.append(
+                    'BattleID IN ( SELECT BattleID FROM Battles WHERE Finished {0} ? )'.format(op))
+            else:
+                conditions.append('{0} {1} ?'.format(timeCol,op))
+            params.append(value)
+
+        sql = 'SELECT {0} FROM {1} WHERE {2}'.format(
+            ','.join(columns), table, ' AND '.join(conditions) or '1')
+        return sql,params
 
-        o_csv = csv.writer(ofile)
+    def iterExport( self, table, columns=None, since=None, until=None,
+                    chunkSize=1000 ):
+        '''
+        Generate <table>'s column names, then its rows (as tuples), reading
+          <chunkSize> rows at a time so memory use doesn't grow with the
+          table.  It's a single query, so the rows come from one read
+          snapshot without holding the write lock.
+        '''
+        self.connect()
+        sql,params = self._exportQuery(table,columns,since,until)
+        cursor = self.conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(sql,params)
+        try:
+            yield [ d[0] for d in cursor.description ]
+            while True:
+                rows = cursor.fetchmany(chunkSize)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+
+    def _exportRows( self, ofile, otype, rows, indent=None ):
+        '''
+        Write the header, then <rows>, as <otype> to <ofile>.  Returns the
+          number of rows written.
+        '''
+        header = next(rows)
+        count = 0
+        if otype == 'csv':
+            o_csv = csv.writer(ofile)
+            o_csv.writerow(header)
+            for row in rows:
+                o_csv.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                print(json.dumps(dict(zip(header,row)),
+                                 sort_keys=True,
+                                 indent=indent),
+                      file=ofile)
+                count += 1
+        return count
+
+    def dump( self, ofile=sys.stdout, otype='json', tables=None,
+              chunkSize=1000 ):
+        '''
+        Dump the database contents (or just <tables>) to one stream.
 
-        for table in ['Robots','Battles','BattleRobots']:
+        'json' pretty-prints each row, 'ndjson' writes one row per line.
+        '''
+        for table in tables or self.exportTables:
             print('\n\nTABLE: {0}'.format(table),file=ofile)
-            emitHeader = True
-            for row in self.conn.execute('SELECT * FROM {0}'.format(table)):
-                if otype == 'csv':
-                    if emitHeader:
-                        o_csv.writerow(row.keys())
-                        emitHeader = False
-                    o_csv.writerow([row[k] for k in row.keys()])
-                elif otype == 'json':
-                    print(json.dumps({ k:row[k] for k in row.keys()},
-                                     sort_keys=True,
-                                     indent=4),
-                          file=ofile)
+            self._exportRows(
+                ofile,
+                'csv' if otype == 'csv' else 'json',
+                self.iterExport(table,chunkSize=chunkSize),
+                indent = 4 if otype == 'json' else None,
+            )
+
+    def exportTable( self, table, path, otype='ndjson', columns=None,
+                     since=None, until=None, compress=False, chunkSize=1000 ):
+        '''
+        Stream <table> into the file <path> (gzipped if <compress>).
+          Returns the number of rows written.
+        '''
+        otype = self.exportTypes[otype]
+        if compress:
+            ofile = gzip.open(path,'wt',encoding='utf-8',newline='')
+        else:
+            ofile = open(path,'w',encoding='utf-8',newline='')
+        with ofile:
+            return self._exportRows(
+                ofile, otype,
+                self.iterExport(table,columns,since,until,chunkSize))
+
+    def export( self, outdir, tables=None, columns=None, since=None,
+                until=None, otype='ndjson', compress=False, parallel=True,
+                chunkSize=1000 ):
+        '''
+        Export <tables> (default: all of them) into <outdir>, one file per
+          table: <table>.ndjson or <table>.csv, plus .gz if <compress>.
+
+        <columns> is { table: [columns] } for the tables that shouldn't be
+          exported in full.  <since>/<until> limit each table to a time range
+          (see exportTimes).
+
+        With <parallel>, each table is written by its own process (with its
+          own connection).  Each process holds one chunk of rows at a time.
 
+        Returns { table: (path,rows) }.
+        '''
+        tables = tables or self.exportTables
+        columns = columns or {}
+        otype = self.exportTypes[otype]
+        os.makedirs(outdir,exist_ok=True)
+
+        jobs = {}
+        for table in tables:
+            # check the table and columns before starting anything
+            self._exportQuery(table,columns.get(table))
+            path = os.path.join(outdir,'{0}.{1}{2}'.format(
+                table, otype, '.gz' if compress else ''))
+            jobs[table] = (path, otype, columns.get(table), since, until,
+                           compress, chunkSize)
+
+        if not parallel or len(jobs) < 2:
+            return { table: (job[0],self.exportTable(table,*job))
+                     for table,job in jobs.items() }
+
+        with concurrent.futures.ProcessPoolExecutor(len(jobs)) as pool:
+            futures = { table: pool.submit(self.exportTable,table,*job)
+                        for table,job in jobs.items() }
+            return { table: (jobs[table][0],future.result())
+                     for table,future in futures.items() }
 
 
     #
@@ -254,27 +2466,47 @@ class BattleDB:
     def ObsolesceBattles( self ):
         '''
         Check each of the finished battles to see if any of the competitors
-        has since been updated.
+        has since been updated, and return the number made obsolete.
+
+        UpdateRobot() and BattleCompleted() keep the battles current as they
+        go, so this full scan is only a consistency check: it should find
+        nothing to do.
+        '''
+
+        return self._obsolesce(None)
+
+
+    def ObsolesceRobotBattles( self, robot ):
+        '''
+        Make obsolete the finished battles that <robot> (a Robot or RobotID)
+        fought as an earlier version, and return the number of them.
+
+        This only touches that robot's battles.
         '''
+        if robot.__class__ == Robot:
+            robot = robot.RobotID
 
+        return self._obsolesce(robot)
+
+    def _obsolesce( self, robotID ):
+        '''
+        Make obsolete the finished battles with a competitor that has since
+        been updated (only <robotID>'s, if given), and return the number of
+        them.  The obsoletedHooks are given their BattleIDs.
+        '''
         self.connect()
 
-        self.conn.execute('''
-            UPDATE Battles
-            SET Obsolete=1
-            WHERE BattleID IN (
-                     SELECT BattleRobots.BattleID
-                     FROM BattleRobots
-                       INNER JOIN Robots
-                       ON BattleRobots.RobotID=Robots.RobotID
-                     WHERE Robots.LastUpdated > BattleRobots.RobotUpdated
-                       AND BattleRobots.RobotUpdated <> ''
-                  )
-              AND Obsolete=0
-              AND State='finished'
-        ''',[])
-
-        
+        with self.transaction():
+            if not self.obsoletedHooks:
+                return self.backend.obsolesce(robotID)
+
+            ids = self.backend.obsolesce(robotID,ids=True)
+            if ids:
+                for hook in self.obsoletedHooks:
+                    hook(self,ids)
+            return len(ids)
+
+
     def GetRobotFinishedBattles( self, robot, obsolete=False ):
         '''
         (set obsolete to None to prevent selection by Obsolete)
@@ -303,32 +2535,33 @@ class BattleDB:
         Return a list of BattleData.Battle objects for which <robot> is a
            competitor.
         '''
-        self.connect()
+        return self._robotQuery(robot,state,obsolete).all()
 
-        if state is None:
-            # don't select by state
-            state = []
+    def IterRobotBattles( self, robot,
+                          state=None, obsolete=None, batchSize=1000 ):
+        '''
+        Like GetRobotBattles(), but generate the battles, loading
+           <batchSize> at a time.
+        '''
+        return self._robotQuery(robot,state,obsolete).iter(batchSize)
+
+    def _robotQuery( self, robot, state, obsolete ):
+        '''
+        Return the BattleQuery selecting the battles of <robot> (in one of
+        the states <state>, if given).
+        '''
+        self.connect()
 
         if robot.__class__ != Robot:
             # assume <robot> is the ID
             robot = self.GetRobot(id=robot)
 
-        conditions = [ 'BattleID IN ( SELECT BattleID FROM BattleRobots WHERE RobotID=? )' ]
-        parameters = [ robot.RobotID ]
-        for s in state:
-            conditions.append('State=?')
-            parameters.append(s)
+        conditions = { 'robot': robot }
+        if state:
+            conditions['State'] = list(state)
         if obsolete is not None:
-            conditions.append('Obsolete={0}'.format( 1 if obsolete else 0 ))
-
-        return [
-            self.GetBattle(record['BattleID'])
-            for record in self.execute('''
-                SELECT BattleID
-                FROM Battles
-                WHERE {0}
-            '''.format(' AND '.join(conditions)),parameters)
-        ]
+            conditions['Obsolete'] = 1 if obsolete else 0
+        return self.QueryBattles(**conditions)
 
 
     # def GetBattleBetween( self, comps, obsolete=False ):
@@ -380,152 +2613,276 @@ class BattleDB:
     def GetObsoleteBattles(self):
         return self.GetBattles(Obsolete=1)
 
-    def GetBattles( self, *sql_conditions, **conditions ):
-        self.connect()
+    def IterScheduledBattles( self, batchSize=1000 ):
+        return self.IterBattles(State='scheduled',batchSize=batchSize)
+
+    def IterFinishedBattles( self, nonObsolete=True, batchSize=1000 ):
+        if nonObsolete:
+            return self.IterBattles(State='finished',Obsolete=0,
+                                    batchSize=batchSize)
+        else:
+            return self.IterBattles(State='finished',batchSize=batchSize)
 
-        # Construct the SQL query.
-        query = '''
-            SELECT BattleID
-            FROM Battles
+    def QueryBattles( self, **conditions ):
         '''
-        params = []
-        if len(sql_conditions) + len(conditions) > 0:
-            conds = list(sql_conditions) + \
-                    list(map(lambda f:'{0}=?'.format(f),conditions.keys()))
-            query += 'WHERE {0}'.format(
-                ' AND '.join(conds)
-            )
-            params = [ str(v) for v in conditions.values() ]
+        Return a BattleData.BattleQuery over all the battles (or those
+          matching <conditions>; see BattleQuery.filter()).
+        '''
+        return BattleQuery(self).filter(**conditions)
 
-        if self._debug:
-            print('Query: {0}\nParams: {1}'.format(query,params)) #DEBUG
+    def GetBattles( self, *sql_conditions, **conditions ):
+        return self._query(sql_conditions,conditions).all()
 
-        return [
-            self.GetBattle(record['BattleID'])
-            for record in self.conn.execute(query,params)
-        ]
+    def IterBattles( self, *sql_conditions, batchSize=1000, **conditions ):
+        '''
+        Like GetBattles(), but generate the battles instead of returning a
+          list: they're loaded (with their competitors) <batchSize> at a
+          time, so memory use doesn't grow with the number of battles.
+
+        Battles are paged by BattleID, each page read from its own snapshot.
+          A battle that changes between pages is seen at most once, and
+          only if it still matches when its page is read.
+        '''
+        return self._query(sql_conditions,conditions).iter(batchSize)
+
+    def _iterBattles( self, query, batchSize ):
+        # checked here, not in the generator, so the caller gets the error
+        if batchSize <= 0:
+            raise ValueError('batchSize must be positive: {0}'.format(batchSize))
+        return self._pageBattles(query,batchSize)
+
+    def _pageBattles( self, query, batchSize ):
+        page = query.limit(batchSize)
+        while True:
+            battles = page.all()
+            yield from battles
+            if len(battles) < batchSize:
+                return
+            page = query.filter(BattleID__gt=battles[-1].BattleID).limit(batchSize)
+
+    def _query( self, sql_conditions, conditions ):
+        '''
+        Return the BattleQuery for GetBattles()' arguments.
+        '''
+        query = self.QueryBattles(**conditions)
+        for condition in sql_conditions:
+            query = query.where(condition)
+        return query
 
 
     def GetBattle( self, id ):
         '''
         Query and return the battle matching the specified ID from the DB.
+        '''
+        if id.__class__ == Battle:
+            id = id.BattleID
 
-        This method is the only one that adds the battle's competitors.
-        Anything that returns a BattleData.Battle should use this.
+        # (the one filter, without QueryBattles() normalizing it)
+        for battle in BattleQuery(self,[ ('BattleID','eq',id) ]).all():
+            return battle
+        raise KeyError("GetBattle() no Battle with ID '{0}' found".format(id))
+
+
+    def GetBattleResults( self, battle ):
+        '''
+        Return a list of BattleData.BattleRobot (one per competitor) for the
+        battle (a BattleData.Battle or a BattleID).
+        '''
+        return self.GetResults([battle]).get(
+            battle.BattleID if battle.__class__ == Battle else battle, [])
+
+    def GetResults( self, battles, counted=False ):
+        '''
+        Return { BattleID: [ BattleData.BattleRobot, ... ] } for <battles>
+        (Battles or BattleIDs); with <counted>, only for those that are
+        finished and not obsolete.
         '''
         self.connect()
 
-        if id.__class__ == Battle:
-            id = id.BattleID
+        results = {}
+        for record in self.backend.battleResults(
+                [ battle.BattleID if battle.__class__ == Battle else battle
+                  for battle in battles ],
+                counted):
+            result = BattleRobot(record)
+            results.setdefault(result.BattleID,[]).append(result)
+        return results
 
-        battle = None
-        for record in self.conn.execute('''
-           SELECT *
-           FROM Battles
-           WHERE BattleID=?
-           ;
-        ''',[id]):
+
+    def _loadBattles( self, query ):
+        '''
+        Query and return the battles matching <query> (a BattleQuery), in
+        its order.
+
+        This method is the only one that adds the battles' competitors.
+        Anything that returns a BattleData.Battle should use this.
+
+        The backend fetches the Battles, BattleRobots, and Robots each with a
+        single set-based query (see SQLiteBackend.loadBattles()), so the
+        number of queries doesn't depend on the number of battles.
+        '''
+        self.connect()
+        self._checkRobots()
+
+        records,pairs,robots = self.backend.loadBattles(query,self._robotsByID)
+        # Only the robots that weren't known yet
+        for record in robots:
+            if record['RobotID'] not in self._robotsByID:
+                self._robot(record)
+
+        battles = {}
+        # Most battles share the same few States and Properties; keep
+        #   one copy of each rather than one per battle.
+        shared = {}
+        for record in records:
             battle = Battle(record,self)
-            break
-        else:
-            raise KeyError("GetBattle() no Battle with ID '{0}' found".format(id))
+            battle.State = shared.setdefault(battle.State,battle.State)
+            battle.Properties = shared.setdefault(battle.Properties,battle.Properties)
+            battles[battle.BattleID] = battle
 
-        for record in self.conn.execute('''
-           SELECT *
-           FROM BattleRobots
-           WHERE BattleID=?
-           ;
-        ''',[id]):
-            battle.addCompetitor(self.GetRobot(id=record['RobotID']))
+        robots = self._robotsByID
+        for battleID,robotID in pairs:
+            try:
+                robot = robots[robotID]
+            except KeyError:
+                raise KeyError("GetRobot() no robot with ID '{0}' found".format(robotID))
+            battles[battleID].addCompetitor(robot)
 
-        return battle
+        return list(battles.values())
 
 
     def ScheduleBattle( self, competitors, properties=None ):
+        return self.ScheduleBattles([competitors],[properties],hydrate=True)[0]
+
+
+    def ScheduleBattles( self, competitors, properties=None, hydrate=False ):
+        '''
+        Schedule many battles in a single transaction.
+
+        <competitors> is an iterable of competitor lists (Robots or RobotIDs).
+        <properties> is None (the default properties), a dict of properties
+           for every battle, or a sequence with one dict (or None) per battle.
+
+        Return a list of the new BattleIDs, or BattleData.Battle objects if
+           <hydrate> is set.
+        '''
+        # allow ID's or Robots
+        competitors = [
+            [ robot.RobotID if robot.__class__ == Robot else robot
+              for robot in comps ]
+            for comps in competitors
+        ]
+
+        default = json.dumps(self.__class__.defaultProperties)
         if properties is None:
-            properties = self.__class__.defaultProperties
+            properties = [ default ] * len(competitors)
+        elif isinstance(properties,dict):
+            properties = [ json.dumps(properties) ] * len(competitors)
+        else:
+            properties = [ default if p is None else json.dumps(p)
+                           for p in properties ]
+            if len(properties) != len(competitors):
+                raise ValueError('ScheduleBattles() needs one set of properties per battle ({0}!={1})'.format(
+                    len(properties),len(competitors)))
 
-        self.connect;
+        if not competitors:
+            return []
 
-        # Create the battle
-        insert = self.conn.execute('''
-           INSERT INTO Battles
-           (State,Priority,Started,Finished,Properties,Winner,Obsolete)
-           VALUES ('scheduled',-1,'','',?,-1,0)
-           ;
-        ''',[json.dumps(properties)])
-        battle_obj = self.GetBattle(insert.lastrowid)
-
-        for robot in competitors:
-            # allow ID's or Robots
-            if robot.__class__ != Robot:
-                robotID = robot
-                robot = self.GetRobot(id=robotID)
-            else:
-                robotID = robot.RobotID
+        self.connect()
+        ids = self.backend.scheduleBattles(competitors,properties)
+        if hydrate:
+            return self.QueryBattles(BattleID=ids).all()
+        return list(ids)
 
-            self.conn.execute('''
-                INSERT INTO BattleRobots
-                (BattleID,RobotID,RobotUpdated,Score,Results)
-                VALUES (?,?,'',-1,'')
-                ;
-            ''',[battle_obj.BattleID,robot.RobotID])
 
-        return self.GetBattle(battle_obj.BattleID)
+    def ScheduleRecording( self, battle, priority=0 ):
+        '''
+        Schedule a rerun of <battle> (or its ID) -- the same competitors and
+          properties -- to be recorded whatever the recording policy, ahead
+          of the battles scheduled normally (<priority>).  Return its
+          BattleID.
+        '''
+        self.connect()
+        with self.transaction():
+            battle = self.GetBattle(battle)
+            battleID, = self.ScheduleBattles([ battle.competitors() ],
+                                             [ battle.getProperties() ])
+            self.backend.updateBattle(battleID,Recording='rerun',Priority=priority)
+        return battleID
 
+    def GetNewVersionBattles( self, battles, firsts ):
+        '''
+        Return the set of those of <battles> (claimed Battles or BattleIDs)
+          that are among the first <firsts> battles of a competitor's
+          version.
+        '''
+        self.connect()
+        battles = [ battle.BattleID if battle.__class__ == Battle else battle
+                    for battle in battles ]
+        if not battles:
+            return set()
+        return self.backend.newVersionBattles(battles,firsts)
 
     class BattleAlreadyFinished(Exception):
         def __init__(self,battle):
             self.battle = battle
         def __str__(self):
-            return 'The battle is already finished: {0}'.format(battle)
+            return 'The battle is already finished: {0}'.format(self.battle)
     class BattleAlreadyStarted(Exception):
         def __init__(self,battle):
             self.battle = battle
         def __str__(self):
-            return 'The battle is already started: {0}'.format(battle)
+            return 'The battle is already started: {0}'.format(self.battle)
     class BattleNotStarted(Exception):
         def __init__(self,battle):
             self.battle = battle
         def __str__(self):
-            return 'The battle has not been started: {0}'.format(battle)
+            return 'The battle has not been started: {0}'.format(self.battle)
 
     def MarkBattleRunning( self, battle ):
+        '''
+        Mark a single scheduled battle as running.
+
+        The backend checks and updates it in one step, so only one caller
+        can ever start a given battle.
+        '''
         self.connect()
 
         # validate/normalize <battle>
         if battle.__class__ == Battle:
-            # replace it with current data
-            battle = self.GetBattle(battle.BattleID)
+            battleID = battle.BattleID
         else:
             # assume it's a BattleID
-            battle = self.GetBattle(battle)
+            battleID = battle
+
+        if self.backend.startBattle(battleID,self._now()):
+            return
 
-        # Verify that it isn't already running or finished
+        # Report why it couldn't be started.
+        battle = self.GetBattle(battleID)
         if battle.Finished:
             raise BattleDB.BattleAlreadyFinished(battle)
-        if battle.Started:
-            raise BattleDB.BattleAlreadyStarted(battle)
+        raise BattleDB.BattleAlreadyStarted(battle)
 
-        # Change the Battle.State
-        self.conn.execute('''
-            UPDATE Battles
-            SET State='running',
-                Started=?
-            WHERE BattleID=?
-        ''',[ datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
-              battle.BattleID ])
 
-        # Update the BattleRobot.RobotUpdated
-        self.conn.execute('''
-            UPDATE BattleRobots
-            SET RobotUpdated=(
-                SELECT LastUpdated
-                FROM Robots
-                WHERE RobotID=BattleRobots.RobotID
-            )
-            WHERE BattleID=?
-        ''',[battle.BattleID])
+    def ClaimBattles( self, count=1 ):
+        '''
+        Atomically mark (up to) <count> scheduled battles as running, highest
+        Priority first, and return them as BattleData.Battle objects.
+
+        Concurrent callers never receive the same battle.
+        '''
+        self.connect()
+
+        with self.transaction():
+            claimed = self.backend.claimBattles(count,self._now())
+            if not claimed:
+                return []
+            return self.QueryBattles(BattleID=claimed).all()
+
+    @staticmethod
+    def _now():
+        return datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
 
 
     def BattleCompleted( self, battle, battleData, resultData ):
@@ -535,53 +2892,63 @@ class BattleDB:
         '''
         self.connect()
 
-        # validate/normalize <battle>
-        if battle.__class__ == Battle:
-            # replace it with current data
-            battle = self.GetBattle(battle.BattleID)
-        else:
-            # assume it's a BattleID
-            battle = self.GetBattle(battle)
+        # Check and record the results in one transaction.
+        with self.transaction():
+            # validate/normalize <battle>
+            if battle.__class__ == Battle:
+                # replace it with current data
+                battle = self.GetBattle(battle.BattleID)
+            else:
+                # assume it's a BattleID
+                battle = self.GetBattle(battle)
+
+            # Verify that it isn't already running or finished
+            if battle.Finished:
+                raise BattleDB.BattleAlreadyFinished(battle)
+            if battle.State != 'running':
+                raise BattleDB.BattleNotStarted(battle)
+
+            winner = None
+            for robot in battle.competitors():
+                if robot.Name == battleData['Winner']:
+                    winner = robot.RobotID
+            if winner is None:
+                raise ValueError('No winner found ({0})'.format(battleData['Winner']))
+
+            results = {}
+            for robot in battle.competitors():
+                text = resultData[robot.Name]['Results']
+                results[robot.RobotID] = (
+                    BattleRobot.number(resultData[robot.Name]['Score']),
+                    text,
+                    json.loads(text) )
+            self.backend.completeBattle(battle.BattleID,battleData,winner,results)
+
+            for hook in self.completedHooks:
+                hook(self,battle.BattleID)
+
+
+    def BattlesCompleted( self, results ):
+        '''
+        Record many battles' results in a single transaction.
 
-        # Verify that it isn't already running or finished
-        if battle.Finished:
-            raise BattleDB.BattleAlreadyFinished(battle)
-        if battle.State != 'running':
-            raise BattleDB.BattleNotStarted(battle)
-
-        winner = None
-        for robot in battle.competitors():
-            if robot.Name == battleData['Winner']:
-                winner = robot.RobotID
-        if winner is None:
-            raise ValueError('No winner found ({0})'.format(battleData['Winner']))
-        
-        # Change the Battle.State
-        self.conn.execute('''
-            UPDATE Battles
-            SET State='finished',
-                Started=?,
-                Finished=?,
-                Winner=?,
-                Properties=?
-            WHERE BattleID=?
-        ''',[battleData['Started'],
-             battleData['Finished'],
-             winner,
-             battleData['Properties'], # these should be definitive
-
-             battle.BattleID])
-
-
-        # Update the BattleRobot.RobotUpdated
-        for robot in battle.competitors():
-            self.conn.execute('''
-                UPDATE BattleRobots
-                SET Score=?,
-                    Results=?
-                WHERE BattleID=? AND RobotID=?
-            ''',[ resultData[robot.Name]['Score'],
-                  resultData[robot.Name]['Results'],
-
-                  battle.BattleID,
-                  robot.RobotID ])
+        <results> is a sequence of (battle, battleData, resultData), as for
+           BattleCompleted().
+
+        A result that can't be recorded doesn't affect the others; return a
+           list of (battle, exception) for those.
+        '''
+        self.connect()
+
+        failed = []
+        with self.transaction():
+            for battle,battleData,resultData in results:
+                try:
+                    with self.backend.savepoint():
+                        self.BattleCompleted(battle,battleData,resultData)
+                except (BattleDB.BattleAlreadyFinished,
+                        BattleDB.BattleNotStarted,
+                        KeyError, ValueError) as e:
+                    failed.append((battle,e))
+
+        return failed
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
 import multiprocessing
+import threading
+import queue
 from queue import Empty
+import copy
 import subprocess
 import Robocode
 import os, os.path
@@ -20,7 +23,91 @@ def recommendedWorkers():
     else:
         return cpus
 
-def BattleWorker( robocode, battledb, job_q, result_q ):
+def runBattle( battle, battledb, groupCommit=False, result_q=None,
+               recordings=None ):
+    '''
+    Run a Robocode.Battle that has already been marked as running, and
+    record its results.
+
+    With <groupCommit>, the results are sent over <result_q> for the parent
+    to record instead (None for a failed battle).
+
+    With <recordings> (a RecordingStore), the battle's recording is moved
+    into it, and indexed along with the results.
+    '''
+    try:
+        print('[{who}] Running battle {id} between: {comps}'.format(
+            who = multiprocessing.current_process().name,
+            id = battle.id,
+            comps = ' '.join(battle.competitors),
+        ), file=sys.stderr)
+        battle.run()
+        print('[{who}] Finished: {id}'.format(
+            who = multiprocessing.current_process().name,
+            id = battle.id,
+        ), file=sys.stderr)
+    except subprocess.CalledProcessError as e:
+        print('[{who}] Battle invocation fails: {exc}\n{output}'.format(
+            who = multiprocessing.current_process().name,
+            exc = e.cmd,
+            output = e.output,
+        ), file=sys.stderr)
+
+    recording = None
+    if ( recordings is not None and not battle.error and
+         battle.recordFile and os.path.isfile(battle.recordFile) ):
+        # (Hash, Size, Stored)
+        recording = recordings.put(battle.recordFile)
+
+    if groupCommit:
+        if battle.error:
+            result_q.put((battle.id,None,None,None))
+        else:
+            result_q.put((battle.id,battle.dbData(),battle.result.dbData(),
+                          recording))
+        return
+
+    if not battle.error:
+        # Only record the data if the battle succeeded.
+        battledb.BattleCompleted(battle.id,
+                                 battle.dbData(),
+                                 battle.result.dbData())
+        if recording is not None:
+            recordings.remove(battledb.AddRecordings([ (battle.id,)+recording ]))
+    result_q.put(battle.id)
+
+
+def setRecording( robocode, battledb, battles ):
+    '''
+    Let <robocode>'s recording policy decide whether to record each of
+    <battles>, (Robocode.Battle, BattleData.Battle) pairs of battles that
+    have been marked as running, unless it's already decided.
+    '''
+    battles = [ (battle,b) for battle,b in battles if battle.record is None ]
+    if not battles:
+        return
+    policy = robocode.recording
+    newVersion = set()
+    if policy.mode == 'new-version':
+        newVersion = battledb.GetNewVersionBattles([ b for battle,b in battles ],
+                                                   policy.firsts)
+    for battle,b in battles:
+        battle.setRecording(b.Recording == 'rerun',b.BattleID in newVersion)
+
+
+def printQueryStats( battledb, top=3 ):
+    '''
+    Print the statements this process spent the most database time on.
+    '''
+    for stat in battledb.stats()[:top]:
+        print('[{who}]   {seconds:.2f}s in {calls} calls, {rows} rows: {template:.100}'.format(
+            who = multiprocessing.current_process().name,
+            **stat
+        ), file=sys.stderr)
+
+
+def BattleWorker( robocode, battledb, job_q, result_q, groupCommit=False,
+                  recordings=None ):
     print('[{who}] Started:\n  {db}\n  {robo}'.format(
         who = multiprocessing.current_process().name,
         db = battledb,
@@ -39,84 +126,269 @@ def BattleWorker( robocode, battledb, job_q, result_q ):
                 break
 
             start_time = datetime.now()
-            try:
-                battledb.MarkBattleRunning(battle.id)
+            battledb.MarkBattleRunning(battle.id)
+            if battle.record is None:
+                setRecording(robocode,battledb,
+                             [ (battle,battledb.GetBattle(battle.id)) ])
+            runBattle(battle,battledb,groupCommit,result_q,recordings)
+            elapsed = datetime.now() - start_time
+    except Exception as e:
+        print('[{who}] Exception: {exc}'.format(
+            who = multiprocessing.current_process().name,
+            exc = e,
+        ), file=sys.stderr)
+        raise e
+    finally:
+        robocode.close()
 
-                print('[{who}] Running battle {id} between: {comps}'.format(
-                    who = multiprocessing.current_process().name,
-                    id = battle.id,
-                    comps = ' '.join(battle.competitors),
-                ), file=sys.stderr)
-                battle.run()
-                print('[{who}] Finished: {id}'.format(
-                    who = multiprocessing.current_process().name,
-                    id = battle.id,
-                ), file=sys.stderr)
-            except subprocess.CalledProcessError as e:
-                print('[{who}] Battle invocation fails: {exc}\n{output}'.format(
-                    who = multiprocessing.current_process().name,
-                    exc = e.cmd,
-                    output = e.output,
-                ), file=sys.stderr)
+    lock = battledb.lockStats()
+    print('[{who}] Finished! Waited {waited:.2f}s (max {max:.2f}s) for the database over {count} transactions ({retries} retries)'.format(
+        who = multiprocessing.current_process().name,
+        waited = lock['waited'],
+        max = lock['maxWait'],
+        count = lock['transactions'],
+        retries = lock['retries'],
+    ), file=sys.stderr)
+    printQueryStats(battledb)
 
-            if not battle.error:
-                # Only record the data if the battle succeeded.
-                battledb.BattleCompleted(battle.id,
-                                         battle.dbData(),
-                                         battle.result.dbData())
 
-            elapsed = datetime.now() - start_time
+def ClaimWorker( robocode, battledb, claim, result_q, groupCommit=False,
+                 recordings=None ):
+    '''
+    Rather than waiting for jobs, claim up to <claim> scheduled battles at a
+    time straight from the database, until there are none left.
+    '''
+    print('[{who}] Started (claiming {claim}):\n  {db}\n  {robo}'.format(
+        who = multiprocessing.current_process().name,
+        claim = claim,
+        db = battledb,
+        robo = robocode
+        ), file=sys.stderr)
+
+    try:
+        while True:
+            claimed = battledb.ClaimBattles(claim)
+            if not claimed:
+                print('[{0}] Nothing left to claim!'.format(
+                    multiprocessing.current_process().name,
+                ), file=sys.stderr)
+                break
 
-            result_q.put(battle.id)
+            battles = [ (robocode.battle(b.BattleID,
+                                         [c.Name for c in b.competitors()],
+                                         b.getProperties()), b)
+                        for b in claimed ]
+            setRecording(robocode,battledb,battles)
+            for battle,b in battles:
+                runBattle(battle,battledb,groupCommit,result_q,recordings)
     except Exception as e:
         print('[{who}] Exception: {exc}'.format(
             who = multiprocessing.current_process().name,
             exc = e,
         ), file=sys.stderr)
         raise e
+    finally:
+        robocode.close()
 
-    print('[{0}] Finished!'.format(
-        multiprocessing.current_process().name,
+    lock = battledb.lockStats()
+    print('[{who}] Finished! Waited {waited:.2f}s (max {max:.2f}s) for the database over {count} transactions ({retries} retries)'.format(
+        who = multiprocessing.current_process().name,
+        waited = lock['waited'],
+        max = lock['maxWait'],
+        count = lock['transactions'],
+        retries = lock['retries'],
     ), file=sys.stderr)
+    printQueryStats(battledb)
+
+
+def ResultWriter( battledb, result_q, done_q, groupCommit, commitInterval,
+                  recordings=None ):
+    '''
+    The single writer for group commits: record the results sent by the
+    workers, <groupCommit> at a time or every <commitInterval> milliseconds
+    (whichever comes first), each batch in one transaction (along with
+    their recordings, stored in <recordings>). The BattleID of every
+    handled result is then put on <done_q>, even if its batch couldn't be
+    recorded.
+
+    A None on <result_q> stops it.
+    '''
+    try:
+        pending = []
+        deadline = None
+        stopping = False
+        commits = 0
+        committed = 0
+        while not stopping:
+            try:
+                if pending:
+                    item = result_q.get(timeout=max(0,deadline-time.monotonic()))
+                else:
+                    item = result_q.get()
+                if item is None:
+                    stopping = True
+                else:
+                    if not pending:
+                        deadline = time.monotonic() + commitInterval/1000
+                    pending.append(item)
+            except Empty:
+                pass
+
+            if not pending:
+                continue
+            if ( not stopping and len(pending) < groupCommit and
+                 time.monotonic() < deadline ):
+                continue
+
+            try:
+                if recordings is None:
+                    failed = battledb.BattlesCompleted(
+                        [ item[:3] for item in pending if item[1] is not None ])
+                else:
+                    with battledb.transaction():
+                        failed = battledb.BattlesCompleted(
+                            [ item[:3] for item in pending if item[1] is not None ])
+                        unrecorded = battledb.AddRecordings(
+                            [ (item[0],)+item[3] for item in pending
+                              if item[3] is not None and
+                                 item[0] not in { battle for battle,e in failed } ])
+                    recordings.remove(unrecorded)
+            except Exception as e:
+                # Lose the batch, not the writer: finish() is waiting for
+                #   every BattleID.
+                failed = [ (item[0],e) for item in pending ]
+            if recordings is not None and failed:
+                # (unless another battle is recorded by the same file)
+                stored = { item[0]: item[3][0] for item in pending
+                           if item[3] is not None }
+                try:
+                    recordings.remove([ stored[battle] for battle,e in failed
+                                        if battle in stored ],battledb)
+                except Exception as e:
+                    print('[{who}] Cannot remove recordings: {exc}'.format(
+                        who = multiprocessing.current_process().name,
+                        exc = e,
+                    ), file=sys.stderr)
+            for battle,e in failed:
+                print('[{who}] Cannot record battle {id}: {exc}'.format(
+                    who = multiprocessing.current_process().name,
+                    id = battle,
+                    exc = e,
+                ), file=sys.stderr)
+            commits += 1
+            committed += len(pending)
+
+            for item in pending:
+                done_q.put(item[0])
+            pending = []
+
+        lock = battledb.lockStats()
+        print('[{who}] Results writer finished: {count} results in {commits} commits, waited {waited:.2f}s for the database'.format(
+            who = multiprocessing.current_process().name,
+            count = committed,
+            commits = commits,
+            waited = lock['waited'],
+        ), file=sys.stderr)
+        printQueryStats(battledb)
+    finally:
+        # the connection was opened on this thread: close it here
+        battledb.close()
 
 
 
 class BattleRunner:
-    def __init__( self, battledb, robocode, maxWorkers=None ):
+    def __init__( self, battledb, robocode, maxWorkers=None, claim=None,
+                  groupCommit=None, commitInterval=1000, recordings=None ):
+        '''
+        If <claim> is set, the workers don't take submitted battles; each one
+        claims <claim> scheduled battles at a time from <battledb>.
+
+        If <groupCommit> is set, the workers don't record their results;
+        they send them to a single writer (a thread in this process) that
+        records up to <groupCommit> results at a time, or whatever it has
+        every <commitInterval> milliseconds, in one transaction.
+
+        With <recordings> (a RecordingStore), each battle's recording is
+        moved into the store and indexed in <battledb>.
+        '''
         self.battledb = battledb
         self.robocode = robocode
         self.job_q = multiprocessing.JoinableQueue()
         self.result_q = multiprocessing.JoinableQueue()
         self.workers = maxWorkers if maxWorkers is not None else recommendedWorkers()
         self.job_count = 0
+        self.claim = claim
+        self.groupCommit = groupCommit
+        self.commitInterval = commitInterval
+        self.recordings = recordings
+        self.writer = None
+        # Where the finished BattleIDs show up
+        if self.groupCommit:
+            self.done_q = queue.Queue()
+        else:
+            self.done_q = self.result_q
 
 
     def start( self ):
+        if self.groupCommit:
+            # copy: the writer thread needs its own connection
+            self.writer = threading.Thread(
+                target = ResultWriter,
+                name = 'ResultWriter',
+                args = (copy.copy(self.battledb), self.result_q, self.done_q,
+                        self.groupCommit, self.commitInterval, self.recordings))
+            self.writer.start()
+
         # Start the workers.
-        self.pool = [ multiprocessing.Process( target = BattleWorker,
-                                               args=(self.robocode, self.battledb, 
-                                                     self.job_q, self.result_q) )
+        groupCommit = bool(self.groupCommit)
+        if self.claim is None:
+            target = BattleWorker
+            args = (self.robocode, self.battledb, self.job_q, self.result_q,
+                    groupCommit, self.recordings)
+        else:
+            target = ClaimWorker
+            args = (self.robocode, self.battledb, self.claim, self.result_q,
+                    groupCommit, self.recordings)
+        self.pool = [ multiprocessing.Process( target = target, args = args )
                       for i in range(self.workers) ]
         for p in self.pool:
             p.start()
 
 
     def finish( self ):
-        print('[{0}] Sending EndOfWork signals'.format(
-            multiprocessing.current_process().name,
-        ), file=sys.stderr)
+        if self.claim is not None:
+            # The workers stop by themselves once nothing is left to claim.
+            while self.running():
+                try:
+                    self.done_q.get(timeout=1)
+                except Empty:
+                    pass
+        else:
+            print('[{0}] Sending EndOfWork signals'.format(
+                multiprocessing.current_process().name,
+            ), file=sys.stderr)
 
-        for p in self.pool:
-            self.job_q.put(0)
+            for p in self.pool:
+                self.job_q.put(0)
 
-        # Consume everything in the result_q
-        while self.job_count > 0:
-            battleid = self.result_q.get()
-            self.job_count -= 1
+            # Consume everything in the result_q
+            while self.job_count > 0:
+                battleid = self.done_q.get()
+                self.job_count -= 1
 
         for p in self.pool:
             p.join()
 
+        if self.writer is not None:
+            # Everything the workers sent is ahead of this.
+            self.result_q.put(None)
+            self.writer.join()
+            self.writer = None
+
+        # Whatever is left over
+        while self.getResults():
+            pass
+
 
     def submit( self, battle ):
         print('[{0}] Submitting battle #{1} '.format(
@@ -142,7 +414,7 @@ class BattleRunner:
 
         results = []
         try:
-            results.append(self.result_q.get_nowait())
+            results.append(self.done_q.get_nowait())
         except Empty:
             pass
 
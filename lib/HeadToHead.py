@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+'''
+Robot-vs-robot outcomes, as a memory-mapped NumPy array.
+
+The array (<db_file>.h2h.npy, next to the database) is 3 x N x N int64,
+  indexed by RobotID:
+
+   [WINS,a,b]     battles in which a placed ahead of b
+   [BATTLES,a,b]  battles between a and b
+   [SCORE,a,b]    a's total score in those battles
+
+  over the finished, non-obsolete battles.  Any number of processes can
+  map it; reading a pair (or a whole row) touches no database.
+
+Once install()ed on a BattleDB it is updated as battles are recorded or
+  made obsolete: the changes are read (through BattleDB's API, so on any
+  backend) inside the database's write transaction and applied once it
+  commits (see BattleDB.afterCommit()), still holding the database lock,
+  so updates are serialized and a rolled back transaction leaves the
+  array alone.  rebuild() recomputes it from the database, e.g. after a
+  crash; install() does so itself when there is no array yet.
+'''
+
+from BattleData import BattleDB, Robot
+import numpy
+import numpy.lib.format
+import argparse
+import os
+import os.path
+
+class HeadToHead:
+    WINS, BATTLES, SCORE = range(3)
+
+    def __init__( self, db_file, size=64 ):
+        '''
+        <size> is the initial number of RobotIDs; the array grows as needed.
+        '''
+        self.path = db_file + '.h2h.npy'
+        self.initialSize = size
+        self._matrix = None
+        self._inode = None
+
+    def __getstate__( self ):
+        # Each process maps the file itself.
+        state = self.__dict__.copy()
+        state['_matrix'] = None
+        state['_inode'] = None
+        return state
+
+    def __str__( self ):
+        return '[HeadToHead file({0})]'.format(self.path)
+
+    @property
+    def matrix( self ):
+        '''
+        The 3 x N x N array (remapped if the file has been replaced).
+        '''
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            self._create(self.initialSize)
+            inode = os.stat(self.path).st_ino
+        if self._matrix is None or inode != self._inode:
+            self._matrix = numpy.lib.format.open_memmap(self.path,mode='r+')
+            self._inode = inode
+        return self._matrix
+
+    @property
+    def wins( self ):
+        return self.matrix[HeadToHead.WINS]
+
+    @property
+    def battles( self ):
+        return self.matrix[HeadToHead.BATTLES]
+
+    @property
+    def scores( self ):
+        return self.matrix[HeadToHead.SCORE]
+
+    def pair( self, a, b ):
+        '''
+        Return how robot <a> did against robot <b> (Robots or RobotIDs).
+        '''
+        a,b = [ r.RobotID if r.__class__ == Robot else r for r in (a,b) ]
+        m = self.matrix
+        if max(a,b) >= m.shape[1]:
+            return { 'Battles':0, 'Wins':0, 'Losses':0, 'Score':0 }
+        return {
+            'Battles' : int(m[HeadToHead.BATTLES,a,b]),
+            'Wins'    : int(m[HeadToHead.WINS,a,b]),
+            'Losses'  : int(m[HeadToHead.WINS,b,a]),
+            'Score'   : int(m[HeadToHead.SCORE,a,b]),
+        }
+
+    def _create( self, size, copy=None ):
+        '''
+        Write a new (zeroed) array of <size> RobotIDs, with <copy>'s
+          contents, and put it in place.
+        '''
+        tmp = self.path + '.tmp'
+        m = numpy.lib.format.open_memmap(tmp,mode='w+',dtype=numpy.int64,
+                                         shape=(3,size,size))
+        if copy is not None:
+            n = min(size,copy.shape[1])
+            m[:,:n,:n] = copy[:,:n,:n]
+        m.flush()
+        del(m)
+        os.replace(tmp,self.path)
+
+    def _fit( self, robotID ):
+        '''
+        Return the array, grown (at least doubled) to hold <robotID>.
+        '''
+        m = self.matrix
+        if robotID >= m.shape[1]:
+            self._create(max(robotID+1,2*m.shape[1]),m)
+            m = self.matrix
+        return m
+
+    @staticmethod
+    def _pairs( results ):
+        '''
+        Each competitor paired with each of its opponents, in the battles'
+          <results> (see BattleDB.GetResults()):
+          (RobotID, opponent's RobotID, placed ahead?, score)
+        '''
+        return [ ( a.RobotID, b.RobotID,
+                   int(a.Place is not None and b.Place is not None and a.Place < b.Place),
+                   a.Score or 0 )
+                 for competitors in results.values()
+                 for a in competitors
+                 for b in competitors
+                 if a.RobotID != b.RobotID ]
+
+    def _defer( self, battledb, rows, sign ):
+        '''
+        _apply() <rows> once <battledb>'s transaction has committed.
+        '''
+        if rows:
+            battledb.afterCommit(lambda: self._apply(rows,sign))
+
+    def _apply( self, rows, sign ):
+        pairs = numpy.array(rows,dtype=numpy.int64).reshape(-1,4)
+        if not len(pairs):
+            return
+        m = self._fit(int(pairs[:,:2].max()))
+        index = (pairs[:,0],pairs[:,1])
+        numpy.add.at(m[HeadToHead.WINS],index,sign*pairs[:,2])
+        numpy.add.at(m[HeadToHead.BATTLES],index,sign)
+        numpy.add.at(m[HeadToHead.SCORE],index,sign*pairs[:,3])
+
+    def install( self, battledb ):
+        '''
+        Keep the array up to date with <battledb>'s results.  If there is no
+          array yet, or it is too small for <battledb>'s robots (it isn't
+          this database's), it is rebuild() first.
+        '''
+        size = max([ robot.RobotID for robot in battledb.GetRobots() ],default=0)+1
+        if not os.path.isfile(self.path) or self.matrix.shape[1] < size:
+            self.rebuild(battledb)
+        battledb.completedHooks.append(self.completed)
+        battledb.obsoletedHooks.append(self.obsoleted)
+        return self
+
+    def completed( self, battledb, battleID ):
+        '''
+        Add a battle that has just been recorded (unless it's obsolete).
+        '''
+        self._defer(battledb,self._pairs(battledb.GetResults([battleID],counted=True)),1)
+
+    def obsoleted( self, battledb, battleIDs ):
+        '''
+        Remove battles that have just been made obsolete.
+        '''
+        self._defer(battledb,self._pairs(battledb.GetResults(battleIDs)),-1)
+
+    def rebuild( self, battledb ):
+        '''
+        Recompute the whole array from <battledb>.
+        '''
+        with battledb.transaction():
+            size = max([ robot.RobotID for robot in battledb.GetRobots() ],default=0)+1
+            self._create(max(size,self.initialSize))
+            battleIDs = battledb.QueryBattles(State='finished',Obsolete=0).ids()
+            for i in range(0,len(battleIDs),10000):
+                self._apply(self._pairs(battledb.GetResults(battleIDs[i:i+10000])),1)
+            self.matrix.flush()
+
+
+def build_cmdline():
+    parser = argparse.ArgumentParser('robot-vs-robot outcomes')
+
+    parser.add_argument(
+        'db',
+        type=str,
+        help='the battle database',
+    )
+    parser.add_argument(
+        '--rebuild',
+        action='store_true',
+        help='recompute the array from the database',
+    )
+
+    return parser
+
+
+if __name__ == '__main__':
+    cmdline = build_cmdline().parse_args()
+    bdata = BattleDB(cmdline.db)
+    h2h = HeadToHead(cmdline.db)
+
+    if cmdline.rebuild:
+        h2h.rebuild(bdata)
+
+    robots = sorted(bdata.GetRobots(),key=lambda r: r.Name)
+    for a in robots:
+        for b in robots:
+            pair = h2h.pair(a,b)
+            if pair['Battles']:
+                print('{0:<40} {1:<40} {2:>6} {3:>6} {4:>6}'.format(
+                    a.Name,b.Name,pair['Battles'],pair['Wins'],pair['Losses']))
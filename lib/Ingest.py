@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+'''
+Rebuild battle results from the results directory (e.g. after the
+database was lost, or restored from an old backup).
+
+Every <BattleID>.result file is parsed (in a process pool, with a parser
+  that produces exactly what Robocode.Result does, several times faster)
+  and recorded as that battle's results:
+
+ * a battle that is in the database but not finished has its results
+   recorded, as BattleDB.BattleCompleted() would;
+ * a battle that isn't in the database is recreated, with its properties
+   from <BattleID>.battle in the battles directory (if it's there), and
+   any missing robots are added;
+ * finished battles, and archived ones (those not in the database, up to
+   the last BattleID archived), are left alone.
+
+Results are recorded <batchSize> battles per transaction, and the finished
+  battles are skipped before anything is parsed, so an interrupted run can
+  simply be run again.
+
+The result files don't say when a battle started, or which version of
+  each robot fought: the file's modification time is used for both
+  Started and Finished, and a recreated battle is taken to be between the
+  robots' current versions.
+'''
+
+from BattleData import BattleDB, BattleRobot
+import Robocode
+import argparse
+import concurrent.futures
+import json
+import os
+import os.path
+import re
+import sys
+import time
+from datetime import datetime
+
+_resultFile = re.compile(r'^(\d+)\.result$')
+
+def parseResult( path ):
+    '''
+    Return (rounds, robots, winner) from the results file <path>, as
+      Robocode.Result reads them: robots is a list of dicts of the
+      columns (plus _Score, _Place and _Name), best first.
+
+    Raise ValueError if the file can't be parsed.
+    '''
+    with open(path,'rt') as in_file:
+        lines = in_file.read().split('\n')
+    if len(lines) < 3:
+        raise ValueError('Not a results file: {0}'.format(path))
+
+    # 'Results for 10 rounds'
+    rounds = int(lines[0].split()[2])
+    header = [ column.strip() for column in lines[1].split('\t') ]
+
+    robots = []
+    winner = ''
+    for line in lines[2:]:
+        if not line:
+            continue
+        data = dict(zip(header,line.split('\t')))
+        data.pop('',None) # the empty column
+        score = data['Total Score']
+        # '1234 (56%)'
+        value,_,percent = score.partition('(')
+        data['_Score'] = value.strip() \
+                         if value.strip().isdigit() and percent.rstrip().endswith('%)') \
+                            and percent.rstrip()[:-2].isdigit() \
+                         else score
+        # '1st: sample.Fire*'
+        place,_,name = data['Robot Name'].partition(': ')
+        data['_Place'] = int(place[:-2])
+        data['_Name'] = name.rstrip('*')
+        if data['_Place'] == 1:
+            winner = data['_Name']
+        robots.append(data)
+
+    if not robots:
+        raise ValueError('No results: {0}'.format(path))
+    return rounds, robots, winner
+
+
+def parseBattle( path ):
+    '''
+    Return the properties from a .battle file (without the competitors),
+      typed like the default properties, or None if there's no such file.
+    '''
+    if not os.path.isfile(path):
+        return None
+    properties = {}
+    with open(path,'rt') as battle:
+        for line in battle:
+            prop,sep,value = line.rstrip('\n').partition('=')
+            if not sep or prop == Robocode.Battle.robotProp:
+                continue
+            default = BattleDB.defaultProperties.get(prop)
+            if isinstance(default,bool):
+                value = value.lower() == 'true'
+            elif isinstance(default,(int,float)):
+                try:
+                    value = type(default)(value)
+                except ValueError:
+                    pass
+            properties[prop] = value
+    return properties
+
+
+def _parseFiles( files ):
+    '''
+    Parse the (battleID, result file, battle file) <files>; return a list of
+      (battleID, finished, parsed or None, properties, error or None).
+    '''
+    parsed = []
+    for battleID,resultFile,battleFile in files:
+        try:
+            finished = datetime.fromtimestamp(os.stat(resultFile).st_mtime)
+            parsed.append((battleID,
+                           finished.strftime('%Y-%m-%dT%H:%M:%S'),
+                           parseResult(resultFile),
+                           parseBattle(battleFile) if battleFile else None,
+                           None))
+        except (OSError,ValueError,KeyError,IndexError) as e:
+            parsed.append((battleID,None,None,None,
+                           '{0}: {1}'.format(resultFile,e)))
+    return parsed
+
+
+class Ingester:
+    def __init__( self, battledb, results, battles=None, workers=None,
+                  batchSize=5000, chunkSize=200, progress=sys.stderr ):
+        '''
+        Ingest the result files in the directory <results> (and the
+        battle files in <battles>) into <battledb>, with <workers>
+        processes (default: one per CPU; 0 parses in this process).
+        Progress (files per second) is reported to <progress>.
+        '''
+        self.battledb = battledb
+        self.results = results
+        self.battles = battles
+        self.workers = workers
+        self.batchSize = batchSize
+        self.chunkSize = chunkSize
+        self.progress = progress
+        self.failed = []
+        self.stats = {
+            'files'    : 0,
+            'skipped'  : 0,
+            'recorded' : 0,
+            'created'  : 0,
+            'failed'   : 0,
+            'seconds'  : 0.0,
+        }
+
+    def scan( self ):
+        '''
+        Return the (battleID, result file, battle file) still to be
+          ingested, in BattleID order.
+        '''
+        self.battledb.connect()
+        conn = self.battledb.conn
+        states = dict(conn.execute('SELECT BattleID, State FROM Battles'))
+        archived = conn.execute(
+            'SELECT IFNULL(MAX(LastBattleID),0) FROM Archives').fetchone()[0]
+
+        files = []
+        for entry in os.scandir(self.results):
+            match = _resultFile.match(entry.name)
+            if not match:
+                continue
+            self.stats['files'] += 1
+            battleID = int(match.group(1))
+            if states.get(battleID) == 'finished' or \
+               ( battleID not in states and battleID <= archived ):
+                self.stats['skipped'] += 1
+                continue
+            battleFile = None
+            if self.battles is not None:
+                battleFile = os.path.join(self.battles,'{0}.battle'.format(battleID))
+            files.append((battleID,entry.path,battleFile))
+        files.sort()
+        return files
+
+    def run( self ):
+        '''
+        Ingest everything; return the stats.
+        '''
+        start = time.perf_counter()
+        files = self.scan()
+        chunks = [ files[i:i+self.chunkSize]
+                   for i in range(0,len(files),self.chunkSize) ]
+
+        if self.workers == 0:
+            parsed = map(_parseFiles,chunks)
+            self._ingest(parsed,start)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(self.workers) as pool:
+                self._ingest(pool.map(_parseFiles,chunks),start)
+
+        self.stats['seconds'] = time.perf_counter() - start
+        self._report(len(files),final=True)
+        return self.stats
+
+    def _ingest( self, parsed, start ):
+        batch = []
+        done = 0
+        for chunk in parsed:
+            for battleID,finished,result,properties,error in chunk:
+                if error is not None:
+                    self.failed.append((battleID,error))
+                    self.stats['failed'] += 1
+                else:
+                    batch.append((battleID,finished,result,properties))
+            done += len(chunk)
+            if len(batch) >= self.batchSize:
+                self._record(batch)
+                batch = []
+                self.stats['seconds'] = time.perf_counter() - start
+                self._report(done)
+        if batch:
+            self._record(batch)
+
+    def _report( self, done, final=False ):
+        if self.progress is None:
+            return
+        seconds = self.stats['seconds'] or 1e-9
+        print('{0} {1}/{2} files in {3:.1f}s ({4:.0f} files/s): {5} recorded, {6} recreated, {7} failed, {8} skipped'.format(
+            'Ingested' if final else '...',
+            done, self.stats['files'] - self.stats['skipped'], seconds,
+            done/seconds,
+            self.stats['recorded'], self.stats['created'],
+            self.stats['failed'], self.stats['skipped'],
+        ),file=self.progress)
+
+    def _record( self, batch ):
+        '''
+        Record a batch of parsed results in one transaction.
+        '''
+        with self.battledb.transaction() as conn:
+            ids = [ battleID for battleID,finished,result,properties in batch ]
+            existing = {}
+            for i in range(0,len(ids),500):
+                chunk = ids[i:i+500]
+                for row in conn.execute('''
+                    SELECT Battles.BattleID, State, RobotID
+                    FROM Battles
+                      LEFT JOIN BattleRobots
+                      ON Battles.BattleID=BattleRobots.BattleID
+                    WHERE Battles.BattleID IN ({0})
+                '''.format(','.join('?'*len(chunk))),chunk):
+                    state,robots = existing.setdefault(row[0],(row[1],set()))
+                    robots.add(row[2])
+
+            # Every robot, by name (adding the missing ones)
+            robots = { row['Name']:(row['RobotID'],row['LastUpdated'])
+                       for row in conn.execute('SELECT * FROM Robots') }
+            newRobots = {}
+            for battleID,finished,(rounds,results,winner),properties in batch:
+                for data in results:
+                    if data['_Name'] not in robots:
+                        newRobots[data['_Name']] = max(
+                            finished,newRobots.get(data['_Name'],finished))
+            if newRobots:
+                conn.executemany('''
+                    INSERT INTO Robots (Name,LastUpdated)
+                    VALUES (?,?)
+                ''',sorted(newRobots.items()))
+                robots = { row['Name']:(row['RobotID'],row['LastUpdated'])
+                           for row in conn.execute('SELECT * FROM Robots') }
+                self.battledb.flushRobots()
+
+            created = []
+            scores = []
+            finishedBattles = []
+            for battleID,finished,(rounds,results,winner),properties in batch:
+                competitors = { robots[data['_Name']][0] for data in results }
+                if winner not in robots:
+                    self.failed.append((battleID,'No winner found'))
+                    self.stats['failed'] += 1
+                    continue
+                if battleID in existing:
+                    state,known = existing[battleID]
+                    if state == 'finished':
+                        continue
+                    if known != competitors:
+                        self.failed.append((battleID,'Competitors differ from the database'))
+                        self.stats['failed'] += 1
+                        continue
+                else:
+                    created.append((battleID,finished,properties,competitors))
+
+                for data in results:
+                    typed = BattleRobot.typedResults(data)
+                    scores.append(
+                        [ BattleRobot.number(data['_Score']),
+                          json.dumps(data,sort_keys=True) ] +
+                        [ typed[col] for col,field in BattleRobot.resultFields ] +
+                        [ battleID, robots[data['_Name']][0] ])
+                finishedBattles.append(
+                    (finished,finished,robots[winner][0],battleID))
+
+            # New battles go in as running: finishing them (below) is what
+            #   adds them to the leaderboard.
+            default = json.dumps(BattleDB.defaultProperties)
+            conn.executemany('''
+                INSERT INTO Battles
+                (BattleID,State,Priority,Started,Finished,Properties,Winner,Obsolete)
+                VALUES (?,'running',-1,?,'',?,-1,0)
+            ''',[ (battleID,finished,
+                   default if properties is None else json.dumps(properties,sort_keys=True))
+                  for battleID,finished,properties,competitors in created ])
+            versions = dict(robots.values())
+            conn.executemany('''
+                INSERT INTO BattleRobots
+                (BattleID,RobotID,RobotUpdated,Score,Results)
+                VALUES (?,?,?,-1,'')
+            ''',[ (battleID,robotID,versions[robotID])
+                  for battleID,finished,properties,competitors in created
+                  for robotID in sorted(competitors) ])
+
+            conn.executemany('''
+                UPDATE BattleRobots
+                SET Score=?,
+                    Results=?,
+                    {0}
+                WHERE BattleID=? AND RobotID=?
+            '''.format(','.join([ '{0}=?'.format(col)
+                                  for col,field in BattleRobot.resultFields ])),
+                scores)
+            conn.executemany('''
+                UPDATE Battles
+                SET State='finished',
+                    Started=COALESCE(NULLIF(Started,''),?),
+                    Finished=?,
+                    Winner=?,
+                    Obsolete = CASE WHEN EXISTS (
+                         SELECT 1
+                         FROM BattleRobots
+                           INNER JOIN Robots
+                           ON BattleRobots.RobotID=Robots.RobotID
+                         WHERE BattleRobots.BattleID=Battles.BattleID
+                           AND Robots.LastUpdated > BattleRobots.RobotUpdated
+                           AND BattleRobots.RobotUpdated <> ''
+                      ) THEN 1 ELSE Obsolete END
+                WHERE BattleID=?
+            ''',finishedBattles)
+
+            for finished,started,winner,battleID in finishedBattles:
+                for hook in self.battledb.completedHooks:
+                    hook(self.battledb,battleID)
+
+            self.stats['created'] += len(created)
+            self.stats['recorded'] += len(finishedBattles)
+
+
+def build_cmdline():
+    parser = argparse.ArgumentParser('rebuild results from the result files')
+
+    parser.add_argument(
+        'db',
+        type=str,
+        help='the battle database',
+    )
+    parser.add_argument(
+        'results',
+        type=str,
+        help='the results directory',
+    )
+    parser.add_argument(
+        '--battles', '-b',
+        type=str,
+        default=None,
+        help='the battles directory (for recreated battles\' properties)',
+    )
+    parser.add_argument(
+        '--workers', '-w',
+        type=int,
+        default=None,
+        help='the number of parsing processes (default: one per CPU; 0 for none)',
+    )
+    parser.add_argument(
+        '--batch',
+        type=int,
+        default=5000,
+        help='the number of battles recorded per transaction',
+    )
+
+    return parser
+
+
+if __name__ == '__main__':
+    cmdline = build_cmdline().parse_args()
+    ingester = Ingester(BattleDB(cmdline.db),cmdline.results,cmdline.battles,
+                        workers=cmdline.workers,batchSize=cmdline.batch)
+    ingester.run()
+    for battleID,error in ingester.failed:
+        print('Battle {0}: {1}'.format(battleID,error),file=sys.stderr)
@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+
+'''
+An in-memory backend for BattleData.BattleDB.
+
+MemoryBackend keeps the robots and battles in plain Python containers
+  instead of SQLite, and implements the backend primitives that BattleDB's
+  core API is built on (see BattleData.SQLiteBackend): robots, scheduling,
+  claiming and completing battles, obsolescence, the leaderboard, and the
+  battle queries (BattleQuery's filter(), orderBy() and limit()).  So a
+  MemoryBattleDB is a BattleDB, with the same API and hooks, and
+  t/t_conformance.py runs against both.  Nothing is written to disk: it's
+  for tests and for simulating large tournaments quickly.
+
+It has no SQL, so BattleDB's SQL-only features -- execute(), SQL
+  conditions (GetBattles() with SQL, BattleQuery.where()), ratings,
+  recordings, archiving and export -- raise BattleDB.NotSupported.
+  Nothing can be rolled back either: a transaction() only groups the
+  changes (and its afterCommit() callbacks).  The contents live in one
+  process, so it can't be shared with BattleRunner's worker processes.
+
+The battles are stored column by column in lists indexed by BattleID
+  (BattleIDs are assigned consecutively from 1), each robot keeps the
+  BattleIDs of its battles, and the scheduled battles are a heap in claim
+  order (Priority DESC, BattleID).  The leaderboard totals are kept
+  current as battles finish or become obsolete, as BattleDB's triggers do.
+'''
+
+from BattleData import BattleDB, BattleQuery, BattleRobot, QueryStats
+from contextlib import contextmanager
+import array
+import bisect
+import heapq
+import json
+import re
+
+class Row(tuple):
+    '''
+    A row of BattleQuery.values(): by index or, like sqlite3.Row, by column
+    name.
+    '''
+    def __new__( cls, columns, values ):
+        row = super().__new__(cls,values)
+        row._columns = columns
+        return row
+
+    def __getitem__( self, key ):
+        if isinstance(key,str):
+            key = self._columns.index(key)
+        return super().__getitem__(key)
+
+    def keys( self ):
+        return list(self._columns)
+
+
+class MemoryBackend:
+    '''
+    BattleDB's storage in memory (see BattleData.SQLiteBackend for what
+    each method does).
+    '''
+    sql = False
+
+    leaderboardOrders = {
+        'wins'    : lambda e: ( -e['Wins'], -e['AverageScore'], e['Name'] ),
+        'score'   : lambda e: ( -e['TotalScore'], e['Name'] ),
+        'average' : lambda e: ( -e['AverageScore'], -e['Wins'], e['Name'] ),
+    }
+
+    def __init__( self, name=':memory:' ):
+        '''
+        <name> is only for messages.
+        '''
+        self.name = name
+        self._debug = False
+        self.queryStats = QueryStats()
+        # The nesting of transaction()s, and what to call once they end
+        self._depth = 0
+        self._afterCommit = []
+        self._transactions = 0
+
+        # Robots, by RobotID-1
+        self._names = []
+        self._lastUpdated = []
+        # Name: RobotID
+        self._robotIDs = {}
+        # RobotID: array of its BattleIDs
+        self._robotBattles = {}
+        # RobotID: [Battles, Wins, TotalScore]
+        self._leaderboard = {}
+
+        # The Battles columns, by BattleID-1
+        self._priority = []
+        self._state = []
+        self._started = []
+        self._finished = []
+        self._properties = []
+        self._winner = []
+        self._obsolete = bytearray()
+        self._recording = []
+        self._recorded = []
+        self._columns = {
+            'Priority'   : self._priority,
+            'State'      : self._state,
+            'Started'    : self._started,
+            'Finished'   : self._finished,
+            'Properties' : self._properties,
+            'Winner'     : self._winner,
+            'Obsolete'   : self._obsolete,
+            'Recording'  : self._recording,
+            'Recorded'   : self._recorded,
+        }
+        # the competitors' RobotIDs (sorted), and their versions once claimed
+        self._competitors = []
+        self._updated = []
+        # BattleID: { RobotID: (Score, Results) }
+        #   (the typed result columns are only parsed when they're read)
+        self._results = {}
+        # (-Priority, BattleID) of the scheduled battles (and, lazily
+        #   removed, some that have since been started or reprioritized)
+        self._scheduled = []
+
+    def __copy__( self ):
+        # (another thread's BattleDB: the same contents)
+        return self
+
+    def __getstate__( self ):
+        raise TypeError('{0} can\'t be shared with another process'.format(self))
+
+    def __str__( self ):
+        return '[MemoryBackend name({0})]'.format(self.name)
+
+    @property
+    def conn( self ):
+        raise BattleDB.NotSupported('{0} has no SQL connection'.format(self))
+
+    def connect( self ):
+        # (nothing to open)
+        return False
+
+    def close( self ):
+        pass
+
+    def stats( self ):
+        return self.queryStats.snapshot()
+
+    def lockStats( self ):
+        return {
+            'transactions'  : self._transactions,
+            'retries'       : 0,
+            'waited'        : 0.0,
+            'maxWait'       : 0.0,
+        }
+
+    @contextmanager
+    def transaction( self ):
+        '''
+        Group the enclosed calls.  Nothing is rolled back on an exception:
+        the changes made so far stay, so the afterCommit() callbacks are
+        called either way.
+        '''
+        self._depth += 1
+        if self._depth == 1:
+            self._transactions += 1
+        try:
+            yield None
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                callbacks,self._afterCommit = self._afterCommit,[]
+                for callback in callbacks:
+                    callback()
+
+    def afterCommit( self, callback ):
+        if self._depth:
+            self._afterCommit.append(callback)
+        else:
+            callback()
+
+    @contextmanager
+    def savepoint( self ):
+        # (nothing to undo: BattleDB checks a result before recording it)
+        yield
+
+
+    #
+    # Robots
+    #
+
+    def robotsVersion( self ):
+        # (the robots only change through the BattleDBs on this backend)
+        return None
+
+    def robotRecords( self, ids=None, name=None ):
+        if name is not None:
+            ids = [ self._robotIDs[name] ] if name in self._robotIDs else []
+        elif ids is None:
+            ids = range(1,len(self._names)+1)
+        return [ { 'RobotID'     : robotID,
+                   'Name'        : self._names[robotID-1],
+                   'LastUpdated' : self._lastUpdated[robotID-1] }
+                 for robotID in ids
+                 if robotID in self._robotBattles ]
+
+    def insertRobot( self, name, lastUpdated ):
+        self._names.append(name)
+        self._lastUpdated.append(lastUpdated)
+        robotID = len(self._names)
+        self._robotIDs[name] = robotID
+        self._robotBattles[robotID] = array.array('q')
+        return robotID
+
+    def updateRobot( self, robotID, lastUpdated ):
+        if robotID in self._robotBattles:
+            self._lastUpdated[robotID-1] = lastUpdated
+
+
+    #
+    # Leaderboard
+    #
+
+    def leaderboard( self, order ):
+        key = self.leaderboardOrders[order]
+        return sorted([
+            { 'RobotID'      : robotID,
+              'Name'         : self._names[robotID-1],
+              'Battles'      : battles,
+              'Wins'         : wins,
+              'TotalScore'   : score,
+              'AverageScore' : float(score)/battles }
+            for robotID,(battles,wins,score) in self._leaderboard.items()
+            if battles > 0
+        ],key=key)
+
+    def _rank( self, i, sign ):
+        '''
+        Add (<sign> 1) or remove (-1) battle index <i> from the leaderboard.
+        '''
+        results = self._results[i+1]
+        for robotID in self._competitors[i]:
+            entry = self._leaderboard.setdefault(robotID,[0,0,0])
+            entry[0] += sign
+            entry[1] += sign * (robotID == self._winner[i])
+            entry[2] += sign * (results[robotID][0] or 0)
+
+
+    #
+    # Battles
+    #
+
+    def _stale( self, i ):
+        '''
+        Has a competitor of battle index <i> been updated since it fought?
+        '''
+        updated = self._updated[i]
+        return updated is not None and any(
+            version != '' and self._lastUpdated[robotID-1] > version
+            for robotID,version in zip(self._competitors[i],updated))
+
+    def obsolesce( self, robotID=None, ids=False ):
+        if robotID is None:
+            indices = range(len(self._state))
+        else:
+            indices = [ battleID-1 for battleID in self._robotBattles.get(robotID,()) ]
+        battleIDs = [ i+1 for i in indices
+                      if self._state[i] == 'finished' and not self._obsolete[i]
+                      and self._stale(i) ]
+        for battleID in battleIDs:
+            self._obsolete[battleID-1] = 1
+            self._rank(battleID-1,-1)
+        return battleIDs if ids else len(battleIDs)
+
+    @staticmethod
+    def _test( op, value ):
+        '''
+        Return a test of a column's value for the filter <op> <value>, as
+        SQL compares them (NULL only matches IS NULL).
+        '''
+        if value is None and op in ('eq','ne'):
+            return (lambda x: x is None) if op == 'eq' else (lambda x: x is not None)
+        if op == 'in':
+            values = set(value)
+            return lambda x: x in values
+        if op == 'like':
+            pattern = re.compile(''.join(
+                '.*' if c == '%' else '.' if c == '_' else re.escape(c)
+                for c in value),re.IGNORECASE | re.DOTALL)
+            return lambda x: x is not None and pattern.fullmatch(str(x)) is not None
+        if op == 'between':
+            low,high = value
+            compare = lambda x: low <= x <= high
+        else:
+            compare = {
+                'eq' : lambda x: x == value,
+                'ne' : lambda x: x != value,
+                'lt' : lambda x: x < value,
+                'le' : lambda x: x <= value,
+                'gt' : lambda x: x > value,
+                'ge' : lambda x: x >= value,
+            }[op]
+        def test( x ):
+            try:
+                return x is not None and compare(x)
+            except TypeError:
+                return False
+        return test
+
+    def _select( self, query ):
+        '''
+        Return the indices of the battles matching <query>, in its order
+        and within its limit.
+        '''
+        # BattleIDs are the indices: conditions on them (and on the
+        #   competitors) pick the candidates, rather than testing each battle.
+        low,high = 1,len(self._state)
+        candidates = None
+        tests = []
+        for column,op,value in query._filters:
+            if column == 'robot':
+                battleIDs = set()
+                for robotID in value:
+                    battleIDs.update(self._robotBattles.get(robotID,()))
+            elif column == 'BattleID' and op == 'in' and \
+                 isinstance(value,range) and value.step == 1:
+                low,high = max(low,value.start),min(high,value.stop-1)
+                continue
+            elif column == 'BattleID' and op in ('eq','in') and value is not None:
+                battleIDs = set(value) if op == 'in' else { value }
+            elif column == 'BattleID' and isinstance(value,int) and \
+                 op in ('lt','le','gt','ge'):
+                if op in ('gt','ge'):
+                    low = max(low,value + (op == 'gt'))
+                else:
+                    high = min(high,value - (op == 'lt'))
+                continue
+            else:
+                test = self._test(op,value)
+                if column == 'BattleID':
+                    tests.append(lambda i, test=test: test(i+1))
+                else:
+                    tests.append(lambda i, test=test, data=self._columns[column]:
+                                 test(data[i]))
+                continue
+            candidates = battleIDs if candidates is None else candidates & battleIDs
+
+        if candidates is None:
+            indices = range(low-1,high)
+        else:
+            indices = [ battleID-1
+                        for battleID in sorted( b for b in candidates
+                                                if isinstance(b,int) )
+                        if low <= battleID <= high ]
+        if tests:
+            indices = [ i for i in indices if all( test(i) for test in tests ) ]
+
+        start = query._offset or 0
+        stop = None if query._limit is None else start + query._limit
+        if query._order is None:
+            return indices[start:stop]
+
+        indices = list(indices)
+        # (stable sorts, the last key first; NULLs first, as SQLite has them)
+        for column in reversed(query._order):
+            descending = column.startswith('-')
+            column = column.lstrip('-')
+            if column == 'BattleID':
+                key = None
+            else:
+                key = lambda i, data=self._columns[column]: (data[i] is not None, data[i])
+            indices.sort(key=key,reverse=descending)
+        return indices[start:stop]
+
+    def _record( self, i ):
+        record = { column:data[i] for column,data in self._columns.items() }
+        record['BattleID'] = i+1
+        return record
+
+    def loadBattles( self, query, known ):
+        indices = self._select(query)
+        pairs = [ (i+1,robotID) for i in indices for robotID in self._competitors[i] ]
+        return ( [ self._record(i) for i in indices ],
+                 pairs,
+                 self.robotRecords(ids=sorted({ robotID for battleID,robotID in pairs
+                                                if robotID not in known })) )
+
+    def values( self, query, columns ):
+        rows = []
+        for i in self._select(query):
+            record = self._record(i)
+            rows.append(Row(columns,[ record[column] for column in columns ]))
+        return rows
+
+    def count( self, query ):
+        return len(self._select(query))
+
+    def battleResults( self, battleIDs, counted=False ):
+        records = []
+        for battleID in sorted({ b for b in battleIDs if isinstance(b,int) }):
+            if not 0 < battleID <= len(self._state):
+                continue
+            i = battleID-1
+            if counted and (self._state[i] != 'finished' or self._obsolete[i]):
+                continue
+            results = self._results.get(battleID,{})
+            updated = self._updated[i] or ('',)*len(self._competitors[i])
+            for robotID,version in zip(self._competitors[i],updated):
+                score,text = results.get(robotID,(-1,''))
+                record = { 'BattleID'     : battleID,
+                           'RobotID'      : robotID,
+                           'RobotUpdated' : version,
+                           'Score'        : score,
+                           'Results'      : text }
+                if text:
+                    record.update(BattleRobot.typedResults(json.loads(text)))
+                records.append(record)
+        return records
+
+    def scheduleBattles( self, competitors, properties ):
+        competitors = [ tuple(sorted(comps)) for comps in competitors ]
+        for comps in competitors:
+            for robotID in comps:
+                if robotID not in self._robotBattles:
+                    raise KeyError("GetRobot() no robot with ID '{0}' found".format(robotID))
+
+        first = len(self._state)+1
+        ids = range(first,first+len(competitors))
+        count = len(competitors)
+        self._priority.extend([-1]*count)
+        self._state.extend(['scheduled']*count)
+        self._started.extend(['']*count)
+        self._finished.extend(['']*count)
+        self._properties.extend(properties)
+        self._winner.extend([-1]*count)
+        self._obsolete.extend(bytes(count))
+        self._recording.extend([None]*count)
+        self._recorded.extend([None]*count)
+        self._competitors.extend(competitors)
+        self._updated.extend([None]*count)
+        for battleID,comps in zip(ids,competitors):
+            for robotID in comps:
+                self._robotBattles[robotID].append(battleID)
+        # (pushed, not appended: the heap may hold battles of a lower Priority)
+        for battleID in ids:
+            heapq.heappush(self._scheduled,(1,battleID))
+        return ids
+
+    def updateBattle( self, battleID, **columns ):
+        i = battleID-1
+        for column,value in columns.items():
+            self._columns[BattleQuery._column(column)][i] = value
+        if 'Priority' in columns and self._state[i] == 'scheduled':
+            heapq.heappush(self._scheduled,(-columns['Priority'],battleID))
+
+    def newVersionBattles( self, battleIDs, firsts ):
+        found = set()
+        for battleID in battleIDs:
+            i = battleID-1
+            if not 0 <= i < len(self._state) or self._updated[i] is None:
+                continue
+            for robotID,version in zip(self._competitors[i],self._updated[i]):
+                robotBattles = self._robotBattles[robotID]
+                earlier = 0
+                for earlierID in robotBattles[:bisect.bisect_left(robotBattles,battleID)]:
+                    j = earlierID-1
+                    if self._updated[j] is not None and \
+                       self._updated[j][self._competitors[j].index(robotID)] == version:
+                        earlier += 1
+                        if earlier >= firsts:
+                            break
+                if earlier < firsts:
+                    found.add(battleID)
+                    break
+        return found
+
+    def _claim( self, i, started ):
+        self._state[i] = 'running'
+        self._started[i] = started
+        self._updated[i] = tuple( self._lastUpdated[robotID-1]
+                                  for robotID in self._competitors[i] )
+
+    def claimBattles( self, count, started ):
+        claimed = []
+        while self._scheduled and len(claimed) < count:
+            priority,battleID = heapq.heappop(self._scheduled)
+            i = battleID-1
+            # (skipping those started since, or queued again at a new Priority)
+            if self._state[i] == 'scheduled' and -priority == self._priority[i]:
+                self._claim(i,started)
+                claimed.append(battleID)
+        return claimed
+
+    def startBattle( self, battleID, started ):
+        if isinstance(battleID,int) and 0 < battleID <= len(self._state) and \
+           self._state[battleID-1] == 'scheduled':
+            self._claim(battleID-1,started)
+            return True
+        return False
+
+    def completeBattle( self, battleID, battleData, winner, results ):
+        i = battleID-1
+        self._results[battleID] = { robotID:(score,text)
+                                    for robotID,(score,text,parsed) in results.items() }
+        self._state[i] = 'finished'
+        self._started[i] = battleData['Started']
+        self._finished[i] = battleData['Finished']
+        self._winner[i] = winner
+        self._properties[i] = battleData['Properties']
+        if battleData.get('Recording') is not None:
+            self._recording[i] = battleData['Recording']
+        self._recorded[i] = battleData.get('Recorded')
+        # A competitor may have been updated while the battle ran.
+        if self._stale(i):
+            self._obsolete[i] = 1
+        if not self._obsolete[i]:
+            self._rank(i,1)
+
+
+class MemoryBattleDB(BattleDB):
+    '''
+    A BattleDB on a MemoryBackend.
+    '''
+    def __init__( self, db_file=':memory:' ):
+        '''
+        <db_file> is only a name (for messages).
+        '''
+        super().__init__(db_file,backend=MemoryBackend(db_file))
+
+    def __str__( self ):
+        return '[MemoryBattleDB name({0})]'.format(self.db_file)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+'''
+Rate robots from their battle results.
+
+Ratings are per robot version (BattleRobots.RobotUpdated), so a robot's
+  earlier versions keep their ratings, and are stored in the Ratings table
+  (see BattleDB.GetRatings()).
+
+Every battle counts as a set of pairwise outcomes: each competitor beat
+  the ones it placed ahead of.
+
+ * Elo: updated incrementally as each battle is recorded (install() it as
+     one of BattleDB.completedHooks).
+ * Bradley-Terry: refit from every finished battle at once, vectorized
+     with NumPy.
+'''
+
+from BattleData import BattleDB
+import numpy
+import argparse
+import array
+import itertools
+import sys
+import time
+
+class Elo:
+    '''
+    Incremental Elo ratings.
+    '''
+    system = 'elo'
+
+    def __init__( self, k=32.0, initial=1500.0 ):
+        '''
+        <k> is the most a rating changes in a battle (split between the
+          opponents, in battles with more than two competitors).
+        '''
+        self.k = k
+        self.initial = initial
+
+    def install( self, battledb ):
+        '''
+        Rate each battle as its results are recorded.
+        '''
+        battledb.requireSQL('Elo ratings')
+        battledb.completedHooks.append(self)
+        return self
+
+    def __call__( self, battledb, battleID ):
+        self.update(battledb,battleID)
+
+    def update( self, battledb, battleID ):
+        '''
+        Apply one finished battle's results.  Only its competitors' ratings
+          are read and written.
+        '''
+        with battledb.transaction() as conn:
+            competitors = conn.execute('''
+                SELECT BattleRobots.RobotID, BattleRobots.RobotUpdated, Place,
+                       Rating, Battles
+                FROM BattleRobots
+                  LEFT JOIN Ratings
+                  ON Ratings.System=?
+                     AND Ratings.RobotID=BattleRobots.RobotID
+                     AND Ratings.RobotUpdated=BattleRobots.RobotUpdated
+                WHERE BattleID=?
+            ''',[self.system,battleID]).fetchall()
+            if len(competitors) < 2 or \
+               any( c['Place'] is None for c in competitors ):
+                return
+
+            ratings = [ self.initial if c['Rating'] is None else c['Rating']
+                        for c in competitors ]
+            k = self.k / (len(competitors)-1)
+            changes = [0.0] * len(competitors)
+            for i in range(len(competitors)):
+                for j in range(i+1,len(competitors)):
+                    expected = 1.0/(1.0 + 10.0**((ratings[j]-ratings[i])/400.0))
+                    place_i = competitors[i]['Place']
+                    place_j = competitors[j]['Place']
+                    actual = 1.0 if place_i < place_j else \
+                             0.5 if place_i == place_j else 0.0
+                    changes[i] += k*(actual-expected)
+                    changes[j] -= k*(actual-expected)
+
+            conn.executemany('''
+                INSERT INTO Ratings (System,RobotID,RobotUpdated,Rating,Battles)
+                VALUES (?,?,?,?,1)
+                ON CONFLICT (System,RobotID,RobotUpdated) DO UPDATE
+                SET Rating=excluded.Rating,
+                    Battles=Battles+1
+            ''',[ (self.system,c['RobotID'],c['RobotUpdated'],rating+change)
+                  for c,rating,change in zip(competitors,ratings,changes) ])
+
+
+class BradleyTerry:
+    '''
+    Bradley-Terry ratings, refit from every finished battle.
+
+    Robot version i beats j with probability p_i/(p_i+p_j).  The strengths
+      p are fit with the MM algorithm (Hunter, 2004):
+
+         p_i <- W_i / sum_j n_ij/(p_i+p_j)
+
+      vectorized over the list of pairwise outcomes, so each iteration is
+      a few numpy.bincount() calls.  Each version also gets <prior> wins
+      and losses against an average (p=1) opponent, which keeps undefeated
+      and winless versions finite.
+
+    The ratings are reported on the Elo scale: 400*log10(p) + <initial>.
+    '''
+    system = 'bradley-terry'
+
+    def __init__( self, prior=1.0, initial=1500.0, tolerance=1e-6,
+                  maxIterations=1000 ):
+        self.prior = prior
+        self.initial = initial
+        self.tolerance = tolerance
+        self.maxIterations = maxIterations
+        self.iterations = 0
+
+    def outcomes( self, battledb ):
+        '''
+        Return (versions, winners, losers): the (RobotID,RobotUpdated) of
+          every rated robot version, and, for every pairwise outcome, the
+          indices (into versions) of the winner and loser.
+
+        BattleRobots is read in a single pass (a chunk at a time, rather than
+          joined with Battles, which is much slower) and the pairs are built
+          with NumPy.
+        '''
+        battledb.connect()
+        conn = battledb.conn
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        index = {}
+        battles = array.array('q')
+        players = array.array('q')
+        places = array.array('q')
+
+        # Read everything from the same snapshot.
+        snapshot = not conn.in_transaction
+        if snapshot:
+            conn.execute('BEGIN')
+        try:
+            finished = numpy.fromiter(
+                ( row[0] for row in cursor.execute(
+                    "SELECT BattleID FROM Battles WHERE State='finished'") ),
+                dtype=numpy.int64)
+            cursor.execute('''
+                SELECT BattleID, RobotID, RobotUpdated, Place
+                FROM BattleRobots
+                WHERE Place IS NOT NULL
+            ''')
+            while True:
+                rows = cursor.fetchmany(100000)
+                if not rows:
+                    break
+                for battleID,robotID,robotUpdated,place in rows:
+                    battles.append(battleID)
+                    players.append(index.setdefault((robotID,robotUpdated),len(index)))
+                    places.append(place)
+        finally:
+            cursor.close()
+            if snapshot:
+                conn.execute('COMMIT')
+
+        battles = numpy.frombuffer(battles,dtype=numpy.int64)
+        players = numpy.frombuffer(players,dtype=numpy.int64)
+        places = numpy.frombuffer(places,dtype=numpy.int64)
+        keep = numpy.isin(battles,finished)
+        if not keep.all():
+            battles,players,places = battles[keep],players[keep],places[keep]
+        # (only the versions that are left)
+        versions = sorted(index,key=index.get)
+        used,players = numpy.unique(players,return_inverse=True)
+        versions = [ versions[i] for i in used ]
+
+        # Sort by battle, then place: each competitor beat the ones after it
+        #   in its battle.  Compare each row with the one <d> after it.
+        order = numpy.lexsort((places,battles))
+        battles,players,places = battles[order],players[order],places[order]
+        winners = []
+        losers = []
+        for d in itertools.count(1):
+            same = battles[d:] == battles[:-d]
+            if not same.any():
+                break
+            ahead = same & (places[:-d] < places[d:])
+            winners.append(players[:-d][ahead])
+            losers.append(players[d:][ahead])
+
+        if not winners:
+            return versions, numpy.empty(0,numpy.int64), numpy.empty(0,numpy.int64)
+        return versions, numpy.concatenate(winners), numpy.concatenate(losers)
+
+    def fit( self, count, winners, losers ):
+        '''
+        Return the strengths (p) of <count> players from the outcomes
+          (arrays of winner and loser indices).
+        '''
+        wins = numpy.bincount(winners,minlength=count) + self.prior
+        p = numpy.ones(count)
+        self.iterations = 0
+        while self.iterations < self.maxIterations:
+            self.iterations += 1
+            # each outcome adds 1/(p_w+p_l) to both players' denominators
+            inverse = 1.0/(p[winners] + p[losers])
+            denominator = numpy.bincount(winners,inverse,count) + \
+                          numpy.bincount(losers,inverse,count) + \
+                          2.0*self.prior/(p + 1.0)
+            updated = wins/denominator
+            # p is only defined up to a constant factor
+            updated /= numpy.exp(numpy.log(updated).mean())
+            change = numpy.abs(numpy.log(updated/p)).max()
+            p = updated
+            if change < self.tolerance:
+                break
+        return p
+
+    def refit( self, battledb ):
+        '''
+        Refit and store every robot version's rating.  Returns the number
+          of versions rated.
+        '''
+        versions,winners,losers = self.outcomes(battledb)
+        if not versions:
+            return 0
+        p = self.fit(len(versions),winners,losers)
+        ratings = 400.0*numpy.log10(p) + self.initial
+        battles = numpy.bincount(winners,minlength=len(versions)) + \
+                  numpy.bincount(losers,minlength=len(versions))
+
+        with battledb.transaction() as conn:
+            conn.execute('DELETE FROM Ratings WHERE System=?',[self.system])
+            conn.executemany('''
+                INSERT INTO Ratings (System,RobotID,RobotUpdated,Rating,Battles)
+                VALUES (?,?,?,?,?)
+            ''',[ (self.system,robotID,robotUpdated,float(rating),int(count))
+                  for (robotID,robotUpdated),rating,count
+                  in zip(versions,ratings,battles) ])
+        return len(versions)
+
+
+systems = {
+    Elo.system           : Elo,
+    BradleyTerry.system  : BradleyTerry,
+}
+
+
+def build_cmdline():
+    parser = argparse.ArgumentParser('rate robots')
+
+    parser.add_argument(
+        'db',
+        type=str,
+        help='the battle database',
+    )
+    parser.add_argument(
+        '--refit',
+        action='store_true',
+        help='refit the Bradley-Terry ratings first',
+    )
+    parser.add_argument(
+        '--system', '-s',
+        choices=sorted(systems.keys()),
+        default=BradleyTerry.system,
+        help='the ratings to list',
+    )
+    parser.add_argument(
+        '--all', '-a',
+        action='store_true',
+        help='list every rated version, not just the current ones',
+    )
+
+    return parser
+
+
+if __name__ == '__main__':
+    cmdline = build_cmdline().parse_args()
+    bdata = BattleDB(cmdline.db)
+
+    if cmdline.refit:
+        bt = BradleyTerry()
+        start = time.perf_counter()
+        rated = bt.refit(bdata)
+        print('Refit {0} versions in {1:.2f}s ({2} iterations)'.format(
+            rated,time.perf_counter()-start,bt.iterations),file=sys.stderr)
+
+    for entry in bdata.GetRatings(cmdline.system,current=not cmdline.all):
+        print('{0:<40} {1:<20} {2:>8.1f} {3:>8}'.format(
+            entry.Name,entry.RobotUpdated,entry.Rating,entry.Battles))
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+'''
+Battle recordings (Robocode's -record files), stored by content.
+
+Each recording is kept gzipped as <root>/ab/cd/<sha256>.br.gz, where
+  abcd... is the SHA-256 of the recording itself, so no directory holds
+  more than a few files per 65536 recordings and identical recordings are
+  stored once.  The BattleDB's Recordings table indexes them by battle
+  (see BattleDB.AddRecordings()).
+
+Recordings are read back as a stream (open(), stream()), or extracted to
+  a file for Robocode's -replay.
+
+expire() applies the retention policy: the recordings of obsolete (or
+  archived) battles go, and (optionally) all but the latest few of each
+  matchup.  The index is updated first, and a file only goes once no
+  battle is recorded by it, so a crash can leave a file nothing refers
+  to.  (A file can still go while an identical recording, put() but not
+  yet indexed, is relying on it.)
+'''
+
+from BattleData import BattleDB
+import argparse
+import gzip
+import hashlib
+import os
+import os.path
+import re
+import shutil
+import sys
+import tempfile
+
+class RecordingStore:
+    suffix = '.br.gz'
+
+    def __init__( self, root, level=6, chunkSize=1<<16 ):
+        '''
+        <level> is the gzip compression level; files are read and written
+        <chunkSize> bytes at a time.
+        '''
+        self.root = root
+        self.level = level
+        self.chunkSize = chunkSize
+
+    def __str__( self ):
+        return '[RecordingStore dir({0}) level({1})]'.format(self.root,self.level)
+
+    def path( self, digest ):
+        '''
+        The file of the recording whose SHA-256 is <digest>.
+        '''
+        return os.path.join(self.root,digest[0:2],digest[2:4],digest+self.suffix)
+
+    def put( self, recordFile, remove=True ):
+        '''
+        Store the recording <recordFile> (removing it, with <remove>) and
+          return (Hash, Size, Stored): its SHA-256, its size and its
+          compressed size.
+
+        It is hashed and compressed in one pass, into a temporary file
+          that is then renamed into place, so a stored recording is always
+          complete.
+        '''
+        tmpDir = os.path.join(self.root,'tmp')
+        os.makedirs(tmpDir,exist_ok=True)
+        fd,tmp = tempfile.mkstemp(dir=tmpDir,suffix=self.suffix)
+        try:
+            sha = hashlib.sha256()
+            size = 0
+            with open(recordFile,'rb') as recording, \
+                 os.fdopen(fd,'wb') as raw, \
+                 gzip.GzipFile(fileobj=raw,mode='wb',compresslevel=self.level,
+                               mtime=0) as out:
+                while True:
+                    chunk = recording.read(self.chunkSize)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+
+            digest = sha.hexdigest()
+            path = self.path(digest)
+            if os.path.isfile(path):
+                # already stored
+                os.remove(tmp)
+            else:
+                os.makedirs(os.path.dirname(path),exist_ok=True)
+                os.replace(tmp,path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        if remove:
+            os.remove(recordFile)
+        return digest, size, os.path.getsize(path)
+
+    def record( self, battledb, battleID, recordFile, remove=True ):
+        '''
+        Store <battleID>'s recording <recordFile> and index it in
+          <battledb>.  Return its Hash.
+        '''
+        digest,size,stored = self.put(recordFile,remove)
+        self.remove(battledb.AddRecordings([ (battleID,digest,size,stored) ]))
+        return digest
+
+    def remove( self, hashes, battledb=None ):
+        '''
+        Remove the recordings <hashes> (that nothing refers to any more).
+
+        With <battledb>, those that a battle is still recorded by are kept
+          (identical recordings are stored once), e.g. for the recordings
+          of results that couldn't be recorded.
+        '''
+        if battledb is None:
+            self._remove(hashes)
+            return
+        # (holding the write lock: nothing is indexed in the meantime)
+        with battledb.transaction():
+            self._remove(battledb.UnusedRecordings(hashes))
+
+    def _remove( self, hashes ):
+        for digest in hashes:
+            try:
+                os.remove(self.path(digest))
+            except FileNotFoundError:
+                pass
+
+    def open( self, digest ):
+        '''
+        Return a binary file object reading the recording <digest>
+          (decompressing it as it goes).
+        '''
+        return gzip.open(self.path(digest),'rb')
+
+    def openBattle( self, battledb, battle ):
+        '''
+        open() <battle>'s recording (KeyError if it has none).
+        '''
+        return self.open(battledb.GetRecording(battle).Hash)
+
+    def stream( self, digest ):
+        '''
+        Yield the recording <digest>, <chunkSize> bytes at a time.
+        '''
+        with self.open(digest) as recording:
+            while True:
+                chunk = recording.read(self.chunkSize)
+                if not chunk:
+                    break
+                yield chunk
+
+    def extract( self, digest, recordFile ):
+        '''
+        Write the recording <digest> to <recordFile> (e.g. for Robocode's
+          -replay).
+        '''
+        with self.open(digest) as recording, open(recordFile,'wb') as out:
+            shutil.copyfileobj(recording,out,self.chunkSize)
+
+    def expire( self, battledb, keep=None ):
+        '''
+        Drop the recordings of obsolete (or archived) battles and, with
+          <keep>, all but the latest <keep> of each matchup (see
+          BattleDB.ExpireRecordings()).
+          Return the number of recordings dropped.
+        '''
+        dropped,hashes = battledb.ExpireRecordings(keep)
+        self.remove(hashes)
+        return dropped
+
+    _recordFile = re.compile(r'^(\d+)\.br$')
+
+    def importDirectory( self, battledb, recordings, progress=sys.stderr ):
+        '''
+        Store (and remove) the <BattleID>.br files in the directory
+          <recordings>, as Robocode wrote them.  Return the number stored.
+        '''
+        files = [ (int(match.group(1)),os.path.join(recordings,name))
+                  for name,match in ( (name,self._recordFile.match(name))
+                                      for name in os.listdir(recordings) )
+                  if match ]
+        batch = []
+        for count,(battleID,recordFile) in enumerate(sorted(files),1):
+            batch.append((battleID,)+self.put(recordFile))
+            if len(batch) == 1000 or count == len(files):
+                self.remove(battledb.AddRecordings(batch))
+                batch = []
+                if progress:
+                    print('{0}/{1} recordings stored'.format(count,len(files)),
+                          file=progress)
+        return len(files)
+
+
+def build_cmdline():
+    parser = argparse.ArgumentParser('manage the recording store')
+
+    parser.add_argument(
+        'db',
+        type=str,
+        help='the battle database',
+    )
+    parser.add_argument(
+        'store',
+        type=str,
+        help='the recording store directory',
+    )
+    parser.add_argument(
+        '--import', '-i',
+        dest='recordings',
+        type=str,
+        default=None,
+        help='store (and remove) the recordings in this directory first',
+    )
+    parser.add_argument(
+        '--keep', '-k',
+        type=int,
+        default=None,
+        help='keep only the latest KEEP recordings of each matchup',
+    )
+    parser.add_argument(
+        '--level',
+        type=int,
+        default=6,
+        help='the gzip compression level',
+    )
+
+    return parser
+
+
+if __name__ == '__main__':
+    cmdline = build_cmdline().parse_args()
+    bdata = BattleDB(cmdline.db)
+    store = RecordingStore(cmdline.store,level=cmdline.level)
+    if cmdline.recordings is not None:
+        store.importDirectory(bdata,cmdline.recordings)
+    print('{0} recordings dropped'.format(store.expire(bdata,cmdline.keep)))
+    recordings = bdata.GetRecordings()
+    print('{0} recordings: {1} bytes, {2} stored'.format(
+        len(recordings),
+        sum( r.Size for r in recordings ),
+        sum( r.Stored for r in recordings )))
@@ -7,3 +7,54 @@ Reporting tools.
  2. List results by robot.
  3. List leaderboard.
 '''
+
+from BattleData import BattleDB
+import argparse
+import sys
+
+def leaderboard( battledb, ofile=sys.stdout, order='wins' ):
+    '''
+    Print the leaderboard (see BattleDB.GetLeaderboard()).
+    '''
+    print('{0:>4}  {1:<40} {2:>8} {3:>8} {4:>12} {5:>10}'.format(
+        'Rank','Robot','Battles','Wins','Total Score','Average'),file=ofile)
+    for rank,entry in enumerate(battledb.GetLeaderboard(order),1):
+        print('{0:>4}  {1:<40} {2:>8} {3:>8} {4:>12} {5:>10.1f}'.format(
+            rank,
+            entry.Name,
+            entry.Battles,
+            entry.Wins,
+            entry.TotalScore,
+            entry.AverageScore,
+        ),file=ofile)
+
+
+def build_cmdline():
+    parser = argparse.ArgumentParser('arena reports')
+
+    parser.add_argument(
+        'db',
+        type=str,
+        help='the battle database',
+    )
+    parser.add_argument(
+        '--leaderboard', '-l',
+        action='store_true',
+        help='list the leaderboard',
+    )
+    parser.add_argument(
+        '--order',
+        choices=sorted(BattleDB.leaderboardOrders.keys()),
+        default='wins',
+        help='how the leaderboard is ranked',
+    )
+
+    return parser
+
+
+if __name__ == '__main__':
+    cmdline = build_cmdline().parse_args()
+    bdata = BattleDB(cmdline.db)
+
+    if cmdline.leaderboard:
+        leaderboard(bdata,order=cmdline.order)
@@ -9,10 +9,13 @@ import os
 import os.path
 import csv
 import json
+import random
 import re
 import sys
 from datetime import datetime
 import subprocess
+import threading
+import queue
 
 class Robocode:
     def __init__( self, arena_dir, robocode_dir,
@@ -21,7 +24,17 @@ class Robocode:
                   results = 'results',
                   recordings = 'recordings',
                   lib = 'libs',
+                  engine = False,
+                  recording = None,
               ):
+        '''
+        With <engine>, battles are run by a long-lived engine process in each
+        worker (see Robocode.Engine) rather than a new Robocode per battle.
+        <engine> may also be the engine's command (e.g. a stand-in).
+
+        <recording> is the RecordingPolicy (or its name, e.g. 'sampled:0.01')
+        deciding which battles are recorded; by default, all of them.
+        '''
         self.robocodeDir = robocode_dir
         self.arenaDir = arena_dir
         for prop,param in (('robots',robots),
@@ -34,6 +47,12 @@ class Robocode:
                 setattr(self,prop,os.path.join(self.arenaDir,param))
 
         self.lib = os.path.join(self.robocodeDir,lib)
+        self.useEngine = engine
+        if recording is None:
+            recording = RecordingPolicy()
+        elif isinstance(recording,str):
+            recording = RecordingPolicy.parse(recording)
+        self.recording = recording
 
     def __str__(self):
         return '[Robocode dir({robo_dir}) {nonstd}]'.format(
@@ -67,8 +86,256 @@ class Robocode:
             namePart = os.path.splitext(os.path.relpath(descriptor,self.robots))[0]
             return Robot('.'.join(namePart.split(os.sep)),self.robots)
             
-    def battle( self, id, competitors, properties ):
-        return Battle(self,id,competitors,properties)
+    def battle( self, id, competitors, properties, record=None ):
+        '''
+        With <record> True or False, the battle is (or isn't) recorded
+        whatever the recording policy.
+        '''
+        return Battle(self,id,competitors,properties,record=record)
+
+    def registry( self ):
+        '''
+        Return this process's registry of the robot directory.
+        '''
+        return RobotRegistry.get(self.robots)
+
+    def engine( self ):
+        '''
+        Return this process's engine (starting it the first time).
+        '''
+        key = (os.getpid(),self.robocodeDir,self.robots,str(self.useEngine))
+        engine = Engine.running.get(key)
+        if engine is None:
+            command = None if self.useEngine is True else self.useEngine
+            engine = Engine.running[key] = Engine(self,command)
+        return engine
+
+    def close( self ):
+        '''
+        Stop this process's engine, if it has one.
+        '''
+        key = (os.getpid(),self.robocodeDir,self.robots,str(self.useEngine))
+        engine = Engine.running.pop(key,None)
+        if engine is not None:
+            engine.close()
+
+
+#
+# Robocode.RecordingPolicy
+#
+
+class RecordingPolicy:
+    '''
+    Which battles are recorded (Robocode's -record), by mode:
+
+       never        none of them
+       always       all of them
+       sampled      a <fraction> of them, chosen by BattleID (so the same
+                    battles are chosen every time)
+       new-version  the first <firsts> battles of each robot version
+       rerun        only the battles rerun to be recorded
+
+    A battle rerun to be recorded (BattleDB.ScheduleRecording()) is
+    recorded whatever the mode.  Whether a battle is among a version's
+    first is up to the database (BattleDB.GetNewVersionBattles()).
+    '''
+    modes = ( 'never', 'always', 'sampled', 'new-version', 'rerun' )
+
+    def __init__( self, mode='always', fraction=0.01, firsts=10 ):
+        if mode not in RecordingPolicy.modes:
+            raise ValueError('Unknown recording policy: {0}'.format(mode))
+        self.mode = mode
+        self.fraction = fraction
+        self.firsts = firsts
+
+    @classmethod
+    def parse( cls, policy ):
+        '''
+        The RecordingPolicy named <policy>, as str() names it: a mode, with
+        the sampled fraction or the number of new-version battles (e.g.
+        'sampled:0.05', 'new-version:20').
+        '''
+        mode,_,value = policy.partition(':')
+        if not value:
+            return cls(mode)
+        elif mode == 'sampled':
+            return cls(mode,fraction=float(value))
+        elif mode == 'new-version':
+            return cls(mode,firsts=int(value))
+        raise ValueError('Unknown recording policy: {0}'.format(policy))
+
+    def __str__( self ):
+        if self.mode == 'sampled':
+            return '{0}:{1:g}'.format(self.mode,self.fraction)
+        elif self.mode == 'new-version':
+            return '{0}:{1}'.format(self.mode,self.firsts)
+        return self.mode
+
+    def record( self, id, rerun=False, newVersion=False ):
+        '''
+        Should battle <id> be recorded?  <rerun> if it was rerun to be
+        recorded; <newVersion> if it's among a robot version's first.
+        '''
+        if rerun or self.mode == 'always':
+            return True
+        elif self.mode == 'sampled':
+            return random.Random(id).random() < self.fraction
+        elif self.mode == 'new-version':
+            return newVersion
+        return False
+
+
+#
+# Robocode.Engine
+#
+
+class Engine:
+    '''
+    A long-lived Robocode engine process (engine/ArenaEngine.java, built on
+    Robocode's control API) that runs one battle after another, so the JVM
+    startup, Robocode initialization and robot repository loading happen
+    once per worker instead of once per battle.
+
+    It reads the same battle file and writes the same results (and record)
+    files as robocode.Robocode, and also replies with the results: one
+    tab-separated line per message over its stdin/stdout (see
+    ArenaEngine.java).  Anything that speaks the protocol can stand in for
+    it (see t/fake_engine.py).
+    '''
+    engineDir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'engine')
+
+    # Each process's engines, by (pid, robocode, robots, command)
+    running = {}
+
+    def __init__( self, robocode, command=None, log=None ):
+        '''
+        <command> starts the engine (default: ArenaEngine with <robocode>'s
+        Robocode).  Its stderr goes to the file <log> (default: nowhere).
+        '''
+        self.robocode = robocode
+        if command is None:
+            command = [
+                'java',
+                '-Xmx512M', # memory
+                '-Djava.awt.headless=true',
+                '-DROBOTPATH={0}'.format(robocode.robots),
+                '-cp', os.pathsep.join([ os.path.join(robocode.lib,'*'),
+                                         Engine.engineDir ]),
+                'ArenaEngine',
+                robocode.robocodeDir,
+            ]
+        self.command = command
+        self.log = log
+        self._log = None
+        self.process = None
+        self.version = None
+        self.starts = 0
+        self.battles = 0
+
+    def __str__( self ):
+        return '[Engine pid({pid}) version({version}) starts({starts}) battles({battles})]'.format(
+            pid = self.process.pid if self.process else None,
+            version = self.version,
+            starts = self.starts,
+            battles = self.battles,
+        )
+
+    def start( self, timeout=60 ):
+        '''
+        Start the engine and wait (up to <timeout> seconds) until it's ready.
+        '''
+        self.close()
+        if self.log:
+            self._log = open(self.log,'at')
+        self.process = subprocess.Popen(
+            self.command,
+            stdin = subprocess.PIPE,
+            stdout = subprocess.PIPE,
+            stderr = self._log or subprocess.DEVNULL,
+            cwd = self.robocode.robocodeDir,
+            universal_newlines = True,
+            bufsize = 1,
+        )
+        self.starts += 1
+        # A thread reads the replies, so waiting for one can time out.
+        self._replies = queue.Queue()
+        reader = threading.Thread(target=Engine._read,
+                                  args=(self.process.stdout,self._replies),
+                                  daemon=True)
+        reader.start()
+
+        kind,reply = self._reply(timeout)
+        if kind != 'ready':
+            self.close()
+            raise subprocess.CalledProcessError(
+                0,cmd=self.command,output='Engine not ready: {0}'.format(reply).encode())
+        self.version = reply.get('version')
+
+    @staticmethod
+    def _read( stdout, replies ):
+        for line in stdout:
+            replies.put(line)
+        replies.put(None)
+
+    def _reply( self, timeout ):
+        '''
+        Return the next (kind, reply), killing the engine if it takes more
+        than <timeout> seconds.
+        '''
+        try:
+            line = self._replies.get(timeout=timeout)
+        except queue.Empty:
+            self.close(kill=True)
+            raise subprocess.TimeoutExpired(self.command,timeout)
+        if line is None:
+            returncode = self.process.wait()
+            self.process = None
+            raise subprocess.CalledProcessError(
+                returncode,cmd=self.command,output=b'The engine exited')
+        kind,_,reply = line.rstrip('\n').partition('\t')
+        return kind,json.loads(reply) if reply else {}
+
+    def run( self, id, battleFile, resultFile, recordFile=None, timeout=60 ):
+        '''
+        Run a battle (starting the engine if need be), and return its
+        results: a dict with 'rounds' and 'results' (one dict of result
+        columns per robot, best first).
+
+        A battle that fails raises subprocess.CalledProcessError, and one
+        that takes more than <timeout> seconds subprocess.TimeoutExpired
+        (after which the engine is restarted for the next battle).
+        '''
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+
+        self.process.stdin.write('\t'.join([
+            'run', str(id), battleFile, resultFile, recordFile or '' ]) + '\n')
+        self.process.stdin.flush()
+        kind,reply = self._reply(timeout)
+        self.battles += 1
+        if kind != 'result' or reply.get('id') != str(id):
+            raise subprocess.CalledProcessError(
+                0,cmd=self.command,
+                output=reply.get('message','Unexpected reply: {0}'.format(reply)).encode())
+        return reply
+
+    def close( self, kill=False ):
+        if self.process is None:
+            return
+        try:
+            if kill:
+                self.process.kill()
+            else:
+                self.process.stdin.write('quit\n')
+                self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (OSError,subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+        if self._log:
+            self._log.close()
+            self._log = None
 
 
 
@@ -84,6 +351,8 @@ class RobotDescr:
             self.deps = [ dep.strip() for dep in robotIn ]
             self.deps = [ os.path.join(rdir,dep)
                           for dep in self.deps if dep ]
+        if not self.deps:
+            raise ValueError('No files in {0}'.format(robotFile))
         self.lastUpdated = \
             datetime.fromtimestamp(max([ os.stat(dep).st_mtime
                                          for dep in self.deps ]))
@@ -148,6 +417,105 @@ class Robot:
             deps = '\n  '.join(self.descriptor.deps),
         )
 
+#
+# Robocode.RobotRegistry
+#
+
+class RobotRegistry:
+    '''
+    The robots of a robot directory, each looked up (its file found, and
+    its descriptor read) once rather than for every battle.
+
+    A robot is looked up again only when one of the directories it was
+    found in (the robot directory, its package directory and those of its
+    files) has changed: one stat per directory.  Robots that are missing
+    or invalid are remembered the same way.
+
+    Replacing a robot's file in place doesn't change its directory, so
+    anything that needs the robot's current version (its lastUpdated)
+    should use Robocode.robot() instead.
+    '''
+    # Each process's registries, by robot directory
+    registries = {}
+
+    def __init__( self, robotRoot ):
+        self.robotRoot = robotRoot
+        # name: (Robot or the exception it raised, ((directory, mtime), ...))
+        self._robots = {}
+        self.lookups = 0
+        self.hits = 0
+
+    @classmethod
+    def get( cls, robotRoot ):
+        registry = cls.registries.get(robotRoot)
+        if registry is None:
+            registry = cls.registries[robotRoot] = cls(robotRoot)
+        return registry
+
+    def __str__( self ):
+        return '[RobotRegistry dir({dir}) robots({robots}) lookups({lookups}) hits({hits})]'.format(
+            dir = self.robotRoot,
+            robots = len(self._robots),
+            lookups = self.lookups,
+            hits = self.hits,
+        )
+
+    @staticmethod
+    def _mtime( directory ):
+        try:
+            return os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def robot( self, name ):
+        '''
+        Return the Robocode.Robot <name>, raising FileNotFoundError if it's
+        missing or ValueError if its descriptor is invalid.
+        '''
+        entry = self._robots.get(name)
+        if entry is not None and \
+           all( RobotRegistry._mtime(d) == mtime for d,mtime in entry[1] ):
+            self.hits += 1
+            robot = entry[0]
+        else:
+            self.lookups += 1
+            # before the lookup, so a change during it is seen next time
+            dirs = { self.robotRoot,
+                     os.path.join(self.robotRoot,*name.split('.')[:-1]) }
+            stamps = [ (d,RobotRegistry._mtime(d)) for d in dirs ]
+            try:
+                robot = Robot(name,self.robotRoot)
+                stamps += [ (d,RobotRegistry._mtime(d))
+                            for d in { os.path.dirname(dep)
+                                       for dep in robot.descriptor.deps } - dirs ]
+            except (OSError,ValueError) as e:
+                robot = e
+            self._robots[name] = (robot,tuple(stamps))
+
+        if isinstance(robot,Exception):
+            raise robot
+        return robot
+
+    def robots( self, names ):
+        '''
+        Return the Robocode.Robot of each of <names>.  If any of them is
+        missing or invalid, raise FileNotFoundError naming them all.
+        '''
+        robots = []
+        invalid = []
+        for name in names:
+            try:
+                robots.append(self.robot(name))
+            except (OSError,ValueError) as e:
+                invalid.append('{0} ({1})'.format(name,e))
+        if invalid:
+            raise FileNotFoundError('Invalid robots: {0}'.format(', '.join(invalid)))
+        return robots
+
+    def clear( self ):
+        self._robots.clear()
+
+
 #
 # Robocode.Result
 #
@@ -158,11 +526,13 @@ class Result:
     _name = re.compile(r'^[^:]+: (.*)\*?$')
     _rounds = re.compile(r'Results for (\d+) round(?:s)?',re.I)
 
-    def __init__( self, in_file ):
+    def __init__( self, in_file=None ):
         self.robots = []
         self.winner = ''
         self.rounds = 0
 
+        if in_file is None:
+            return
         with open(in_file,'rt') as in_tab_file:
             meta_head = in_tab_file.readline()
             self.rounds = int(re.sub(Result._rounds,r'\1',meta_head))
@@ -174,15 +544,33 @@ class Result:
             for row in in_tab:
                 data = { k:row[k] for k in row.keys() }
                 del(data['']) # strip the empty column
-                data['_Score'] = re.sub(Result._score,r'\1',data['Total Score'])
-                data['_Place'] = int(re.sub(Result._place,r'\1',data['Robot Name']))
-                # remove the 'devel' marker, if it exists
-                data['_Name'] = re.sub(Result._name,r'\1',data['Robot Name']).rstrip('*')
-                if data['_Place'] == 1:
-                    # remove the 'devel' marker, if it exists
-                    self.winner = data['_Name'].rstrip('*')
+                self._addRobot(data)
 
-                self.robots.append(data)
+    @classmethod
+    def fromEngine( cls, reply ):
+        '''
+        The results in an Engine.run() reply (as if read from its file).
+        '''
+        result = cls()
+        result.rounds = reply['rounds']
+        for row in reply['results']:
+            data = dict(row)
+            # as it appears in the file
+            data['Robot Name'] = '{0}: {1}'.format(data.pop('Rank'),
+                                                   data['Robot Name'])
+            result._addRobot(data)
+        return result
+
+    def _addRobot( self, data ):
+        data['_Score'] = re.sub(Result._score,r'\1',data['Total Score'])
+        data['_Place'] = int(re.sub(Result._place,r'\1',data['Robot Name']))
+        # remove the 'devel' marker, if it exists
+        data['_Name'] = re.sub(Result._name,r'\1',data['Robot Name']).rstrip('*')
+        if data['_Place'] == 1:
+            # remove the 'devel' marker, if it exists
+            self.winner = data['_Name'].rstrip('*')
+
+        self.robots.append(data)
 
     def __str__(self):
         return '[Result rounds({rounds}) winner({winner})]\n  {robots}'.format(
@@ -222,12 +610,16 @@ class Battle:
     robotProp = 'robocode.battle.selectedRobots'
     notOther = ( 'id', 'properties', 'competitors' )
 
-    def __init__( self, robocode, id, competitors, properties, **kwargs ):
+    def __init__( self, robocode, id, competitors, properties, record=None,
+                  **kwargs ):
         self.robocode = robocode # parent object (class Robocode)
         self.id = id
         self.competitors = competitors # robot names
         self.properties = properties
         self.battleFile = None
+        # None: the recording policy decides (see setRecording())
+        self.record = record
+        self.recording = None
 
         # allow overriding 
 
@@ -247,13 +639,38 @@ class Battle:
     def run( self ):
         '''
         Run the battle.
+
+        A battle with a missing or invalid competitor fails (as it would
+        in Robocode) without starting Robocode.
         '''
 
+        try:
+            self.robots()
+        except FileNotFoundError as e:
+            self.started = self.finished = datetime.now()
+            self.runTime = self.finished-self.started
+            self.error = True
+            print('Missing Robot: {0}'.format(e),file=sys.stderr)
+            raise subprocess.CalledProcessError(
+                0,
+                cmd=Battle.robotProp,
+                output=str(e).encode())
+
         self.createBattleFile()
         self.resultFile = os.path.join(self.robocode.results,
                                        '{0}.result'.format(self.id))
-        self.recordFile = os.path.join(self.robocode.recordings,
-                                       '{0}.br'.format(self.id))
+        if self.record is None:
+            self.setRecording()
+        if self.recording is None:
+            self.recording = str(self.robocode.recording)
+        if self.record:
+            self.recordFile = os.path.join(self.robocode.recordings,
+                                           '{0}.br'.format(self.id))
+        else:
+            self.recordFile = None
+
+        if self.robocode.useEngine:
+            return self.runEngine()
 
         command = [
             'java',
@@ -267,7 +684,7 @@ class Battle:
             '-cwd', self.robocode.robocodeDir,
             '-battle', self.battleFile,
             '-results', self.resultFile,
-            '-record', self.recordFile,
+        ] + ( [ '-record', self.recordFile ] if self.recordFile else [] ) + [
             '-nodisplay',
             '-nosound',
         ]
@@ -308,6 +725,48 @@ class Battle:
             raise e
             
 
+    def runEngine( self ):
+        '''
+        Run the (already written) battle on this process's engine.
+        '''
+        engine = self.robocode.engine()
+        try:
+            self.started = datetime.now()
+            reply = engine.run(self.id,self.battleFile,self.resultFile,
+                               self.recordFile)
+            self.finished = datetime.now()
+            self.runTime = self.finished-self.started
+            self.error = False
+            self.result = Result.fromEngine(reply)
+
+        except subprocess.TimeoutExpired as e:
+            # A timeout should not consider a valid battle run.
+            self.runTime = datetime.now()-self.started
+            self.finished = None
+            self.error = True
+
+        except subprocess.CalledProcessError as e:
+            self.finished = datetime.now()
+            self.runTime = self.finished-self.started
+            self.error = True
+            print('Battle returns error:\n{0}'.format(e.output.decode('ascii')))
+            raise e
+
+    def setRecording( self, rerun=False, newVersion=False ):
+        '''
+        Let the recording policy decide whether to record this battle (see
+        RecordingPolicy.record()).
+        '''
+        policy = self.robocode.recording
+        self.record = policy.record(self.id,rerun,newVersion)
+        self.recording = 'rerun' if rerun else str(policy)
+
+    def robots( self ):
+        '''
+        The competitors' Robocode.Robot (see RobotRegistry.robots()).
+        '''
+        return self.robocode.registry().robots(self.competitors)
+
     def createBattleFile( self ):
         self.battleFile = os.path.join(self.robocode.battles,
                                        '{0}.battle'.format(self.id))
@@ -318,8 +777,7 @@ class Battle:
             # Competitors
             print('{0}={1}'.format(
                 Battle.robotProp,
-                ','.join([ Robot(r,self.robocode.robots).battleName()
-                           for r in self.competitors ]),
+                ','.join([ r.battleName() for r in self.robots() ]),
             ), file=out_battle)
 
 
@@ -338,7 +796,9 @@ class Battle:
         #   Finished TEXT,
         #   Properties TEXT,
         #   Winner INTEGER,
-        #   Obsolete INTEGER
+        #   Obsolete INTEGER,
+        #   Recording TEXT,
+        #   Recorded INTEGER
 
         return {
             'BattleID'     :    self.id,
@@ -346,5 +806,7 @@ class Battle:
             'Finished'     :    self.finished.strftime('%Y-%m-%dT%H:%M:%S'),
             'Properties'   :    json.dumps(self.properties,sort_keys=True),
             'Winner'       :    self.result.winner,
+            'Recording'    :    self.recording,
+            'Recorded'     :    int(bool(self.record)),
         }
             
@@ -0,0 +1,209 @@
+/*
+ * A long-lived Robocode engine: one JVM (and one robot repository) runs
+ * battle after battle, instead of starting robocode.Robocode for each one.
+ *
+ * It is driven by Robocode.Engine (lib/Robocode.py) over stdin/stdout, one
+ * line per message:
+ *
+ *   -> ready<TAB>{"version": ...}
+ *   <- run<TAB><id><TAB><battle file><TAB><results file><TAB><record file, or empty>
+ *   -> result<TAB>{"id": ..., "rounds": N, "results": [ {column: value}, ... ]}
+ *   -> error<TAB>{"id": ..., "message": ...}
+ *   <- quit            (or end of input)
+ *
+ * The battle, results and record files are the same ones robocode.Robocode
+ * reads and writes (-battle, -results, -record); the result columns are
+ * those of the results file (see BattleResultsTableModel), best first.
+ * Anything Robocode or the robots print goes to stderr.
+ *
+ * Build (bin/setup.py does this):
+ *   javac -cp "<robocode>/libs/*" -d lib/engine lib/engine/ArenaEngine.java
+ * Run:
+ *   java -DROBOTPATH=<robots> -cp "<robocode>/libs/*:lib/engine" ArenaEngine <robocode>
+ */
+
+import java.io.BufferedReader;
+import java.io.File;
+import java.io.FileInputStream;
+import java.io.FileOutputStream;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.util.ArrayList;
+import java.util.List;
+
+import net.sf.robocode.battle.BattleProperties;
+import net.sf.robocode.battle.BattleResultsTableModel;
+import net.sf.robocode.battle.IBattleManagerBase;
+import net.sf.robocode.core.ContainerBase;
+import net.sf.robocode.recording.BattleRecordFormat;
+import net.sf.robocode.recording.IRecordManager;
+import net.sf.robocode.serialization.SerializableOptions;
+import robocode.control.BattleSpecification;
+import robocode.control.BattlefieldSpecification;
+import robocode.control.RobocodeEngine;
+import robocode.control.RobotSpecification;
+import robocode.control.events.BattleAdaptor;
+import robocode.control.events.BattleCompletedEvent;
+import robocode.control.events.BattleErrorEvent;
+
+public class ArenaEngine extends BattleAdaptor {
+	private final PrintStream out;
+	private final RobocodeEngine engine;
+	private BattleCompletedEvent completed;
+	private final List<String> errors = new ArrayList<String>();
+
+	public ArenaEngine(File robocodeHome, PrintStream out) {
+		this.out = out;
+		RobocodeEngine.setLogMessagesEnabled(false);
+		engine = new RobocodeEngine(robocodeHome);
+		engine.addBattleListener(this);
+	}
+
+	@Override
+	public void onBattleCompleted(BattleCompletedEvent event) {
+		completed = event;
+	}
+
+	@Override
+	public void onBattleError(BattleErrorEvent event) {
+		errors.add(event.getError());
+	}
+
+	public void ready() {
+		out.println("ready\t{\"version\": " + quote(engine.getVersion()) + "}");
+	}
+
+	/**
+	 * Run one battle and report its results (or what went wrong).
+	 */
+	public void run(String id, String battleFile, String resultsFile, String recordFile) {
+		completed = null;
+		errors.clear();
+		try {
+			BattleProperties properties = new BattleProperties();
+			FileInputStream in = new FileInputStream(battleFile);
+			try {
+				properties.load(in);
+			} finally {
+				in.close();
+			}
+
+			String selected = properties.getSelectedRobots();
+			RobotSpecification[] robots = engine.getLocalRepository(selected);
+			if (robots.length != selected.split(",").length) {
+				error(id, "Can't find all of '" + selected + "'");
+				return;
+			}
+
+			BattleSpecification spec = new BattleSpecification(
+					new BattlefieldSpecification(properties.getBattlefieldWidth(), properties.getBattlefieldHeight()),
+					properties.getNumRounds(), properties.getInactivityTime(), properties.getGunCoolingRate(),
+					properties.getSentryBorderSize(), properties.getHideEnemyNames(), robots);
+			boolean record = recordFile != null && recordFile.length() > 0;
+			ContainerBase.getComponent(IBattleManagerBase.class).startNewBattle(spec, null, true, record);
+
+			if (completed == null) {
+				error(id, errors.isEmpty() ? "The battle did not complete" : String.join("\n", errors));
+				return;
+			}
+			if (record) {
+				ContainerBase.getComponent(IRecordManager.class).saveRecord(recordFile, BattleRecordFormat.BINARY_ZIP,
+						new SerializableOptions(false));
+			}
+			BattleResultsTableModel table = new BattleResultsTableModel(completed.getSortedResults(),
+					completed.getBattleRules().getNumRounds());
+			PrintStream results = new PrintStream(new FileOutputStream(resultsFile));
+			try {
+				table.print(results);
+			} finally {
+				results.close();
+			}
+			result(id, table, completed.getBattleRules().getNumRounds());
+		} catch (Exception e) {
+			error(id, e.toString());
+		}
+	}
+
+	private void result(String id, BattleResultsTableModel table, int rounds) {
+		StringBuilder reply = new StringBuilder();
+		reply.append("result\t{\"id\": ").append(quote(id));
+		reply.append(", \"rounds\": ").append(rounds);
+		reply.append(", \"results\": [");
+		for (int row = 0; row < table.getRowCount(); row++) {
+			reply.append(row == 0 ? "{" : ", {");
+			for (int col = 0; col < table.getColumnCount(); col++) {
+				if (col > 0) {
+					reply.append(", ");
+				}
+				reply.append(quote(table.getColumnName(col).trim())).append(": ");
+				reply.append(quote(String.valueOf(table.getValueAt(row, col))));
+			}
+			reply.append("}");
+		}
+		reply.append("]}");
+		out.println(reply);
+	}
+
+	private void error(String id, String message) {
+		out.println("error\t{\"id\": " + quote(id) + ", \"message\": " + quote(message) + "}");
+	}
+
+	private static String quote(String s) {
+		StringBuilder quoted = new StringBuilder("\"");
+		for (char c : s.toCharArray()) {
+			switch (c) {
+			case '"':
+				quoted.append("\\\"");
+				break;
+
+			case '\\':
+				quoted.append("\\\\");
+				break;
+
+			case '\n':
+				quoted.append("\\n");
+				break;
+
+			case '\t':
+				quoted.append("\\t");
+				break;
+
+			default:
+				if (c < 0x20 || c > 0x7e) {
+					quoted.append(String.format("\\u%04x", (int) c));
+				} else {
+					quoted.append(c);
+				}
+			}
+		}
+		return quoted.append('"').toString();
+	}
+
+	public void close() {
+		engine.close();
+	}
+
+	public static void main(String[] args) throws Exception {
+		// Keep stdout for the replies: everything else goes to stderr.
+		PrintStream out = new PrintStream(System.out, true, "US-ASCII");
+		System.setOut(System.err);
+
+		ArenaEngine arena = new ArenaEngine(new File(args.length > 0 ? args[0] : "."), out);
+		arena.ready();
+
+		BufferedReader in = new BufferedReader(new InputStreamReader(System.in, "UTF-8"));
+		String line;
+		while ((line = in.readLine()) != null) {
+			String[] command = line.split("\t", -1);
+			if (command[0].equals("quit")) {
+				break;
+			} else if (command[0].equals("run") && command.length == 5) {
+				arena.run(command[1], command[2], command[3], command[4]);
+			} else {
+				arena.error("", "Unknown command: " + line);
+			}
+		}
+		arena.close();
+		System.exit(0);
+	}
+}
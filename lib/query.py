@@ -3,8 +3,11 @@
 import argparse
 import sqlite3
 import sys
+import os
 import csv
 import json
+import time
+import tempfile
 
 def build_cmdline():
     parser = argparse.ArgumentParser(
@@ -35,10 +38,52 @@ def build_cmdline():
         action='store_const',
         const='json',
     )
+    outtype_group.add_argument(
+        '--ndjson',
+        action='store_const',
+        const='ndjson',
+        help='one JSON object per line',
+    )
+
+    parser.add_argument(
+        '--read-only', '-r',
+        action='store_true',
+        help='open the database read-only',
+    )
+    parser.add_argument(
+        '--snapshot', '-s',
+        nargs='?',
+        choices=['memory','temp'],
+        const='memory',
+        help='query a point-in-time copy of the database (in memory, or in a temporary file), so that a long query never holds up the live one',
+    )
+    parser.add_argument(
+        '--batch', '-b',
+        type=int,
+        default=1000,
+        help='the number of records fetched at a time',
+    )
 
     return parser
 
 
+def snapshot( source, where ):
+    '''
+    Copy the database <source> (a connection) with the online backup API,
+    in a single step so the copy is consistent. Return the connection to
+    the copy (and the temporary file, if any).
+    '''
+    tmp = None
+    if where == 'temp':
+        fd,tmp = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        copy = sqlite3.connect(tmp)
+    else:
+        copy = sqlite3.connect(':memory:')
+    source.backup(copy)
+    return copy,tmp
+
+
 if __name__ == '__main__':
     cmdline = build_cmdline().parse_args()
 
@@ -47,29 +92,63 @@ if __name__ == '__main__':
         output_type = cmdline.csv
     elif cmdline.json:
         output_type = cmdline.json
+    elif cmdline.ndjson:
+        output_type = cmdline.ndjson
 
     print('Output Type: {0}'.format(output_type),file=sys.stderr)
-    print('DB: {0}\nQuery: {1}\n'.format(cmdline.db,cmdline.query,file=sys.stderr))
-
+    print('DB: {0}\nQuery: {1}\n'.format(cmdline.db,cmdline.query),file=sys.stderr)
 
-    db = sqlite3.connect(cmdline.db)
+    start = time.perf_counter()
+    if cmdline.read_only or cmdline.snapshot:
+        db = sqlite3.connect('file:{0}?mode=ro'.format(cmdline.db),uri=True)
+    else:
+        db = sqlite3.connect(cmdline.db)
+    tmp = None
+    if cmdline.snapshot:
+        live = db
+        db,tmp = snapshot(live,cmdline.snapshot)
+        live.close()
     db.row_factory = sqlite3.Row
+    opened = time.perf_counter()
 
     header = None
     csv_out = None
     count = 0
+    first = None
     if output_type == 'csv':
         csv_out = csv.writer(sys.stdout)
-    for record in db.execute(cmdline.query):
-        count += 1
-        if output_type == 'csv':
-            if header is None:
-                header = record.keys()
-                csv_out.writerow(header)
-            csv_out.writerow([record[k] for k in header])
-        elif output_type == 'json':
-            print(json.dumps({k:record[k] for k in record.keys()}, indent=4, sort_keys=True))
-        else:
-            raise Exception('Unknown output type {0}'.format(output_type))
+    try:
+        cursor = db.execute(cmdline.query)
+        while True:
+            records = cursor.fetchmany(cmdline.batch)
+            if first is None:
+                first = time.perf_counter()
+            if not records:
+                break
+            for record in records:
+                count += 1
+                if output_type == 'csv':
+                    if header is None:
+                        header = record.keys()
+                        csv_out.writerow(header)
+                    csv_out.writerow([record[k] for k in header])
+                elif output_type == 'json':
+                    print(json.dumps({k:record[k] for k in record.keys()}, indent=4, sort_keys=True))
+                elif output_type == 'ndjson':
+                    print(json.dumps({k:record[k] for k in record.keys()}, sort_keys=True))
+                else:
+                    raise Exception('Unknown output type {0}'.format(output_type))
+    finally:
+        db.close()
+        if tmp is not None:
+            os.remove(tmp)
+    finished = time.perf_counter()
 
     print('\n{0} records returned.'.format(count),file=sys.stderr)
+    print('{0}: {1:.3f}s, first records: {2:.3f}s, total query: {3:.3f}s ({4:.0f} records/s)'.format(
+        'snapshot' if cmdline.snapshot else 'open',
+        opened-start,
+        first-opened,
+        finished-opened,
+        count/max(finished-opened,1e-9),
+    ),file=sys.stderr)
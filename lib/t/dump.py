@@ -10,11 +10,51 @@ import argparse
 parser = argparse.ArgumentParser()
 parser.add_argument('--csv',action='store_true')
 parser.add_argument('--json',action='store_true')
+parser.add_argument('--ndjson',action='store_true')
+parser.add_argument('--table','-t',action='append',dest='tables',
+                    choices=BattleDB.exportTables,
+                    help='only dump this table (repeatable)')
+parser.add_argument('--outdir','-o',type=str,
+                    help='write one file per table into this directory')
+parser.add_argument('--columns','-c',action='append',default=[],
+                    metavar='TABLE:COL,COL',
+                    help='only export these columns of TABLE (with --outdir)')
+parser.add_argument('--since',type=str,
+                    help='only rows from this time on (with --outdir)')
+parser.add_argument('--until',type=str,
+                    help='only rows from before this time (with --outdir)')
+parser.add_argument('--gzip','-z',action='store_true',
+                    help='compress the files (with --outdir)')
+parser.add_argument('--serial',action='store_true',
+                    help='export one table at a time (with --outdir)')
+parser.add_argument('--chunk',type=int,default=1000,
+                    help='rows fetched at a time')
 parser.add_argument('db',type=str)
 cmdline = parser.parse_args()
 
 bdata = BattleDB(cmdline.db)
 if cmdline.json:
-    bdata.dump(otype='json')
+    otype = 'json'
+elif cmdline.ndjson:
+    otype = 'ndjson'
 else:
-    bdata.dump(otype='csv')
+    otype = 'csv'
+
+if cmdline.outdir:
+    columns = {}
+    for spec in cmdline.columns:
+        table,cols = spec.split(':',1)
+        columns[table] = cols.split(',')
+    exported = bdata.export(cmdline.outdir,
+                            tables = cmdline.tables,
+                            columns = columns,
+                            since = cmdline.since,
+                            until = cmdline.until,
+                            otype = otype,
+                            compress = cmdline.gzip,
+                            parallel = not cmdline.serial,
+                            chunkSize = cmdline.chunk)
+    for table,(path,rows) in exported.items():
+        print('{0}: {1} rows -> {2}'.format(table,rows,path),file=sys.stderr)
+else:
+    bdata.dump(otype=otype,tables=cmdline.tables,chunkSize=cmdline.chunk)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+'''
+A stand-in for the Robocode engine (engine/ArenaEngine.java) that speaks
+the same protocol, so Robocode.Engine and everything that dispatches to
+it can be tested without a JVM:
+
+   Robocode.Robocode(arena_dir,robocode_dir,
+                     engine=[sys.executable,'t/fake_engine.py'])
+
+Every battle has a random winner.  It writes the same results file (and,
+if asked, a record file) as Robocode.  Battle properties control it:
+
+   fake.sleep=<seconds>  take that long to run the battle
+   fake.fail=<message>   reply with an error instead
+   fake.turns=<turns>    the turns per round in the record file (100)
+'''
+
+import json
+import random
+import sys
+import time
+
+def readBattle( battleFile ):
+    '''
+    Read a .battle (Java properties) file.
+    '''
+    properties = {}
+    with open(battleFile,'rt') as battle:
+        for line in battle:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                key,_,value = line.partition('=')
+                properties[key.strip()] = value.strip()
+    return properties
+
+def place( n ):
+    return '{0}{1}'.format(n, 'th' if 3 < n < 20 else
+                              { 1:'st', 2:'nd', 3:'rd' }.get(n%10,'th'))
+
+columns = ( 'Robot Name', 'Total Score', 'Survival', 'Surv Bonus',
+            'Bullet Dmg', 'Bullet Bonus', 'Ram Dmg * 2', 'Ram Bonus',
+            '1sts', '2nds', '3rds' )
+
+def runBattle( id, battleFile, resultFile, recordFile ):
+    properties = readBattle(battleFile)
+    if 'fake.fail' in properties:
+        return 'error', { 'id':id, 'message':properties['fake.fail'] }
+    time.sleep(float(properties.get('fake.sleep',0)))
+
+    rounds = int(properties.get('robocode.battle.numRounds',10))
+    robots = properties['robocode.battle.selectedRobots'].split(',')
+    random.shuffle(robots)
+    scores = sorted(( random.randint(0,5000) for r in robots ),reverse=True)
+    total = sum(scores) or 1
+    rows = []
+    for rank,(robot,score) in enumerate(zip(robots,scores)):
+        rows.append({
+            'Rank'         : place(rank+1),
+            'Robot Name'   : robot,
+            'Total Score'  : '{0} ({1}%)'.format(score,int(100*score/total+0.5)),
+            'Survival'     : str(score//2),
+            'Surv Bonus'   : str(score//10),
+            'Bullet Dmg'   : str(score//4),
+            'Bullet Bonus' : str(score//20),
+            'Ram Dmg * 2'  : '0',
+            'Ram Bonus'    : '0',
+            '1sts'         : str(rounds if rank == 0 else 0),
+            '2nds'         : str(rounds if rank == 1 else 0),
+            '3rds'         : '0',
+        })
+
+    # as BattleResultsTableModel.print() writes it
+    with open(resultFile,'wt') as results:
+        print('Results for {0} rounds'.format(rounds),file=results)
+        print(''.join( '{0}\t'.format(c) for c in columns ),file=results)
+        for row in rows:
+            print('{0}: '.format(row['Rank']) +
+                  ''.join( '{0}\t'.format(row[c]) for c in columns ),file=results)
+    if recordFile:
+        # every robot's position, every turn
+        with open(recordFile,'wt') as record:
+            print('fake record of battle {0}'.format(id),file=record)
+            for round in range(rounds):
+                for turn in range(int(properties.get('fake.turns',100))):
+                    print('{0} {1} '.format(round,turn) +
+                          ' '.join( '{0}:{1},{2}'.format(robot,random.randint(0,800),
+                                                         random.randint(0,600))
+                                    for robot in robots ),file=record)
+
+    return 'result', { 'id':id, 'rounds':rounds, 'results':rows }
+
+
+if __name__ == '__main__':
+    out = sys.stdout
+    sys.stdout = sys.stderr
+    print('ready\t{0}'.format(json.dumps({ 'version':'fake' })),file=out,flush=True)
+    for line in sys.stdin:
+        command = line.rstrip('\n').split('\t')
+        if command[0] == 'quit':
+            break
+        elif command[0] == 'run' and len(command) == 5:
+            kind,reply = runBattle(*command[1:])
+        else:
+            kind,reply = 'error', { 'id':'', 'message':'Unknown command: {0}'.format(line) }
+        print('{0}\t{1}'.format(kind,json.dumps(reply)),file=out,flush=True)
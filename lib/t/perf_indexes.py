@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+'''
+Time the common BattleDB queries against an unindexed (user_version 0)
+database, migrate it in place, and time them again.
+'''
+
+import sys
+sys.path.append('..')
+
+import sqlite3
+import argparse
+import os, os.path
+import random
+import time
+
+from BattleData import BattleDB
+
+def build_cmdline():
+    parser = argparse.ArgumentParser(
+        'query times before/after the BattleDB schema migrations')
+
+    parser.add_argument(
+        '--db',
+        type=str,
+        default='perf_indexes.sqlite3',
+        help='the scratch database (it is recreated)',
+    )
+    parser.add_argument(
+        '--battles', '-b',
+        type=int,
+        default=1000000,
+        help='the number of battles to create',
+    )
+    parser.add_argument(
+        '--robots',
+        type=int,
+        default=1000,
+        help='the number of robots to create',
+    )
+    parser.add_argument(
+        '--repeat', '-r',
+        type=int,
+        default=20,
+        help='the number of times each query is run',
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+    )
+
+    return parser
+
+
+def populate( db_file, num_robots, num_battles ):
+    '''
+    Create the original (unindexed) schema and fill it: almost every battle
+    is finished, with a few scheduled, running, and obsolete ones.
+    '''
+    conn = sqlite3.connect(db_file, isolation_level = None)
+    for statement in BattleDB.schema:
+        conn.execute(statement)
+
+    conn.execute('BEGIN')
+    conn.executemany('''
+        INSERT INTO Robots (RobotID,Name,LastUpdated)
+        VALUES (?,?,'2014-10-20T09:30:00')
+    ''', [ (r,'nonex.TestRobot.{0:05d}'.format(r))
+           for r in range(1,num_robots+1) ])
+
+    def battles():
+        for b in range(1,num_battles+1):
+            x = random.random()
+            if x < 0.01:
+                yield (b,'scheduled',0)
+            elif x < 0.02:
+                yield (b,'running',0)
+            elif x < 0.10:
+                yield (b,'finished',1)
+            else:
+                yield (b,'finished',0)
+    conn.executemany('''
+        INSERT INTO Battles
+        (BattleID,Priority,State,Started,Finished,Properties,Winner,Obsolete)
+        VALUES (?,-1,?,'','','{}',-1,?)
+    ''', battles())
+
+    def battleRobots():
+        for b in range(1,num_battles+1):
+            for r in random.sample(range(1,num_robots+1),2):
+                yield (b,r)
+    conn.executemany('''
+        INSERT INTO BattleRobots
+        (BattleID,RobotID,RobotUpdated,Score,Results)
+        VALUES (?,?,'',-1,'')
+    ''', battleRobots())
+    conn.execute('COMMIT')
+    conn.close()
+
+
+def timeQueries( db_file, num_robots, repeat ):
+    '''
+    Return { description: seconds per query }.
+    '''
+    conn = sqlite3.connect(db_file, isolation_level = None)
+
+    queries = [
+        ('scheduled battles',
+         'SELECT BattleID FROM Battles WHERE State=? AND Obsolete=?',
+         lambda: ['scheduled',0]),
+        ('finished, obsolete battles',
+         'SELECT BattleID FROM Battles WHERE State=? AND Obsolete=?',
+         lambda: ['finished',1]),
+        ('battles of a robot',
+         'SELECT BattleID FROM Battles WHERE BattleID IN ( SELECT BattleID FROM BattleRobots WHERE RobotID=? )',
+         lambda: [random.randint(1,num_robots)]),
+        ('running battles of a robot',
+         'SELECT BattleID FROM Battles WHERE BattleID IN ( SELECT BattleID FROM BattleRobots WHERE RobotID=? ) AND State=?',
+         lambda: [random.randint(1,num_robots),'running']),
+        ('robot by name',
+         'SELECT * FROM Robots WHERE Name=?',
+         lambda: ['nonex.TestRobot.{0:05d}'.format(random.randint(1,num_robots))]),
+    ]
+
+    times = {}
+    for descr,query,params in queries:
+        start = time.perf_counter()
+        for i in range(repeat):
+            conn.execute(query,params()).fetchall()
+        times[descr] = (time.perf_counter()-start)/repeat
+
+    conn.close()
+    return times
+
+
+if __name__ == '__main__':
+    cmdline = build_cmdline().parse_args()
+    random.seed(cmdline.seed)
+
+    if os.path.isfile(cmdline.db):
+        os.remove(cmdline.db)
+
+    print('Populating {0}: {1} robots, {2} battles...'.format(
+        cmdline.db,cmdline.robots,cmdline.battles))
+    start = time.perf_counter()
+    populate(cmdline.db,cmdline.robots,cmdline.battles)
+    print('  {0:.1f}s'.format(time.perf_counter()-start))
+
+    before = timeQueries(cmdline.db,cmdline.robots,cmdline.repeat)
+
+    print('Migrating...')
+    start = time.perf_counter()
+    bdata = BattleDB(cmdline.db)
+    bdata.connect()
+    print('  version {0}: {1:.1f}s'.format(
+        bdata.schemaVersion(),time.perf_counter()-start))
+    del(bdata)
+
+    after = timeQueries(cmdline.db,cmdline.robots,cmdline.repeat)
+
+    print('\n{0:<30} {1:>12} {2:>12} {3:>9}'.format(
+        'query','before (ms)','after (ms)','speedup'))
+    for descr in before.keys():
+        print('{0:<30} {1:>12.3f} {2:>12.3f} {3:>8.0f}x'.format(
+            descr,
+            before[descr]*1000,
+            after[descr]*1000,
+            before[descr]/max(after[descr],1e-9),
+        ))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+'''
+Time parsing a directory of results files with Robocode.Result and with
+Ingest.parseResult, and ingesting them all into a scratch database.
+'''
+
+import sys
+sys.path.append('..')
+
+import argparse
+import os, os.path
+import shutil
+import tempfile
+import time
+
+from BattleData import BattleDB
+import Ingest
+import Robocode
+import fake_engine
+
+def build_cmdline():
+    parser = argparse.ArgumentParser(
+        'results file parsing and ingestion time')
+
+    parser.add_argument(
+        '--battles', '-b',
+        type=int,
+        default=20000,
+        help='the number of results files',
+    )
+    parser.add_argument(
+        '--robots',
+        type=int,
+        default=100,
+        help='the number of robots',
+    )
+    parser.add_argument(
+        '--workers', '-w',
+        type=int,
+        default=None,
+        help='the number of parsing processes (default: one per CPU)',
+    )
+
+    return parser
+
+
+if __name__ == '__main__':
+    cmdline = build_cmdline().parse_args()
+
+    root = tempfile.mkdtemp(prefix='perf_ingest.')
+    try:
+        names = [ 'nonex.TestRobot.{0:04d}'.format(i) for i in range(cmdline.robots) ]
+        battleFile = os.path.join(root,'battle')
+        results = os.path.join(root,'results')
+        os.makedirs(results)
+        for id in range(1,cmdline.battles+1):
+            with open(battleFile,'wt') as out:
+                print('robocode.battle.numRounds=10',file=out)
+                print('robocode.battle.selectedRobots={0},{1}'.format(
+                    names[id%len(names)],names[(id*7+1)%len(names)]),file=out)
+            fake_engine.runBattle(str(id),battleFile,
+                                  os.path.join(results,'{0}.result'.format(id)),None)
+        files = [ os.path.join(results,f) for f in os.listdir(results) ]
+
+        print('{0} results files\n'.format(len(files)))
+        for name,parse in ( ('Robocode.Result',Robocode.Result),
+                            ('Ingest.parseResult',Ingest.parseResult) ):
+            start = time.perf_counter()
+            for path in files:
+                parse(path)
+            seconds = time.perf_counter() - start
+            print('{0:<24} {1:>8.2f}s {2:>10.0f} files/s'.format(
+                name,seconds,len(files)/seconds))
+
+        bdata = BattleDB(os.path.join(root,'ingest.sqlite3'))
+        stats = Ingest.Ingester(bdata,results,workers=cmdline.workers,progress=None).run()
+        assert stats['created'] == len(files), stats
+        print('{0:<24} {1:>8.2f}s {2:>10.0f} files/s'.format(
+            'Ingester',stats['seconds'],len(files)/stats['seconds']))
+    finally:
+        shutil.rmtree(root)
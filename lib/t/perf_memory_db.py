@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+'''
+Time a simulated tournament -- schedule, claim and record every battle --
+against the in-memory backend (MemoryBattleData) and, optionally, the
+SQLite one.
+'''
+
+import sys
+sys.path.append('..')
+
+import argparse
+import json
+import os, os.path
+import random
+import time
+
+from BattleData import BattleDB
+from MemoryBattleData import MemoryBattleDB
+
+def build_cmdline():
+    parser = argparse.ArgumentParser(
+        'simulated tournament time')
+
+    parser.add_argument(
+        '--battles', '-b',
+        type=int,
+        default=1000000,
+        help='the number of battles to run',
+    )
+    parser.add_argument(
+        '--robots',
+        type=int,
+        default=1000,
+        help='the number of robots',
+    )
+    parser.add_argument(
+        '--claim',
+        type=int,
+        default=1000,
+        help='the number of battles claimed at a time',
+    )
+    parser.add_argument(
+        '--sqlite',
+        type=str,
+        default=None,
+        metavar='DB',
+        help='also run it against this (scratch, recreated) SQLite database',
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+    )
+
+    return parser
+
+
+def simulate( bdata, cmdline ):
+    '''
+    Return the seconds taken by each step.
+    '''
+    rng = random.Random(cmdline.seed)
+    times = {}
+
+    robots = [ bdata.UpdateRobot(lastUpdated='2014-10-20T09:30:00',
+                                 name='nonex.TestRobot.{0:04d}'.format(i))
+               for i in range(cmdline.robots) ]
+    pairs = [ rng.sample(robots,2) for i in range(cmdline.battles) ]
+    start = time.perf_counter()
+    bdata.ScheduleBattles(pairs)
+    times['schedule'] = time.perf_counter() - start
+
+    times['claim'] = times['record'] = 0.0
+    while True:
+        start = time.perf_counter()
+        battles = bdata.ClaimBattles(cmdline.claim)
+        times['claim'] += time.perf_counter() - start
+        if not battles:
+            break
+        results = []
+        for battle in battles:
+            names = [ r.Name for r in battle.competitors() ]
+            rng.shuffle(names)
+            results.append((
+                battle,
+                { 'Started'    : '2014-10-20T10:00:00',
+                  'Finished'   : '2014-10-20T10:01:00',
+                  'Winner'     : names[0],
+                  'Properties' : battle.Properties },
+                { name: { 'Score'   : 100-place,
+                          'Results' : json.dumps({ '_Place':place+1 }) }
+                  for place,name in enumerate(names) },
+            ))
+        start = time.perf_counter()
+        bdata.BattlesCompleted(results)
+        times['record'] += time.perf_counter() - start
+
+    start = time.perf_counter()
+    # every version is replaced: all of the battles become obsolete
+    for robot in robots:
+        bdata.UpdateRobot(lastUpdated='2014-10-21T09:30:00',id=robot.RobotID)
+    times['obsolesce'] = time.perf_counter() - start
+
+    assert len(bdata.GetObsoleteBattles()) == cmdline.battles
+    return times
+
+
+if __name__ == '__main__':
+    cmdline = build_cmdline().parse_args()
+
+    backends = [ MemoryBattleDB() ]
+    if cmdline.sqlite is not None:
+        if os.path.isfile(cmdline.sqlite):
+            os.remove(cmdline.sqlite)
+        backends.append(BattleDB(cmdline.sqlite))
+
+    print('{0} battles between {1} robots\n'.format(cmdline.battles,cmdline.robots))
+    steps = ( 'schedule', 'claim', 'record', 'obsolesce' )
+    print('{0:<48} '.format('backend') +
+          ' '.join( '{0:>10}'.format(step) for step in steps ) +
+          ' {0:>10}'.format('total (s)'))
+    for bdata in backends:
+        times = simulate(bdata,cmdline)
+        print('{0:<48} '.format(str(bdata)) +
+              ' '.join( '{0:>10.2f}'.format(times[step]) for step in steps ) +
+              ' {0:>10.2f}'.format(sum(times.values())))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+'''
+Time a full Bradley-Terry refit (Rating.py) over a large database of
+one-on-one battles between robots of known strengths.
+'''
+
+import sys
+sys.path.append('..')
+
+import argparse
+import os, os.path
+import random
+import time
+
+import numpy
+
+from BattleData import BattleDB
+import Rating
+
+def build_cmdline():
+    parser = argparse.ArgumentParser(
+        'Bradley-Terry refit time')
+
+    parser.add_argument(
+        '--db',
+        type=str,
+        default='perf_rating.sqlite3',
+        help='the scratch database (it is recreated)',
+    )
+    parser.add_argument(
+        '--battles', '-b',
+        type=int,
+        default=1000000,
+        help='the number of battles to create',
+    )
+    parser.add_argument(
+        '--robots',
+        type=int,
+        default=1000,
+        help='the number of robots to create',
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+    )
+
+    return parser
+
+
+def populate( bdata, num_robots, num_battles ):
+    '''
+    Fill the database with finished battles; return the robots' true
+      strengths (log p).
+    '''
+    strength = numpy.random.normal(0.0,1.0,num_robots+1)
+    with bdata.transaction() as conn:
+        conn.executemany('''
+            INSERT INTO Robots (RobotID,Name,LastUpdated)
+            VALUES (?,?,'2014-10-20T09:30:00')
+        ''', [ (r,'nonex.TestRobot.{0:05d}'.format(r))
+               for r in range(1,num_robots+1) ])
+        conn.executemany('''
+            INSERT INTO Battles
+            (BattleID,Priority,State,Started,Finished,Properties,Winner,Obsolete)
+            VALUES (?,-1,'finished','','','{}',-1,0)
+        ''', [ (b,) for b in range(1,num_battles+1) ])
+
+        def battleRobots():
+            for b in range(1,num_battles+1):
+                r1,r2 = random.sample(range(1,num_robots+1),2)
+                p1 = 1.0/(1.0 + numpy.exp(strength[r2]-strength[r1]))
+                first = 1 if random.random() < p1 else 2
+                yield (b,r1,first)
+                yield (b,r2,3-first)
+        conn.executemany('''
+            INSERT INTO BattleRobots
+            (BattleID,RobotID,RobotUpdated,Score,Results,Place)
+            VALUES (?,?,'2014-10-20T09:30:00',0,'',?)
+        ''', battleRobots())
+    return strength
+
+
+if __name__ == '__main__':
+    cmdline = build_cmdline().parse_args()
+    random.seed(cmdline.seed)
+    numpy.random.seed(cmdline.seed)
+
+    if os.path.isfile(cmdline.db):
+        os.remove(cmdline.db)
+    bdata = BattleDB(cmdline.db)
+
+    print('Populating {0}: {1} robots, {2} battles...'.format(
+        cmdline.db,cmdline.robots,cmdline.battles))
+    start = time.perf_counter()
+    strength = populate(bdata,cmdline.robots,cmdline.battles)
+    print('  {0:.1f}s'.format(time.perf_counter()-start))
+
+    bt = Rating.BradleyTerry()
+    start = time.perf_counter()
+    versions,winners,losers = bt.outcomes(bdata)
+    loaded = time.perf_counter()
+    p = bt.fit(len(versions),winners,losers)
+    fitted = time.perf_counter()
+
+    print('\n{0:<24} {1:>8.2f}s'.format('load outcomes',loaded-start))
+    print('{0:<24} {1:>8.2f}s ({2} iterations)'.format(
+        'fit',fitted-loaded,bt.iterations))
+
+    start = time.perf_counter()
+    bt.refit(bdata)
+    print('{0:<24} {1:>8.2f}s'.format('refit (and store)',
+                                      time.perf_counter()-start))
+
+    true = numpy.array([ strength[robotID] for robotID,updated in versions ])
+    print('\ncorrelation with the true strengths: {0:.3f}'.format(
+        numpy.corrcoef(true,numpy.log(p))[0,1]))
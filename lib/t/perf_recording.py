@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+'''
+Time battles run with each recording policy (Robocode.RecordingPolicy):
+the battles per second with recording off, sampled and on, and with the
+recordings moved into a RecordingStore.
+
+By default the battles run on the stand-in engine (fake_engine.py), whose
+record files are <turns> lines per round; with --arena and --robocode,
+they run on Robocode itself (--engine for the long-lived engine).
+'''
+
+import sys
+sys.path.append('..')
+
+import argparse
+import itertools
+import os, os.path
+import shutil
+import tempfile
+import time
+
+from BattleData import BattleDB
+from RecordingStore import RecordingStore
+from t_engine import makeArena
+import Robocode
+
+def build_cmdline():
+    parser = argparse.ArgumentParser(
+        'battle throughput by recording policy')
+
+    parser.add_argument(
+        '--battles', '-b',
+        type=int,
+        default=200,
+        help='the number of battles run with each policy',
+    )
+    parser.add_argument(
+        '--rounds',
+        type=int,
+        default=10,
+        help='the rounds per battle',
+    )
+    parser.add_argument(
+        '--turns',
+        type=int,
+        default=1000,
+        help='the turns per round recorded by the stand-in engine',
+    )
+    parser.add_argument(
+        '--policies',
+        type=str,
+        nargs='+',
+        default=[ 'never', 'sampled:0.01', 'sampled:0.1', 'always' ],
+        help='the recording policies to time',
+    )
+    parser.add_argument(
+        '--arena',
+        type=str,
+        default=None,
+        help='run real battles in this arena (with --robocode and --robots)',
+    )
+    parser.add_argument(
+        '--robocode',
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        '--robots',
+        type=str,
+        nargs='+',
+        default=[ 'sample.Fire', 'sample.Crazy', 'sample.Walls' ],
+    )
+    parser.add_argument(
+        '--engine',
+        action='store_true',
+        help='with --arena, run the battles on the long-lived engine',
+    )
+
+    return parser
+
+
+def run( robo, cmdline, names, store=None ):
+    '''
+    Return (seconds, battles recorded, bytes recorded, bytes stored).
+    '''
+    properties = dict(BattleDB.defaultProperties,
+                      **{ 'robocode.battle.numRounds':cmdline.rounds,
+                          'fake.turns':cmdline.turns })
+    pairs = itertools.cycle(itertools.combinations(names,2))
+    recorded = size = stored = 0
+    start = time.perf_counter()
+    for id in range(1,cmdline.battles+1):
+        battle = robo.battle(id,list(next(pairs)),properties)
+        battle.run()
+        assert not battle.error
+        if battle.recordFile:
+            recorded += 1
+            if store is not None:
+                digest,raw,compressed = store.put(battle.recordFile)
+                size += raw
+                stored += compressed
+            else:
+                size += os.path.getsize(battle.recordFile)
+                stored += os.path.getsize(battle.recordFile)
+                os.remove(battle.recordFile)
+    seconds = time.perf_counter() - start
+    robo.close()
+    return seconds, recorded, size, stored
+
+
+if __name__ == '__main__':
+    cmdline = build_cmdline().parse_args()
+
+    root = tempfile.mkdtemp(prefix='perf_recording.')
+    try:
+        if cmdline.arena is None:
+            names = [ 'sample.Fake{0:02d}'.format(i) for i in range(4) ]
+            arena,robo_dir = makeArena(root,names)
+            engine = [ sys.executable,
+                       os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    'fake_engine.py') ]
+        else:
+            names = cmdline.robots
+            arena,robo_dir = cmdline.arena,cmdline.robocode
+            engine = cmdline.engine
+
+        print('{0} battles, {1} rounds each\n'.format(cmdline.battles,cmdline.rounds))
+        print('{0:<24} {1:>9} {2:>10} {3:>9} {4:>12} {5:>12}'.format(
+            'policy','seconds','battles/s','recorded','MB recorded','MB stored'))
+        for policy,store in [ (policy,None) for policy in cmdline.policies ] + \
+                            [ (cmdline.policies[-1],RecordingStore(os.path.join(root,'store'))) ]:
+            robo = Robocode.Robocode(arena,robo_dir,engine=engine,recording=policy)
+            seconds,recorded,size,stored = run(robo,cmdline,names,store)
+            print('{0:<24} {1:>9.2f} {2:>10.1f} {3:>9} {4:>12.1f} {5:>12.1f}'.format(
+                policy + (' (stored)' if store else ''),
+                seconds,cmdline.battles/seconds,recorded,size/1e6,stored/1e6))
+    finally:
+        shutil.rmtree(root)
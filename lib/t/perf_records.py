@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+'''
+Compare the memory held by a tournament's worth of battles loaded as
+BattleData records against the original __dict__-based records (one
+Robot object per competitor of every battle).
+'''
+
+import sys
+sys.path.append('..')
+
+import argparse
+import itertools
+import os, os.path
+import time
+import tracemalloc
+
+from BattleData import BattleDB
+
+def build_cmdline():
+    parser = argparse.ArgumentParser(
+        'memory used by loaded battles')
+
+    parser.add_argument(
+        '--db',
+        type=str,
+        default='perf_records.sqlite3',
+        help='the scratch database (it is recreated)',
+    )
+    parser.add_argument(
+        '--robots',
+        type=int,
+        default=50,
+        help='the number of robots (every pair battles)',
+    )
+    parser.add_argument(
+        '--rounds', '-r',
+        type=int,
+        default=40,
+        help='the number of full round-robins to schedule',
+    )
+
+    return parser
+
+
+#
+# The original record classes
+#
+class LegacyDBRecord:
+    def __init__(self, db_rec):
+        for col in db_rec.keys():
+            setattr(self,col,db_rec[col])
+
+class LegacyBattle(LegacyDBRecord):
+    def __init__(self, record, db):
+        self.db = db
+        self._robots = []
+        super().__init__(record)
+
+    def addCompetitor( self, robot ):
+        self._robots.append(robot)
+
+class LegacyRobot(LegacyDBRecord):
+    def __init__(self, record, db):
+        self.db = db
+        super().__init__(record)
+
+def legacyLoad( bdata ):
+    '''
+    Build the battles the way GetBattle() used to: a new Robot for every
+    competitor of every battle.
+    '''
+    bdata.connect()
+    robots = { record['RobotID']:record
+               for record in bdata.conn.execute('SELECT * FROM Robots') }
+    battles = {}
+    for record in bdata.conn.execute('SELECT * FROM Battles ORDER BY BattleID'):
+        battles[record['BattleID']] = LegacyBattle(record,bdata)
+    for record in bdata.conn.execute('SELECT BattleID,RobotID FROM BattleRobots'):
+        battles[record['BattleID']].addCompetitor(
+            LegacyRobot(robots[record['RobotID']],bdata))
+    return list(battles.values())
+
+
+def measure( load ):
+    '''
+    Return (objects, bytes held, seconds).
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    loaded = load()
+    elapsed = time.perf_counter() - start
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return loaded, held, elapsed
+
+
+if __name__ == '__main__':
+    cmdline = build_cmdline().parse_args()
+
+    if os.path.isfile(cmdline.db):
+        os.remove(cmdline.db)
+    bdata = BattleDB(cmdline.db)
+
+    for i in range(cmdline.robots):
+        bdata.UpdateRobot(name='nonex.TestRobot.{0:04d}'.format(i),
+                          lastUpdated='2014-10-20T09:30:00')
+    pairs = list(itertools.combinations(bdata.GetRobots(),2))
+    bdata.ScheduleBattles(pairs * cmdline.rounds)
+    bdata.execute('''
+        UPDATE Battles
+        SET State='finished',
+            Started='2014-10-20T09:30:00',
+            Finished='2014-10-20T09:31:00'
+    ''',[])
+
+    legacy,legacy_bytes,legacy_time = measure(lambda: legacyLoad(bdata))
+    count = len(legacy)
+    del(legacy)
+    current,current_bytes,current_time = measure(bdata.GetBattles)
+    assert len(current) == count
+
+    print('{0} battles\n'.format(count))
+    print('{0:<10} {1:>12} {2:>14} {3:>10}'.format(
+        'records','total (MB)','per battle (B)','load (s)'))
+    for name,held,elapsed in (('legacy',legacy_bytes,legacy_time),
+                              ('current',current_bytes,current_time)):
+        print('{0:<10} {1:>12.1f} {2:>14.0f} {3:>10.2f}'.format(
+            name, held/(1<<20), held/count, elapsed))
+    print('\n{0:.1f}x less memory'.format(legacy_bytes/current_bytes))
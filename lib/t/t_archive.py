@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+'''
+Archive obsolete and old battles and check what is left in the database,
+the archive, and the rollups.
+'''
+
+import sys
+sys.path.append('..')
+
+from BattleData import BattleDB
+import itertools
+import sqlite3
+import json
+import os
+import os.path
+
+def complete( bdata, battle, finished ):
+    names = [ r.Name for r in battle.competitors() ]
+    bdata.BattleCompleted(
+        battle,
+        { 'Started'    : finished,
+          'Finished'   : finished,
+          'Winner'     : names[0],
+          'Properties' : battle.Properties },
+        { name: { 'Score'   : 100-place,
+                  'Results' : json.dumps({ '_Name':name, '_Place':place+1 }) }
+          for place,name in enumerate(names) })
+
+if __name__ == '__main__':
+    db_file = 't_archive.sqlite3'
+    archive_file = 't_archive.archive.sqlite3'
+    # always start clean
+    for f in (db_file,archive_file):
+        if os.path.isfile(f):
+            os.remove(f)
+
+    # An existing database, created before auto_vacuum was turned on
+    conn = sqlite3.connect(db_file)
+    for statement in BattleDB.schema:
+        conn.execute(statement)
+    conn.close()
+    bdata = BattleDB(db_file)
+
+    for i in range(6):
+        bdata.UpdateRobot(
+            lastUpdated = '2014-10-20T09:30:00',
+            name = 'nonex.TestRobot.{0:02d}'.format(i),
+        )
+    robots = bdata.GetRobots()
+    ids = bdata.ScheduleBattles(list(itertools.combinations(robots,2))*20)
+    for n,battle in enumerate(bdata.ClaimBattles(200)):
+        complete(bdata,battle,'2014-10-{0:02d}T10:00:00'.format(20+n%5))
+    bdata.UpdateRobot(lastUpdated='2014-10-28T09:30:00',id=robots[0].RobotID)
+    obsolete = { b.BattleID for b in bdata.GetObsoleteBattles() }
+    assert len(obsolete) > 0
+    board = { e.RobotID:e.Battles for e in bdata.GetLeaderboard() }
+
+    # Only the obsolete ones
+    assert bdata.Archive(batchSize=7) == len(obsolete)
+    assert bdata.GetObsoleteBattles() == []
+    assert board == { e.RobotID:e.Battles for e in bdata.GetLeaderboard() }, \
+        'Archiving obsolete battles changed the Leaderboard'
+    archive = BattleDB(archive_file)
+    assert { b.BattleID for b in archive.GetBattles() } == obsolete
+    for battle in archive.GetBattles():
+        assert len(battle.competitors()) == 2
+        assert len(archive.GetBattleResults(battle)) == 2
+    rollups = bdata.GetRollups(robots[0])
+    assert len(rollups) == 1
+    assert rollups[0].RobotUpdated == '2014-10-20T09:30:00'
+    assert rollups[0].Battles == rollups[0].Obsolete == \
+           len([ b for b in archive.GetBattles()
+                 if robots[0].RobotID in [ r.RobotID for r in b.competitors() ] ])
+    print('[TEST] archive obsolete battles: OK')
+
+    # ... and old ones
+    before = len(bdata.GetFinishedBattles())
+    old = len(bdata.GetBattles("State='finished'","Finished < '2014-10-22'"))
+    moved = bdata.Archive(olderThan='2014-10-22')
+    assert moved == old > 0
+    assert len(bdata.GetFinishedBattles()) == before-old
+    assert bdata.GetBattles("Finished < '2014-10-22'","State='finished'") == []
+    assert len(archive.GetBattles()) == len(obsolete)+old
+    assert bdata.Archive(olderThan='2014-10-22') == 0
+    total = sum( r.Battles for robot in robots
+                 for r in bdata.GetRollups(robot) )
+    assert total == 2*(len(obsolete)+old), total
+    print('[TEST] archive old battles: OK')
+
+    # Archived BattleIDs aren't reused
+    for battle in bdata.ClaimBattles(1000):
+        complete(bdata,battle,'2014-10-29T10:00:00')
+    bdata.UpdateRobot(lastUpdated='2014-10-29T09:30:00',id=robots[1].RobotID)
+    bdata.Archive(olderThan='2014-10-30')
+    new = bdata.ScheduleBattles([robots[:2]])
+    assert new[0] > max(ids), 'BattleID reused: {0}'.format(new)
+    print('[TEST] BattleIDs: OK')
+
+    # An interrupted run still records the batches it moved
+    bdata.ScheduleBattles([robots[:2]]*6)
+    for battle in bdata.ClaimBattles(1000):
+        complete(bdata,battle,'2014-10-30T10:00:00')
+    archiveBatch = bdata._archiveBatch
+    batches = []
+    def interrupted( conn, columns ):
+        if len(batches) == 1:
+            raise KeyboardInterrupt()
+        archiveBatch(conn,columns)
+        batches.append(conn.execute(
+            'SELECT MAX(BattleID) FROM temp.Archiving').fetchone()[0])
+    bdata._archiveBatch = interrupted
+    try:
+        bdata.Archive(olderThan='2014-10-31',batchSize=4)
+    except KeyboardInterrupt:
+        pass
+    else:
+        assert False, 'Archive() was not interrupted'
+    del(bdata._archiveBatch)
+    last = bdata.execute('''
+        SELECT Battles, LastBattleID FROM Archives ORDER BY ArchiveID DESC LIMIT 1
+    ''').fetchone()
+    assert tuple(last) == (4,batches[0]), tuple(last)
+    print('[TEST] interrupted archive: OK')
+
+    assert bdata.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+    print('[TEST] incremental vacuum: OK')
+
+    print('\n\n[TEST_OK]')
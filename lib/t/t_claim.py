@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+'''
+Have several processes claim battles from the same database at once and
+make sure that no battle is ever claimed twice.
+'''
+
+import sys
+sys.path.append('..')
+
+from BattleData import BattleDB
+import multiprocessing
+import itertools
+import os
+import os.path
+
+db_file = 't_claim.sqlite3'
+
+def claimer( bdata, batch, out_q ):
+    # <bdata> is the parent's (connected) BattleDB, as with BattleRunner.
+    claimed = []
+    while True:
+        battles = bdata.ClaimBattles(batch)
+        if not battles:
+            break
+        for battle in battles:
+            assert battle.State == 'running', \
+                'Claimed battle is not running: {0}'.format(battle)
+            claimed.append(battle.BattleID)
+    out_q.put((claimed,bdata.lockStats()))
+
+
+if __name__ == '__main__':
+    # always start clean
+    if os.path.isfile(db_file):
+        os.remove(db_file)
+    bdata = BattleDB(db_file)
+
+    for i in range(12):
+        bdata.UpdateRobot(
+            lastUpdated = '2014-10-20T09:30:{0:02d}'.format(i),
+            name = 'nonex.TestRobot.{0:02d}'.format(i),
+        )
+    robots = bdata.GetRobots()
+
+    ids = bdata.ScheduleBattles(itertools.combinations(robots,2))
+    print('[TEST] scheduled {0} battles'.format(len(ids)))
+    assert len(ids) == 66, 'Incorrect number of battles: {0}'.format(len(ids))
+
+    # A higher priority is claimed first.
+    bdata.execute('UPDATE Battles SET Priority=10 WHERE BattleID=?',[ids[-1]])
+    first = bdata.ClaimBattles(1)
+    assert [ b.BattleID for b in first ] == [ids[-1]], \
+        'ClaimBattles() ignores Priority: {0}'.format(first[0])
+    print('[TEST] Priority: OK')
+
+    # Already running
+    try:
+        bdata.MarkBattleRunning(ids[-1])
+        assert False, 'MarkBattleRunning() restarted a running battle'
+    except BattleDB.BattleAlreadyStarted:
+        pass
+    print('[TEST] MarkBattleRunning() on a running battle: OK')
+
+    out_q = multiprocessing.Queue()
+    procs = [ multiprocessing.Process(target=claimer,args=(bdata,batch,out_q))
+              for batch in (1,2,3,5,7,11) ]
+    for p in procs:
+        p.start()
+    claimed = []
+    for p in procs:
+        p_claimed,p_locks = out_q.get()
+        claimed.extend(p_claimed)
+        print('[LOCKS] {0}'.format(p_locks))
+    for p in procs:
+        p.join()
+
+    assert len(claimed) == len(set(claimed)), \
+        'Battles claimed more than once: {0}'.format(sorted(claimed))
+    assert set(claimed) == set(ids[:-1]), \
+        'Unclaimed battles: {0}'.format(set(ids[:-1]) - set(claimed))
+    assert len(bdata.GetScheduledBattles()) == 0
+    assert len(bdata.GetRunningBattles()) == len(ids)
+    print('[TEST] concurrent claims: OK')
+
+    mode = bdata.execute('PRAGMA journal_mode').fetchone()[0]
+    assert mode == 'wal', 'Not in WAL mode: {0}'.format(mode)
+    print('[TEST] WAL: OK')
+
+    print('\n\n[TEST_OK]')
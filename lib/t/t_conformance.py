@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+'''
+The same checks of the core battle database API, run against each
+backend: BattleData.BattleDB (SQLite) and MemoryBattleData.MemoryBattleDB.
+'''
+
+import sys
+sys.path.append('..')
+
+from BattleData import BattleDB, BattleRobot
+from MemoryBattleData import MemoryBattleDB
+from HeadToHead import HeadToHead
+from Rating import Elo
+import argparse
+import json
+import os
+import os.path
+
+def sqliteBackend():
+    db_file = 't_conformance.sqlite3'
+    # always start clean
+    if os.path.isfile(db_file):
+        os.remove(db_file)
+    return BattleDB(db_file)
+
+backends = {
+    'sqlite' : sqliteBackend,
+    'memory' : MemoryBattleDB,
+}
+
+def build_cmdline():
+    parser = argparse.ArgumentParser('battle database conformance')
+
+    parser.add_argument(
+        '--backend', '-b',
+        action='append',
+        choices=sorted(backends.keys()),
+        help='the backend(s) to check (default: all of them)',
+    )
+
+    return parser
+
+
+def complete( bdata, battle, winner=0 ):
+    '''
+    Record made-up results: competitor <winner> wins.
+    '''
+    names = [ r.Name for r in battle.competitors() ]
+    names = names[winner:] + names[:winner]
+    bdata.BattleCompleted(battle,*results(battle,names))
+
+def results( battle, names ):
+    return (
+        { 'Started'    : '2014-10-20T10:00:00',
+          'Finished'   : '2014-10-20T10:01:00',
+          'Winner'     : names[0],
+          'Properties' : battle.Properties },
+        { name: { 'Score'   : str(100-place),
+                  'Results' : json.dumps({ '_Name':name, '_Place':place+1,
+                                           '_Score':str(100-place),
+                                           'Survival':'50 (50%)' }) }
+          for place,name in enumerate(names) },
+    )
+
+def ids( battles ):
+    return [ b.BattleID for b in battles ]
+
+def expectError( error, call ):
+    try:
+        call()
+    except error:
+        return
+    assert False, 'Expected {0}'.format(error.__name__)
+
+
+def conformance( bdata ):
+    # Robots
+    robots = [
+        bdata.UpdateRobot(lastUpdated='2014-10-20T09:30:00',
+                          name='nonex.TestRobot.{0:02d}'.format(i))
+        for i in range(4)
+    ]
+    r0,r1,r2,r3 = robots
+    assert [ r.RobotID for r in bdata.GetRobots() ] == [ r.RobotID for r in robots ]
+    assert bdata.GetRobot(id=r1.RobotID) is r1
+    assert bdata.GetRobot(name=r2.Name) is r2
+    expectError(ValueError,lambda: bdata.UpdateRobot(name=r0.Name))
+    expectError(ValueError,lambda: bdata.GetRobot())
+    expectError(KeyError,lambda: bdata.GetRobot(id=1000))
+    expectError(KeyError,lambda: bdata.GetRobot(name='nonex.Nobody'))
+    print('[TEST] {0}: robots: OK'.format(bdata))
+
+    # Scheduling
+    b01,b02,b12,b23,b13 = bdata.ScheduleBattles(
+        [ (r0,r1), (r0,r2), (r1,r2), (r2,r3), (r1,r3) ], hydrate=True)
+    assert b01.State == 'scheduled' and b01.Obsolete == 0 and b01.Winner == -1
+    assert b01.getProperties() == bdata.getProperties()
+    assert [ r.RobotID for r in b13.competitors() ] == [ r1.RobotID, r3.RobotID ]
+    custom = bdata.ScheduleBattle([r3.RobotID,r0],{ 'robocode.battle.numRounds':3 })
+    assert custom.getProperties() == { 'robocode.battle.numRounds':3 }
+    assert ids(bdata.GetScheduledBattles()) == ids([b01,b02,b12,b23,b13,custom])
+    assert bdata.ScheduleBattles([]) == []
+    expectError(KeyError,lambda: bdata.ScheduleBattles([(r0.RobotID,1000)]))
+    expectError(ValueError,lambda: bdata.ScheduleBattles([(r0,r1)],[None,None]))
+    expectError(KeyError,lambda: bdata.GetBattle(1000))
+    assert bdata.GetBattle(b12.BattleID).BattleID == b12.BattleID
+    print('[TEST] {0}: scheduling: OK'.format(bdata))
+
+    # Claiming and running
+    bdata.MarkBattleRunning(b02)
+    expectError(BattleDB.BattleAlreadyStarted,lambda: bdata.MarkBattleRunning(b02))
+    claimed = bdata.ClaimBattles(2)
+    assert ids(claimed) == [ b01.BattleID, b12.BattleID ], ids(claimed)
+    assert all( b.State == 'running' and b.Started for b in claimed )
+    bdata.MarkBattleRunning(b23.BattleID)
+    assert ids(bdata.GetRunningBattles()) == ids([b01,b02,b12,b23])
+    assert [ r.RobotUpdated for r in bdata.GetBattleResults(b01) ] == \
+           [ '2014-10-20T09:30:00' ] * 2
+    assert [ r.RobotUpdated for r in bdata.GetBattleResults(b13) ] == [ '' ] * 2
+    expectError(BattleDB.BattleNotStarted,lambda: complete(bdata,b13))
+    print('[TEST] {0}: claiming: OK'.format(bdata))
+
+    # Results
+    complete(bdata,b01)
+    complete(bdata,b02,winner=1)
+    expectError(BattleDB.BattleAlreadyFinished,lambda: complete(bdata,b01))
+    expectError(BattleDB.BattleAlreadyFinished,lambda: bdata.MarkBattleRunning(b01))
+    battleData,resultData = results(b12,[ r.Name for r in b12.competitors() ])
+    battleData['Winner'] = r3.Name
+    expectError(ValueError,lambda: bdata.BattleCompleted(b12,battleData,resultData))
+    assert bdata.GetBattle(b12).State == 'running'
+
+    battle = bdata.GetBattle(b02)
+    assert battle.State == 'finished' and battle.Winner == r2.RobotID
+    assert battle.Finished == '2014-10-20T10:01:00'
+    scores = bdata.GetBattleResults(b02)
+    assert [ (r.RobotID,r.Score,r.Place,r.Survival) for r in scores ] == \
+           [ (r0.RobotID,99,2,50), (r2.RobotID,100,1,50) ], \
+           [ (r.RobotID,r.Score,r.Place,r.Survival) for r in scores ]
+    assert isinstance(scores[0],BattleRobot)
+    assert scores[0].getResults()['_Name'] == r0.Name
+    assert ids(bdata.GetFinishedBattles()) == ids([b01,b02])
+    assert ids(bdata.GetRobotFinishedBattles(r0)) == ids([b01,b02])
+    assert ids(bdata.GetRobotRunningBattles(r2.RobotID)) == ids([b12,b23])
+    assert ids(bdata.GetRobotScheduledBattles(r3)) == ids([b13,custom])
+    print('[TEST] {0}: results: OK'.format(bdata))
+
+    # Many results at once: the good ones are recorded.
+    bdata.MarkBattleRunning(b13)
+    failed = bdata.BattlesCompleted([
+        (b12,) + results(b12,[ r.Name for r in b12.competitors() ]),
+        (custom,) + results(custom,[ r.Name for r in custom.competitors() ]),
+        (b13,) + results(b13,[ r.Name for r in b13.competitors() ]),
+    ])
+    assert [ (b.BattleID,e.__class__) for b,e in failed ] == \
+           [ (custom.BattleID,BattleDB.BattleNotStarted) ], failed
+    assert ids(bdata.GetFinishedBattles()) == ids([b01,b02,b12,b13])
+    print('[TEST] {0}: BattlesCompleted: OK'.format(bdata))
+
+    board = bdata.GetLeaderboard()
+    assert [ (e.Name,e.Battles,e.Wins,e.TotalScore) for e in board ] == [
+        (r1.Name,3,2,299), (r0.Name,2,1,199), (r2.Name,2,1,199), (r3.Name,1,0,99),
+    ], [ (e.Name,e.Battles,e.Wins,e.TotalScore) for e in board ]
+    assert [ e.Name for e in bdata.GetLeaderboard('average') ][0] == r1.Name
+    print('[TEST] {0}: leaderboard: OK'.format(bdata))
+
+    # Obsolescence
+    bdata.UpdateRobot(lastUpdated='2014-10-21T09:30:00',id=r0.RobotID)
+    assert bdata.lastObsoleted == 2, bdata.lastObsoleted
+    assert r0.LastUpdated == '2014-10-21T09:30:00'
+    assert ids(bdata.GetObsoleteBattles()) == ids([b01,b02])
+    assert ids(bdata.GetRobotObsoleteBattles(r1)) == ids([b01])
+    assert ids(bdata.GetFinishedBattles()) == ids([b12,b13])
+    assert ids(bdata.GetFinishedBattles(nonObsolete=False)) == ids([b01,b02,b12,b13])
+    assert bdata.ObsolesceRobotBattles(r0) == 0
+    # r3 is updated while 2-3 runs: obsolete as soon as it finishes
+    bdata.UpdateRobot(lastUpdated='2014-10-21T09:30:00',id=r3.RobotID)
+    assert bdata.lastObsoleted == 1
+    complete(bdata,b23)
+    assert bdata.GetBattle(b23).Obsolete == 1
+    assert bdata.ObsolesceBattles() == 0
+    expectError(KeyError,lambda: bdata.UpdateRobot(id=1000))
+    board = bdata.GetLeaderboard('score')
+    assert [ (e.Name,e.Battles,e.Wins) for e in board ] == [
+        (r1.Name,1,1), (r2.Name,1,0),
+    ], [ (e.Name,e.Battles,e.Wins) for e in board ]
+    print('[TEST] {0}: obsolescence: OK'.format(bdata))
+
+    # Hooks
+    seen = []
+    bdata.completedHooks.append(lambda db,battleID: seen.append(('completed',battleID)))
+    bdata.obsoletedHooks.append(lambda db,battleIDs: seen.append(('obsoleted',battleIDs)))
+    bdata.MarkBattleRunning(custom)
+    complete(bdata,custom)
+    bdata.UpdateRobot(lastUpdated='2014-10-22T09:30:00',id=r0.RobotID)
+    assert seen == [ ('completed',custom.BattleID),
+                     ('obsoleted',[custom.BattleID]) ], seen
+    print('[TEST] {0}: hooks: OK'.format(bdata))
+
+    # Iterating
+    everything = ids(bdata.GetBattles())
+    assert everything == ids([b01,b02,b12,b23,b13,custom])
+    assert ids(bdata.IterBattles(batchSize=2)) == everything
+    assert ids(bdata.IterBattles(batchSize=2,Obsolete=1)) == ids(bdata.GetObsoleteBattles())
+    assert ids(bdata.IterFinishedBattles(nonObsolete=False,batchSize=4)) == everything
+    assert ids(bdata.IterRobotBattles(r3,batchSize=1)) == ids([b23,b13,custom])
+    assert ids(bdata.GetBattles(State='nonsense')) == []
+    print('[TEST] {0}: iterating: OK'.format(bdata))
+
+    # Reruns to record, and robot versions' first battles
+    assert bdata.GetBattle(b12).Recording is None
+    rerun = bdata.ScheduleRecording(b12)
+    battle = bdata.GetBattle(rerun)
+    assert battle.State == 'scheduled' and battle.Recording == 'rerun'
+    assert [ r.RobotID for r in battle.competitors() ] == \
+           [ r.RobotID for r in b12.competitors() ]
+    late, = bdata.ScheduleBattles([ (r1,r2) ])
+    assert ids(bdata.ClaimBattles(1)) == [ rerun ]
+    # r1 and r2 have fought 3 battles each as this version
+    assert bdata.GetNewVersionBattles([ rerun ],3) == set()
+    assert bdata.GetNewVersionBattles([ battle ],4) == { rerun }
+    bdata.UpdateRobot(lastUpdated='2014-10-22T09:30:00',id=r2.RobotID)
+    bdata.MarkBattleRunning(late)
+    assert bdata.GetNewVersionBattles([ rerun, late ],1) == { late }
+    battleData,resultData = results(battle,[ r.Name for r in battle.competitors() ])
+    battleData['Recorded'] = 1
+    bdata.BattleCompleted(rerun,battleData,resultData)
+    battle = bdata.GetBattle(rerun)
+    assert battle.Recording == 'rerun' and battle.Recorded == 1
+    print('[TEST] {0}: recording: OK'.format(bdata))
+
+    # Queries
+    finished = bdata.QueryBattles(State='finished')
+    assert finished.count() == len(bdata.GetFinishedBattles(nonObsolete=False))
+    assert finished.filter(robot=r3).ids() == ids([b23,b13,custom])
+    assert finished.filter(robot=[r0,r3],Obsolete=1).ids() == \
+           ids([b01,b02,b23,b13,custom])
+    assert finished.filter(robot=[r0,r3],Obsolete=0).ids() == []
+    assert bdata.QueryBattles(BattleID__gt=b12.BattleID,BattleID__le=b13.BattleID).ids() == \
+           ids([b23,b13])
+    assert bdata.QueryBattles(State__like='RUN%').ids() == [ late ]
+    assert bdata.QueryBattles(Recording=None,State__ne='finished').ids() == [ late ]
+    assert finished.orderBy('-Recorded','BattleID').limit(2,1).ids() == \
+           ids([b01,b02])
+    rows = bdata.QueryBattles(BattleID=[rerun,b02.BattleID]).values('BattleID','Winner')
+    assert [ (row['BattleID'],row[1]) for row in rows ] == \
+           [ (b02.BattleID,r2.RobotID), (rerun,r1.RobotID) ]
+    assert finished.exists() and not bdata.QueryBattles(State='nonsense').exists()
+    print('[TEST] {0}: queries: OK'.format(bdata))
+
+    # Transactions: the callbacks run once it's over
+    called = []
+    with bdata.transaction():
+        bdata.afterCommit(lambda: called.append(1))
+        assert called == []
+    assert called == [ 1 ]
+    bdata.afterCommit(lambda: called.append(2))
+    assert called == [ 1, 2 ]
+    print('[TEST] {0}: transactions: OK'.format(bdata))
+
+    # HeadToHead, kept up to date through the hooks, matches a rebuild
+    path = 't_conformance.h2h'
+    for f in (path + '.h2h.npy', path + '.check.h2h.npy'):
+        if os.path.isfile(f):
+            os.remove(f)
+    h2h = HeadToHead(path,size=2).install(bdata)
+    rebuilt = HeadToHead(path + '.check',size=2)
+    h2h.rebuild(bdata)
+    more = bdata.ScheduleBattles([ (r0,r1), (r1,r2,r3), (r0,r3) ])
+    for battle in bdata.ClaimBattles(len(more)):
+        complete(bdata,battle,winner=1)
+    bdata.UpdateRobot(lastUpdated='2014-10-23T09:30:00',id=r3.RobotID)
+    rebuilt.rebuild(bdata)
+    assert (h2h.matrix == rebuilt.matrix).all(), 'HeadToHead != rebuilt'
+    assert h2h.pair(r0,r1)['Battles'] > 0
+    print('[TEST] {0}: HeadToHead: OK'.format(bdata))
+
+    # SQL: only on a backend that has it
+    sql = [
+        lambda: bdata.GetBattles("State='finished'"),
+        lambda: bdata.QueryBattles().where('BattleID > ?',1),
+        lambda: bdata.execute('SELECT COUNT(*) FROM Battles'),
+        lambda: Elo().install(bdata),
+    ]
+    if bdata.backend.sql:
+        for call in sql:
+            call()
+    else:
+        for call in sql:
+            expectError(BattleDB.NotSupported,call)
+    print('[TEST] {0}: SQL: OK'.format(bdata))
+
+    # Battles scheduled after one of a lower Priority are still claimed first
+    low = bdata.ScheduleRecording(b13,priority=-5)
+    later = bdata.ScheduleBattles([ (r0,r1), (r1,r2), (r0,r2), (r0,r3), (r1,r3) ])
+    order = bdata.QueryBattles(State='scheduled').orderBy('-Priority').ids()
+    assert order[-1] == low and order[:-1] == later, order
+    claimed = [ battle.BattleID for n in range(len(order))
+                for battle in bdata.ClaimBattles(1) ]
+    assert claimed == order, claimed
+    print('[TEST] {0}: priorities: OK'.format(bdata))
+
+
+if __name__ == '__main__':
+    cmdline = build_cmdline().parse_args()
+    for name in cmdline.backend or sorted(backends.keys()):
+        conformance(backends[name]())
+
+    print('\n\n[TEST_OK]')
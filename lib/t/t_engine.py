@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+'''
+Run battles through Robocode.Engine with the stand-in engine
+(fake_engine.py): one engine process serves many battles, its results
+match the results files, failures and timeouts are reported, and
+BattleRunner's workers dispatch to it.
+'''
+
+import sys
+sys.path.append('..')
+
+from BattleRunner import BattleRunner
+from BattleData import BattleDB
+import Robocode
+import itertools
+import os
+import os.path
+import shutil
+import subprocess
+import tempfile
+
+def makeArena( root, names ):
+    '''
+    Make an arena and robot files (the robots are never run).
+    '''
+    arena = os.path.join(root,'arena')
+    for subdir in ('robots','battles','results','recordings'):
+        os.makedirs(os.path.join(arena,subdir))
+    os.makedirs(os.path.join(root,'robocode','libs'))
+    for name in names:
+        base = os.path.join(arena,'robots',*name.split('.'))
+        os.makedirs(os.path.dirname(base),exist_ok=True)
+        with open(base+'.class','wb'):
+            pass
+        with open(base+'.robot','wt') as robot:
+            print(os.path.basename(base)+'.class',file=robot)
+    return arena, os.path.join(root,'robocode')
+
+
+if __name__ == '__main__':
+    fake = [ sys.executable,
+             os.path.join(os.path.dirname(os.path.abspath(__file__)),'fake_engine.py') ]
+    names = [ 'sample.Fake{0:02d}'.format(i) for i in range(5) ]
+    root = tempfile.mkdtemp(prefix='t_engine.')
+    try:
+        arena,robo_dir = makeArena(root,names)
+        robo = Robocode.Robocode(arena,robo_dir,engine=fake)
+        properties = BattleDB.defaultProperties
+
+        # Many battles, one engine
+        for id,competitors in enumerate(itertools.combinations(names,2)):
+            battle = robo.battle(id,list(competitors),properties)
+            battle.run()
+            assert not battle.error
+            assert battle.result.winner in competitors, battle.result.winner
+            assert { r['_Name'] for r in battle.result.robots } == set(competitors)
+            # the reply is the same as the results file
+            assert battle.result.robots == robo.result(battle.resultFile).robots, \
+                '{0} != {1}'.format(battle.result.robots,
+                                    robo.result(battle.resultFile).robots)
+            assert os.path.isfile(battle.recordFile)
+            assert battle.result.dbData().keys() == set(competitors)
+        engine = robo.engine()
+        assert engine.starts == 1 and engine.battles == id+1, str(engine)
+        assert engine.version == 'fake'
+        print('[TEST] one engine, many battles: OK')
+
+        # An engine error is a failed battle
+        battle = robo.battle(100,names[:2],dict(properties,**{ 'fake.fail':'Oops' }))
+        try:
+            battle.run()
+        except subprocess.CalledProcessError as e:
+            assert b'Oops' in e.output
+        else:
+            assert False, 'The failed battle succeeded'
+        assert battle.error
+        print('[TEST] engine errors: OK')
+
+        # A battle that takes too long is killed, with the engine
+        battle = robo.battle(101,names[:2],dict(properties,**{ 'fake.sleep':5 }))
+        battle.createBattleFile()
+        try:
+            engine.run(101,battle.battleFile,os.path.join(root,'101.result'),
+                       timeout=0.5)
+        except subprocess.TimeoutExpired:
+            pass
+        else:
+            assert False, 'The battle did not time out'
+        assert engine.process is None
+        battle = robo.battle(102,names[:2],properties)
+        battle.run()
+        assert not battle.error and engine.starts == 2, str(engine)
+        robo.close()
+        assert engine.process is None
+        print('[TEST] timeouts: OK')
+
+        # Through BattleRunner: each worker runs its own engine
+        db_file = 't_engine.sqlite3'
+        # always start clean
+        if os.path.isfile(db_file):
+            os.remove(db_file)
+        bdata = BattleDB(db_file)
+        for name in names:
+            bdata.UpdateRobot(name=name,lastUpdated='2014-10-20T09:30:00')
+        ids = bdata.ScheduleBattles(
+            list(itertools.combinations(bdata.GetRobots(),2))*2)
+        runner = BattleRunner(bdata,robo,2,claim=3)
+        runner.start()
+        runner.finish()
+        finished = bdata.GetFinishedBattles()
+        assert len(finished) == len(ids), \
+            'Not every battle was recorded: {0}!={1}'.format(len(finished),len(ids))
+        print('[TEST] BattleRunner workers: OK')
+    finally:
+        shutil.rmtree(root)
+
+    print('\n\n[TEST_OK]')
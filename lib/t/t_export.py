@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+'''
+Export a small database with BattleDB.export() and read the files back.
+'''
+
+import sys
+sys.path.append('..')
+
+from BattleData import BattleDB
+import itertools
+import shutil
+import json
+import gzip
+import csv
+import io
+import os
+import os.path
+
+if __name__ == '__main__':
+    db_file = 't_export.sqlite3'
+    outdir = 't_export.d'
+    # always start clean
+    if os.path.isfile(db_file):
+        os.remove(db_file)
+    shutil.rmtree(outdir,ignore_errors=True)
+    bdata = BattleDB(db_file)
+
+    for i in range(6):
+        bdata.UpdateRobot(
+            lastUpdated = '2014-10-2{0}T09:30:00'.format(i),
+            name = 'nonex.TestRobot.{0:02d}'.format(i),
+        )
+    robots = bdata.GetRobots()
+    ids = bdata.ScheduleBattles(itertools.combinations(robots,2))
+    bdata.execute('''
+        UPDATE Battles
+        SET State='finished',
+            Finished='2014-10-21T10:' || printf('%02d',BattleID)
+    ''',[])
+
+    exported = bdata.export(outdir,chunkSize=4)
+    assert sorted(exported.keys()) == sorted(BattleDB.exportTables)
+    with open(exported['Battles'][0]) as ifile:
+        battles = [ json.loads(line) for line in ifile ]
+    assert exported['Battles'][1] == len(ids) == len(battles)
+    assert sorted( b['BattleID'] for b in battles ) == sorted(ids)
+    with open(exported['BattleRobots'][0]) as ifile:
+        assert len(ifile.readlines()) == 2*len(ids)
+    print('[TEST] ndjson export: OK')
+
+    exported = bdata.export(outdir,tables=['Robots'],otype='csv',
+                            columns={'Robots':['RobotID','Name']},
+                            compress=True)
+    path,count = exported['Robots']
+    assert path.endswith('Robots.csv.gz')
+    with gzip.open(path,'rt',newline='') as ifile:
+        rows = list(csv.reader(ifile))
+    assert rows[0] == ['RobotID','Name']
+    assert sorted(rows[1:]) == sorted( [str(r.RobotID),r.Name] for r in robots )
+    print('[TEST] gzipped csv, selected columns: OK')
+
+    cutoff = '2014-10-21T10:{0:02d}'.format(ids[5])
+    exported = bdata.export(outdir,since=cutoff,until='2014-10-23',
+                            parallel=False)
+    assert exported['Robots'][1] == 1, exported
+    assert exported['Battles'][1] == len(ids)-5, exported
+    assert exported['BattleRobots'][1] == 2*(len(ids)-5), exported
+    print('[TEST] time range: OK')
+
+    for bad in ( dict(tables=['Nope']), dict(columns={'Robots':['Nope']}) ):
+        try:
+            bdata.export(outdir,**bad)
+            assert False, 'export() accepted {0}'.format(bad)
+        except KeyError:
+            pass
+    print('[TEST] unknown tables/columns: OK')
+
+    ofile = io.StringIO()
+    bdata.dump(ofile,otype='csv',tables=['Robots'])
+    assert len(ofile.getvalue().strip().splitlines()) == 2+len(robots)
+    print('[TEST] dump(): OK')
+
+    shutil.rmtree(outdir)
+    print('\n\n[TEST_OK]')
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+'''
+Run battles (with a stand-in for Robocode, so no JVM is needed) through
+claiming workers and the group-commit results writer, then check that
+every battle was recorded.
+'''
+
+import sys
+sys.path.append('..')
+
+from BattleRunner import BattleRunner, ResultWriter
+from BattleData import BattleDB
+from datetime import datetime
+import itertools
+import random
+import json
+import os
+import os.path
+import queue
+import sqlite3
+
+class FakeResult:
+    def __init__( self, competitors ):
+        self.winner = competitors[0]
+        self.competitors = competitors
+
+    def dbData( self ):
+        return {
+            name: {
+                'Score'   : 100 - place,
+                'Results' : json.dumps({ '_Name':name, '_Place':place+1 }),
+            }
+            for place,name in enumerate(self.competitors)
+        }
+
+class FakeBattle:
+    def __init__( self, id, competitors, properties ):
+        self.id = id
+        self.competitors = competitors
+        self.properties = properties
+        self.error = False
+        self.record = False
+
+    def run( self ):
+        self.started = datetime.now()
+        random.shuffle(self.competitors)
+        self.result = FakeResult(self.competitors)
+        self.finished = datetime.now()
+
+    def dbData( self ):
+        return {
+            'BattleID'   : self.id,
+            'Started'    : self.started.strftime('%Y-%m-%dT%H:%M:%S'),
+            'Finished'   : self.finished.strftime('%Y-%m-%dT%H:%M:%S'),
+            'Properties' : json.dumps(self.properties,sort_keys=True),
+            'Winner'     : self.result.winner,
+        }
+
+class FakeRobocode:
+    def battle( self, id, competitors, properties ):
+        return FakeBattle(id,competitors,properties)
+
+    def close( self ):
+        pass
+
+class FailingDB(BattleDB):
+    def BattlesCompleted( self, results ):
+        raise sqlite3.OperationalError('database is locked')
+
+class FakeStore:
+    def __init__( self ):
+        self.removed = []
+
+    def remove( self, hashes, battledb=None ):
+        self.removed.extend(hashes)
+
+
+if __name__ == '__main__':
+    db_file = 't_group_commit.sqlite3'
+    # always start clean
+    if os.path.isfile(db_file):
+        os.remove(db_file)
+    bdata = BattleDB(db_file)
+
+    for i in range(10):
+        bdata.UpdateRobot(
+            lastUpdated = '2014-10-20T09:30:{0:02d}'.format(i),
+            name = 'nonex.TestRobot.{0:02d}'.format(i),
+        )
+    robots = bdata.GetRobots()
+    ids = bdata.ScheduleBattles(list(itertools.combinations(robots,2))*4)
+
+    runner = BattleRunner(bdata,FakeRobocode(),4,
+                          claim=3,groupCommit=25,commitInterval=50)
+    runner.start()
+    runner.finish()
+
+    finished = bdata.GetFinishedBattles()
+    assert len(finished) == len(ids), \
+        'Not every battle was recorded: {0}!={1}'.format(len(finished),len(ids))
+    for battle in finished:
+        assert battle.Winner in [ r.RobotID for r in battle.competitors() ], \
+            'Bad winner: {0}'.format(battle)
+    assert len(bdata.GetRunningBattles()) == 0
+    assert len(bdata.GetScheduledBattles()) == 0
+    print('[TEST] group commit: OK')
+
+    # A batch that can't be recorded is still reported, and its recordings
+    #   are removed
+    result_q = queue.Queue()
+    done_q = queue.Queue()
+    store = FakeStore()
+    for battleID in (1,2,3):
+        result_q.put((battleID,{},{},('{0:064x}'.format(battleID),10,5)))
+    result_q.put((4,None,None,None))
+    result_q.put(None)
+    ResultWriter(FailingDB(db_file),result_q,done_q,2,50,store)
+    assert sorted( done_q.get_nowait() for i in range(done_q.qsize()) ) == [1,2,3,4]
+    assert store.removed == [ '{0:064x}'.format(i) for i in (1,2,3) ], store.removed
+    print('[TEST] failed batch: OK')
+
+    print('\n\n[TEST_OK]')
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+'''
+Keep a HeadToHead array up to date while battles are recorded and made
+obsolete, and check it against one rebuilt from the database.
+'''
+
+import sys
+sys.path.append('..')
+
+from BattleData import BattleDB
+from HeadToHead import HeadToHead
+import itertools
+import random
+import numpy
+import json
+import os
+import os.path
+
+def complete( bdata, battle ):
+    names = [ r.Name for r in battle.competitors() ]
+    random.shuffle(names)
+    bdata.BattleCompleted(
+        battle,
+        { 'Started'    : '2014-10-20T10:00:00',
+          'Finished'   : '2014-10-20T10:01:00',
+          'Winner'     : names[0],
+          'Properties' : battle.Properties },
+        { name: { 'Score'   : random.randint(0,5000),
+                  'Results' : json.dumps({ '_Name':name, '_Place':place+1 }) }
+          for place,name in enumerate(names) })
+
+def check( bdata, h2h, what ):
+    rebuilt = HeadToHead(db_file + '.check')
+    rebuilt.rebuild(bdata)
+    n = max(h2h.matrix.shape[1],rebuilt.matrix.shape[1])
+    a = numpy.zeros((3,n,n),dtype=numpy.int64)
+    b = numpy.zeros((3,n,n),dtype=numpy.int64)
+    a[:,:h2h.matrix.shape[1],:h2h.matrix.shape[1]] = h2h.matrix
+    b[:,:rebuilt.matrix.shape[1],:rebuilt.matrix.shape[1]] = rebuilt.matrix
+    assert (a == b).all(), '{0}: incremental != rebuilt'.format(what)
+    print('[TEST] {0}: OK'.format(what))
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    db_file = 't_head_to_head.sqlite3'
+    # always start clean
+    for f in (db_file, db_file+'.h2h.npy', db_file+'.check.h2h.npy',
+              db_file+'.late.h2h.npy'):
+        if os.path.isfile(f):
+            os.remove(f)
+    bdata = BattleDB(db_file)
+    h2h = HeadToHead(db_file,size=4).install(bdata)
+
+    for i in range(7):
+        bdata.UpdateRobot(
+            lastUpdated = '2014-10-20T09:30:00',
+            name = 'nonex.TestRobot.{0:02d}'.format(i),
+        )
+    robots = bdata.GetRobots()
+    bdata.ScheduleBattles(list(itertools.combinations(robots,2))*3 +
+                          list(itertools.combinations(robots,3)))
+    for battle in bdata.ClaimBattles(80):
+        complete(bdata,battle)
+    assert h2h.matrix.shape[1] > 7, 'Not grown: {0}'.format(h2h.matrix.shape)
+    check(bdata,h2h,'finished battles')
+
+    a,b = robots[0],robots[1]
+    pair = h2h.pair(a,b)
+    assert pair['Wins'] + pair['Losses'] == pair['Battles'] > 0
+    assert pair['Losses'] == h2h.pair(b,a)['Wins']
+    # another mapping of the same file sees the same thing
+    assert HeadToHead(db_file).pair(a,b) == pair
+    print('[TEST] pair(): OK')
+
+    running = bdata.ClaimBattles(10)
+    bdata.UpdateRobot(lastUpdated='2014-10-21T09:30:00',id=robots[2].RobotID)
+    assert bdata.lastObsoleted > 0
+    check(bdata,h2h,'updated robot')
+    for battle in running:
+        complete(bdata,battle)
+    check(bdata,h2h,'updated while running')
+
+    for battle in bdata.ClaimBattles(1000):
+        complete(bdata,battle)
+    bdata.execute('UPDATE Robots SET LastUpdated=? WHERE RobotID=?',
+                  ['2014-10-22T09:30:00',robots[5].RobotID])
+    assert bdata.ObsolesceBattles() > 0
+    check(bdata,h2h,'ObsolesceBattles()')
+
+    # A rolled back transaction leaves the array alone
+    bdata.ScheduleBattles(list(itertools.combinations(robots,2)))
+    before = numpy.array(h2h.matrix)
+    for change in (lambda: [ complete(bdata,battle)
+                             for battle in bdata.ClaimBattles(5) ],
+                   lambda: bdata.UpdateRobot(lastUpdated='2014-10-23T09:30:00',
+                                             id=robots[3].RobotID)):
+        try:
+            with bdata.transaction():
+                change()
+                raise KeyboardInterrupt()
+        except KeyboardInterrupt:
+            pass
+        assert (numpy.array(h2h.matrix) == before).all(), \
+            'A rolled back change was applied'
+    check(bdata,h2h,'rolled back')
+    for battle in bdata.ClaimBattles(5):
+        complete(bdata,battle)
+    assert not (numpy.array(h2h.matrix) == before).all()
+    check(bdata,h2h,'committed after a rollback')
+
+    # Installed on a database that already has results: built from them
+    late = HeadToHead(db_file+'.late',size=4).install(bdata)
+    check(bdata,late,'installed late')
+    bdata.UpdateRobot(lastUpdated='2014-10-24T09:30:00',id=robots[4].RobotID)
+    assert bdata.lastObsoleted > 0
+    assert (late.matrix >= 0).all(), 'Negative counts'
+    check(bdata,late,'installed late, then obsoleted')
+
+    print('\n\n[TEST_OK]')
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+'''
+Write result files (with the stand-in engine, fake_engine.py), then
+rebuild the results from them with Ingest.py: into a database that has
+the battles, and into an empty one.  The fast parser must agree with
+Robocode.Result, and a second run must find nothing to do.
+'''
+
+import sys
+sys.path.append('..')
+
+from BattleData import BattleDB
+import Ingest
+import Robocode
+import fake_engine
+import itertools
+import os
+import os.path
+import shutil
+import tempfile
+
+def fresh( db_file ):
+    # always start clean
+    if os.path.isfile(db_file):
+        os.remove(db_file)
+    return BattleDB(db_file)
+
+def leaderboard( bdata ):
+    return [ (e.Name,e.Battles,e.Wins,e.TotalScore) for e in bdata.GetLeaderboard() ]
+
+def recount( bdata ):
+    '''
+    The leaderboard, computed from scratch.
+    '''
+    return [ tuple(row) for row in bdata.execute('''
+        SELECT Name, COUNT(*), TOTAL(Robots.RobotID=Winner), TOTAL(Score)
+        FROM BattleRobots
+          INNER JOIN Battles ON BattleRobots.BattleID=Battles.BattleID
+          INNER JOIN Robots ON BattleRobots.RobotID=Robots.RobotID
+        WHERE State='finished' AND Obsolete=0
+        GROUP BY Robots.RobotID
+        ORDER BY Name
+    ''') ]
+
+
+if __name__ == '__main__':
+    root = tempfile.mkdtemp(prefix='t_ingest.')
+    try:
+        results = os.path.join(root,'results')
+        battles = os.path.join(root,'battles')
+        os.makedirs(results)
+        os.makedirs(battles)
+
+        bdata = fresh('t_ingest.sqlite3')
+        for i in range(6):
+            bdata.UpdateRobot(name='sample.Fake{0:02d}'.format(i),
+                              lastUpdated='2014-10-20T09:30:00')
+        properties = dict(BattleDB.defaultProperties,
+                          **{ 'robocode.battle.numRounds':3 })
+        ids = bdata.ScheduleBattles(
+            list(itertools.combinations(bdata.GetRobots(),2))*3,properties)
+        for battle in bdata.GetBattles():
+            battleFile = os.path.join(battles,'{0}.battle'.format(battle.BattleID))
+            with open(battleFile,'wt') as out:
+                for prop,value in battle.getProperties().items():
+                    print('{0}={1}'.format(prop,value),file=out)
+                print('{0}={1}'.format(Robocode.Battle.robotProp,
+                                       ','.join( r.Name for r in battle.competitors() )),
+                      file=out)
+            fake_engine.runBattle(str(battle.BattleID),battleFile,
+                                  os.path.join(results,'{0}.result'.format(battle.BattleID)),
+                                  None)
+        with open(os.path.join(results,'9999.result'),'wt') as out:
+            print('not a results file',file=out)
+
+        # The fast parser reads exactly what Robocode.Result does
+        for battleID in ids:
+            path = os.path.join(results,'{0}.result'.format(battleID))
+            result = Robocode.Result(path)
+            assert Ingest.parseResult(path) == (result.rounds,result.robots,result.winner), \
+                '{0}: {1} != {2}'.format(path,Ingest.parseResult(path),result.robots)
+        assert Ingest.parseBattle(os.path.join(battles,'1.battle')) == properties
+        print('[TEST] parser: OK')
+
+        # Some battles have run (one of them is finished), the rest haven't
+        claimed = bdata.ClaimBattles(10)
+        bdata.BattleCompleted(
+            claimed[0].BattleID,
+            { 'Started'    : '2014-10-20T10:00:00',
+              'Finished'   : '2014-10-20T10:01:00',
+              'Winner'     : claimed[0].competitors()[0].Name,
+              'Properties' : claimed[0].Properties },
+            { r.Name: { 'Score':'10', 'Results':'{}' } for r in claimed[0].competitors() })
+        ingester = Ingest.Ingester(bdata,results,battles,workers=2,batchSize=20,
+                                   chunkSize=7,progress=None)
+        stats = ingester.run()
+        assert stats['files'] == len(ids)+1 and stats['skipped'] == 1 and \
+               stats['recorded'] == len(ids)-1 and stats['created'] == 0 and \
+               stats['failed'] == 1, stats
+        assert len(bdata.GetFinishedBattles()) == len(ids)
+        assert leaderboard(bdata) and sorted(leaderboard(bdata)) == recount(bdata), \
+            '{0} != {1}'.format(leaderboard(bdata),recount(bdata))
+        winner = bdata.GetBattle(ids[-1]).Winner
+        result = Robocode.Result(os.path.join(results,'{0}.result'.format(ids[-1])))
+        assert bdata.GetRobot(id=winner).Name == result.winner
+        assert [ r.Place for r in bdata.GetBattleResults(ids[-1]) ] != [ None, None ]
+        print('[TEST] ingest into the database: OK')
+
+        # Nothing left to do
+        again = Ingest.Ingester(bdata,results,battles,workers=0,progress=None).run()
+        assert again['skipped'] == len(ids) and again['recorded'] == 0, again
+        print('[TEST] resume: OK')
+
+        # The database is lost: everything is recreated
+        lost = fresh('t_ingest.lost.sqlite3')
+        stats = Ingest.Ingester(lost,results,battles,progress=None).run()
+        assert stats['created'] == len(ids) and stats['recorded'] == len(ids), stats
+        assert sorted( r.Name for r in lost.GetRobots() ) == \
+               sorted( r.Name for r in bdata.GetRobots() )
+        recreated = lost.GetBattle(ids[3])
+        assert recreated.getProperties() == properties
+        assert sorted( r.Name for r in recreated.competitors() ) == \
+               sorted( r.Name for r in bdata.GetBattle(ids[3]).competitors() )
+        assert sorted(leaderboard(lost)) == recount(lost)
+        # new battles are numbered after the recreated ones
+        assert lost.ScheduleBattles([ lost.GetRobots()[:2] ]) == [ ids[-1]+1 ]
+        print('[TEST] ingest into an empty database: OK')
+    finally:
+        shutil.rmtree(root)
+
+    print('\n\n[TEST_OK]')
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+'''
+Page through battles with the Iter*Battles() generators and compare them
+with the Get*Battles() lists.
+'''
+
+import sys
+sys.path.append('..')
+
+from BattleData import BattleDB
+import itertools
+import os
+import os.path
+
+def ids( battles ):
+    return [ b.BattleID for b in battles ]
+
+def competitors( battles ):
+    return [ [ r.RobotID for r in b.competitors() ] for b in battles ]
+
+if __name__ == '__main__':
+    db_file = 't_iter.sqlite3'
+    # always start clean
+    if os.path.isfile(db_file):
+        os.remove(db_file)
+    bdata = BattleDB(db_file)
+
+    for i in range(8):
+        bdata.UpdateRobot(
+            lastUpdated = '2014-10-20T09:30:{0:02d}'.format(i),
+            name = 'nonex.TestRobot.{0:02d}'.format(i),
+        )
+    robots = bdata.GetRobots()
+    scheduled = bdata.ScheduleBattles(itertools.combinations(robots,2))
+    bdata.execute('''
+        UPDATE Battles SET State='finished' WHERE BattleID % 3 = 0
+    ''',[])
+
+    for batchSize in (1,2,5,7,100):
+        for get,it in (
+                (bdata.GetBattles(),
+                 bdata.IterBattles(batchSize=batchSize)),
+                (bdata.GetScheduledBattles(),
+                 bdata.IterScheduledBattles(batchSize=batchSize)),
+                (bdata.GetFinishedBattles(),
+                 bdata.IterFinishedBattles(batchSize=batchSize)),
+                (bdata.GetBattles('BattleID>5',Obsolete=0),
+                 bdata.IterBattles('BattleID>5',Obsolete=0,
+                                   batchSize=batchSize)),
+                (bdata.GetRobotBattles(robots[3],state=['finished']),
+                 bdata.IterRobotBattles(robots[3],state=['finished'],
+                                        batchSize=batchSize)),
+        ):
+            it = list(it)
+            assert ids(it) == ids(get), \
+                'batch {0}: {1} != {2}'.format(batchSize,ids(it),ids(get))
+            assert competitors(it) == competitors(get)
+    print('[TEST] Iter*Battles() match Get*Battles(): OK')
+
+    # Only one batch is loaded at a time.
+    battles = bdata.IterBattles(batchSize=4)
+    first = next(battles)
+    assert first.BattleID == scheduled[0]
+    bdata.execute('DELETE FROM Battles WHERE BattleID>?',[scheduled[3]])
+    assert len(list(battles)) == 3, 'More than a batch was loaded'
+    print('[TEST] batches: OK')
+
+    # A batch of no battles is refused
+    for batchSize in (0,-1):
+        for call in (lambda: bdata.IterBattles(batchSize=batchSize),
+                     lambda: bdata.QueryBattles().iter(batchSize),
+                     lambda: bdata.IterRobotBattles(robots[0],batchSize=batchSize)):
+            try:
+                call()
+            except ValueError:
+                pass
+            else:
+                assert False, 'batchSize {0} was accepted'.format(batchSize)
+    print('[TEST] batch size: OK')
+
+    print('\n\n[TEST_OK]')
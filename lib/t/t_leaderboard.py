@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+'''
+Finish, obsolesce, and delete battles and check the Leaderboard table
+against totals recomputed from every battle.
+'''
+
+import sys
+sys.path.append('..')
+
+from BattleData import BattleDB
+import itertools
+import random
+import json
+import io
+import os
+import os.path
+
+import Reporter
+
+def complete( bdata, battle ):
+    '''
+    Record made-up results for <battle> in a random order.
+    '''
+    names = [ r.Name for r in battle.competitors() ]
+    random.shuffle(names)
+    bdata.BattleCompleted(
+        battle,
+        { 'Started'    : '2014-10-20T10:00:00',
+          'Finished'   : '2014-10-20T10:01:00',
+          'Winner'     : names[0],
+          'Properties' : battle.Properties },
+        { name: { 'Score'   : random.randint(0,5000),
+                  'Results' : json.dumps({ '_Name':name, '_Place':place+1 }) }
+          for place,name in enumerate(names) })
+
+def recomputed( bdata ):
+    '''
+    { RobotID: (Battles,Wins,TotalScore) } from the battles themselves.
+    '''
+    totals = {}
+    for battle in bdata.GetFinishedBattles():
+        for result in bdata.GetBattleResults(battle):
+            b,w,s = totals.get(result.RobotID,(0,0,0))
+            totals[result.RobotID] = ( b+1,
+                                       w+(result.RobotID == battle.Winner),
+                                       s+result.Score )
+    return totals
+
+def check( bdata, what ):
+    board = { e.RobotID: (e.Battles,e.Wins,e.TotalScore)
+              for e in bdata.GetLeaderboard() }
+    expected = recomputed(bdata)
+    assert board == expected, \
+        '{0}: leaderboard {1} != {2}'.format(what,board,expected)
+    print('[TEST] {0}: OK'.format(what))
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    db_file = 't_leaderboard.sqlite3'
+    # always start clean
+    if os.path.isfile(db_file):
+        os.remove(db_file)
+    bdata = BattleDB(db_file)
+
+    for i in range(6):
+        bdata.UpdateRobot(
+            lastUpdated = '2014-10-20T09:30:00',
+            name = 'nonex.TestRobot.{0:02d}'.format(i),
+        )
+    robots = bdata.GetRobots()
+    bdata.ScheduleBattles(list(itertools.combinations(robots,2))*3 +
+                          list(itertools.combinations(robots,3)))
+    check(bdata,'empty')
+
+    for battle in bdata.ClaimBattles(60):
+        complete(bdata,battle)
+    check(bdata,'finished battles')
+
+    board = bdata.GetLeaderboard()
+    assert [ e.Wins for e in board ] == sorted([ e.Wins for e in board ],
+                                               reverse=True)
+    for e in board:
+        assert e.AverageScore == e.TotalScore/e.Battles
+    print('[TEST] ranking: OK')
+
+    bdata.UpdateRobot(lastUpdated='2014-10-21T09:30:00',id=robots[2].RobotID)
+    check(bdata,'updated robot')
+
+    # Updated while running
+    running = bdata.ClaimBattles(10)
+    bdata.UpdateRobot(lastUpdated='2014-10-22T09:30:00',id=robots[4].RobotID)
+    for battle in running:
+        complete(bdata,battle)
+    check(bdata,'updated while running')
+
+    for battle in bdata.ClaimBattles(1000):
+        complete(bdata,battle)
+    bdata.execute('DELETE FROM Battles WHERE BattleID % 4 = 0',[])
+    check(bdata,'deleted battles')
+
+    # An existing database gets a backfilled Leaderboard
+    bdata.execute('DROP TABLE Leaderboard',[])
+    bdata.execute('PRAGMA user_version=3',[])
+    del(bdata)
+    bdata = BattleDB(db_file)
+    check(bdata,'migration')
+
+    report = io.StringIO()
+    Reporter.leaderboard(bdata,report)
+    assert len(report.getvalue().splitlines()) == 1+len(bdata.GetLeaderboard())
+    print('[TEST] Reporter.leaderboard(): OK')
+
+    print('\n\n[TEST_OK]')
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+'''
+Migrate a database created with the original schema to the latest version,
+and refuse one whose robot names aren't unique.
+'''
+
+import sys
+sys.path.append('..')
+
+from BattleData import BattleDB
+import sqlite3
+import os
+import os.path
+
+def create( db_file, names ):
+    # The original schema (version 0), with the robots <names>
+    if os.path.isfile(db_file):
+        os.remove(db_file)
+    conn = sqlite3.connect(db_file)
+    for statement in BattleDB.schema:
+        conn.execute(statement)
+    conn.executemany('INSERT INTO Robots (Name,LastUpdated) VALUES (?,?)',
+                     [ (name,'2014-10-20T09:30:00') for name in names ])
+    conn.commit()
+    conn.close()
+
+def version( db_file ):
+    conn = sqlite3.connect(db_file)
+    try:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    db_file = 't_migrate.sqlite3'
+    latest = BattleDB.migrations[-1][0]
+
+    create(db_file,[ 'nonex.A', 'nonex.B' ])
+    bdata = BattleDB(db_file)
+    assert [ r.Name for r in bdata.GetRobots() ] == [ 'nonex.A', 'nonex.B' ]
+    assert version(db_file) == latest
+    bdata.close()
+    print('[TEST] migrated: OK')
+
+    # Duplicate names: the migration fails, naming them...
+    create(db_file,[ 'nonex.A', 'nonex.B', 'nonex.A', 'nonex.C', 'nonex.C' ])
+    for i in range(2):
+        bdata = BattleDB(db_file)
+        try:
+            bdata.connect()
+        except sqlite3.IntegrityError as e:
+            assert 'nonex.A (RobotIDs 1,3)' in str(e) and \
+                   'nonex.C (RobotIDs 4,5)' in str(e) and \
+                   'nonex.B' not in str(e), str(e)
+        else:
+            assert False, 'Duplicate robot names were migrated'
+        bdata.close()
+        assert version(db_file) == 0
+    # ... until they're removed
+    conn = sqlite3.connect(db_file)
+    conn.execute('DELETE FROM Robots WHERE RobotID IN (3,5)')
+    conn.commit()
+    conn.close()
+    bdata = BattleDB(db_file)
+    assert [ r.Name for r in bdata.GetRobots() ] == [ 'nonex.A', 'nonex.B', 'nonex.C' ]
+    assert version(db_file) == latest
+    print('[TEST] duplicate robot names: OK')
+
+    print('\n\n[TEST_OK]')
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+'''
+Record some (made up) battle results, update robots, and check that
+exactly the right battles become obsolete without the full-table
+ObsolesceBattles() scan.
+'''
+
+import sys
+sys.path.append('..')
+
+from BattleData import BattleDB
+import json
+import os
+import os.path
+
+def complete( bdata, battle ):
+    '''
+    Record made-up results: the first competitor wins.
+    '''
+    names = [ r.Name for r in battle.competitors() ]
+    bdata.BattleCompleted(
+        battle,
+        { 'Started'    : '2014-10-20T10:00:00',
+          'Finished'   : '2014-10-20T10:01:00',
+          'Winner'     : names[0],
+          'Properties' : battle.Properties },
+        { name: { 'Score'   : 100-place,
+                  'Results' : json.dumps({ '_Name':name, '_Place':place+1,
+                                           '_Score':str(100-place) }) }
+          for place,name in enumerate(names) })
+
+def obsolete( bdata ):
+    return { b.BattleID for b in bdata.GetObsoleteBattles() }
+
+
+db_file = 't_obsolesce.sqlite3'
+# always start clean
+if os.path.isfile(db_file):
+    os.remove(db_file)
+bdata = BattleDB(db_file)
+
+robots = [
+    bdata.UpdateRobot(lastUpdated='2014-10-20T09:30:00',
+                      name='nonex.TestRobot.{0:02d}'.format(i))
+    for i in range(4)
+]
+r0,r1,r2,r3 = robots
+
+# 0-1 and 0-2 finish, 1-2 finishes, 2-3 is left running, 1-3 scheduled
+b01,b02,b12,b23,b13 = bdata.ScheduleBattles(
+    [ (r0,r1), (r0,r2), (r1,r2), (r2,r3), (r1,r3) ], hydrate=True)
+for battle in (b01,b02,b12,b23):
+    bdata.MarkBattleRunning(battle)
+for battle in (b01,b02,b12):
+    complete(bdata,battle)
+
+# Updating r0 only obsoletes its finished battles.
+bdata.UpdateRobot(lastUpdated='2014-10-21T09:30:00',id=r0.RobotID)
+assert bdata.lastObsoleted == 2, \
+    'Wrong number of battles obsoleted: {0}'.format(bdata.lastObsoleted)
+assert obsolete(bdata) == { b01.BattleID, b02.BattleID }, \
+    'Wrong battles obsoleted: {0}'.format(obsolete(bdata))
+print('[TEST] UpdateRobot() obsolesces its battles: OK')
+
+# Nothing more to do for a robot that hasn't changed again.
+assert bdata.ObsolesceRobotBattles(r0) == 0
+print('[TEST] ObsolesceRobotBattles() again: OK')
+
+# r3 is updated while 2-3 is running: it is obsolete as soon as it finishes.
+bdata.UpdateRobot(lastUpdated='2014-10-21T09:30:00',id=r3.RobotID)
+assert bdata.lastObsoleted == 0
+complete(bdata,b23)
+assert obsolete(bdata) == { b01.BattleID, b02.BattleID, b23.BattleID }, \
+    'Wrong battles obsoleted: {0}'.format(obsolete(bdata))
+print('[TEST] battles finishing after an update: OK')
+
+# The full scan agrees.
+assert bdata.ObsolesceBattles() == 0, 'ObsolesceBattles() found stale battles'
+print('[TEST] consistency check: OK')
+
+print('\n\n[TEST_OK]')
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+'''
+Build queries with BattleDB.QueryBattles() and check their results
+against the battles themselves.
+'''
+
+import sys
+sys.path.append('..')
+
+from BattleData import BattleDB
+import itertools
+import os
+import os.path
+
+db_file = 't_query_builder.sqlite3'
+# always start clean
+if os.path.isfile(db_file):
+    os.remove(db_file)
+bdata = BattleDB(db_file)
+
+robots = [
+    bdata.UpdateRobot(lastUpdated='2014-10-20T09:30:00',
+                      name='nonex.TestRobot.{0:02d}'.format(i))
+    for i in range(5)
+]
+ids = bdata.ScheduleBattles(list(itertools.combinations(robots,2)))
+# the first half finish, one minute apart
+for i,battleID in enumerate(ids[:len(ids)//2]):
+    bdata.execute('''
+        UPDATE Battles
+        SET State='finished', Started=?, Finished=?
+        WHERE BattleID=?
+    ''',['2014-10-20T10:{0:02d}:00'.format(i),
+         '2014-10-20T10:{0:02d}:30'.format(i),battleID])
+everything = bdata.GetBattles()
+
+def expect( query, battles ):
+    got = [ b.BattleID for b in query.all() ]
+    want = [ b.BattleID for b in battles ]
+    assert got == want, '{0}: {1} != {2}'.format(query,got,want)
+    assert query.ids() == want
+    assert query.count() == len(want), \
+        '{0}: count {1} != {2}'.format(query,query.count(),len(want))
+    assert query.exists() == bool(want)
+
+finished = bdata.QueryBattles(State='finished')
+expect(finished,[ b for b in everything if b.State == 'finished' ])
+expect(finished.filter(robot=robots[0]),
+       [ b for b in everything if b.State == 'finished' and
+         robots[0].RobotID in [ r.RobotID for r in b.competitors() ] ])
+expect(bdata.QueryBattles(BattleID=ids[2:5]),everything[2:5])
+expect(bdata.QueryBattles(BattleID__gt=ids[3],BattleID__le=ids[6]),
+       everything[4:7])
+expect(bdata.QueryBattles(Finished=None),
+       [ b for b in everything if b.Finished is None ])
+expect(finished.filter(Finished__between=('2014-10-20T10:01','2014-10-20T10:03')),
+       everything[1:3])
+expect(bdata.QueryBattles(State='nonsense'),[])
+print('[TEST] filter, count and exists: OK')
+
+latest = finished.orderBy('-Finished')
+expect(latest.limit(2),everything[len(ids)//2-2:len(ids)//2][::-1])
+expect(latest.limit(2,offset=1),everything[len(ids)//2-3:len(ids)//2-1][::-1])
+rows = latest.limit(1).values('BattleID','Finished')
+assert rows[0].keys() == ['BattleID','Finished'], rows[0].keys()
+assert rows[0]['BattleID'] == ids[len(ids)//2-1]
+print('[TEST] orderBy, limit and values: OK')
+
+# Values are bound, never spliced into the SQL.
+sneaky = "finished' OR '1'='1"
+assert bdata.QueryBattles(State=sneaky).count() == 0
+assert sneaky not in bdata.QueryBattles(State=sneaky).sql()[0]
+for bad in ( lambda: bdata.QueryBattles(Nonsense=1),
+             lambda: bdata.QueryBattles(State__near=1),
+             lambda: finished.orderBy('Nonsense'),
+             lambda: finished.values('BattleID; DROP TABLE Battles') ):
+    try:
+        bad()
+    except (KeyError,ValueError):
+        pass
+    else:
+        assert False, 'Bad query accepted'
+print('[TEST] bound parameters and validation: OK')
+
+# Queries are immutable; GetBattles()/IterBattles() go through them.
+assert finished.count() == len(ids)//2
+assert [ b.BattleID for b in finished.iter(batchSize=3) ] == finished.ids()
+assert [ b.BattleID for b in bdata.GetBattles("State<>'finished'") ] == \
+       ids[len(ids)//2:]
+assert [ b.BattleID for b in bdata.IterBattles(batchSize=4,State='scheduled') ] == \
+       ids[len(ids)//2:]
+print('[TEST] immutability and GetBattles: OK')
+
+print('\n\n[TEST_OK]')
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+'''
+Run query.py in snapshot mode while the database is being written.
+'''
+
+import sys
+sys.path.append('..')
+
+from BattleData import BattleDB
+import subprocess
+import itertools
+import json
+import os
+import os.path
+
+if __name__ == '__main__':
+    db_file = 't_query_snapshot.sqlite3'
+    # always start clean
+    if os.path.isfile(db_file):
+        os.remove(db_file)
+    bdata = BattleDB(db_file)
+
+    for i in range(5):
+        bdata.UpdateRobot(
+            lastUpdated = '2014-10-20T09:30:00',
+            name = 'nonex.TestRobot.{0:02d}'.format(i),
+        )
+    ids = bdata.ScheduleBattles(itertools.combinations(bdata.GetRobots(),2))
+
+    # A writer is in the middle of a transaction (with uncommitted battles).
+    with bdata.transaction():
+        bdata.ScheduleBattles(itertools.combinations(bdata.GetRobots(),2))
+        for snapshot in ('memory','temp'):
+            out = subprocess.run(
+                [ sys.executable, os.path.join('..','query.py'), db_file,
+                  '--query', 'SELECT BattleID FROM Battles ORDER BY BattleID',
+                  '--ndjson', '--snapshot', snapshot, '--batch', '3' ],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                check=True, universal_newlines=True)
+            got = [ json.loads(line)['BattleID']
+                    for line in out.stdout.splitlines() if line ]
+            assert got == list(ids), '{0}: {1}'.format(snapshot,got)
+            assert 'records/s' in out.stderr
+            print('[TEST] {0} snapshot: OK'.format(snapshot))
+
+    print('\n\n[TEST_OK]')
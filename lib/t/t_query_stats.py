@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+'''
+Check the statement statistics and the slow-query log.
+'''
+
+import sys
+sys.path.append('..')
+
+from BattleData import BattleDB, QueryStats
+import itertools
+import os
+import os.path
+
+def find( bdata, prefix ):
+    matches = [ s for s in bdata.stats() if s['template'].startswith(prefix) ]
+    assert len(matches) == 1, '{0}: {1}'.format(prefix,matches)
+    return matches[0]
+
+if __name__ == '__main__':
+    db_file = 't_query_stats.sqlite3'
+    log_file = 't_query_stats.log'
+    # always start clean
+    for f in (db_file,log_file):
+        if os.path.isfile(f):
+            os.remove(f)
+    bdata = BattleDB(db_file)
+
+    for i in range(8):
+        bdata.UpdateRobot(
+            lastUpdated = '2014-10-20T09:30:00',
+            name = 'nonex.TestRobot.{0:02d}'.format(i),
+        )
+    robots = bdata.GetRobots()
+    ids = bdata.ScheduleBattles(itertools.combinations(robots,2))
+
+    bdata.queryStats.reset()
+    for i in range(5):
+        assert len(bdata.GetScheduledBattles()) == len(ids)
+    rows = list(bdata.execute('SELECT BattleID FROM Battles WHERE BattleID < ?',[11]))
+    bdata.execute('SELECT * FROM Battles WHERE BattleID IN (?,?,?)',[1,2,3]).fetchall()
+    bdata.execute('SELECT * FROM Battles WHERE BattleID IN (?,?)',[1,2]).fetchone()
+
+    stats = find(bdata,'SELECT * FROM Battles WHERE State=?')
+    assert stats['calls'] == 5, stats
+    assert stats['rows'] == 5*len(ids), stats
+    assert sum(stats['histogram']) == stats['calls']
+    assert 0 < stats['mean'] <= stats['max'] <= stats['seconds']
+    assert find(bdata,'SELECT BattleID FROM Battles WHERE BattleID < ?')['rows'] == 10
+    # parameter lists are one template; an unfinished cursor still counts
+    stats = find(bdata,'SELECT * FROM Battles WHERE BattleID IN (?,...)')
+    assert stats['calls'] == 2 and stats['rows'] == 4, stats
+    assert len(QueryStats.histogramBounds()) == QueryStats.buckets
+    print('[TEST] statement stats: OK')
+
+    # Statements in other modules (through the connection) count too
+    bdata.queryStats.reset()
+    bdata.conn.executemany('UPDATE Battles SET Priority=? WHERE BattleID=?',
+                           [ (1,id) for id in ids ])
+    stats = find(bdata,'UPDATE Battles SET Priority=?')
+    assert stats['calls'] == 1 and stats['rows'] == len(ids), stats
+    print('[TEST] executemany(): OK')
+
+    slow = BattleDB(db_file,slowQuery=0.0,slowLog=log_file)
+    slow.GetRobotBattles(robots[0])
+    with open(log_file) as log:
+        entries = log.read()
+    assert '[SLOW QUERY]' in entries
+    assert 'SEARCH' in entries or 'SCAN' in entries, entries
+    os.remove(log_file)
+    print('[TEST] slow query log: OK')
+
+    print('\n\n[TEST_OK]')
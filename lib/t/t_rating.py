@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+'''
+Play made-up battles between robots of known strengths and check that
+the Elo and Bradley-Terry ratings rank them correctly, per version.
+'''
+
+import sys
+sys.path.append('..')
+
+from BattleData import BattleDB
+import Rating
+import itertools
+import random
+import json
+import os
+import os.path
+
+def play( bdata, battles, strength ):
+    '''
+    Claim and complete <battles> battles; the winner is drawn with the
+      Bradley-Terry probabilities of <strength> { Name: p }.
+    '''
+    for battle in bdata.ClaimBattles(battles):
+        a,b = [ r.Name for r in battle.competitors() ]
+        if random.random() >= strength[a]/(strength[a]+strength[b]):
+            a,b = b,a
+        bdata.BattleCompleted(
+            battle,
+            { 'Started'    : '2014-10-20T10:00:00',
+              'Finished'   : '2014-10-20T10:01:00',
+              'Winner'     : a,
+              'Properties' : battle.Properties },
+            { name: { 'Score'   : 100*(2-place),
+                      'Results' : json.dumps({ '_Name':name, '_Place':place+1 }) }
+              for place,name in enumerate((a,b)) })
+
+def ranking( entries ):
+    return [ e.Name for e in entries ]
+
+
+if __name__ == '__main__':
+    random.seed(1)
+    db_file = 't_rating.sqlite3'
+    # always start clean
+    if os.path.isfile(db_file):
+        os.remove(db_file)
+    bdata = BattleDB(db_file)
+    Rating.Elo(k=16).install(bdata)
+
+    names = [ 'nonex.TestRobot.{0:02d}'.format(i) for i in range(5) ]
+    strength = { name: 3.0**i for i,name in enumerate(names) }
+    for name in names:
+        bdata.UpdateRobot(lastUpdated='2014-10-20T09:30:00',name=name)
+    robots = bdata.GetRobots()
+    bdata.ScheduleBattles(list(itertools.combinations(robots,2))*60)
+    play(bdata,1000,strength)
+
+    best_first = list(reversed(names))
+    elo = bdata.GetRatings('elo')
+    assert ranking(elo) == best_first, 'Elo: {0}'.format(ranking(elo))
+    assert sum( e.Battles for e in elo ) == 2*600
+    print('[TEST] Elo: OK')
+
+    bt = Rating.BradleyTerry()
+    assert bt.refit(bdata) == len(names)
+    fitted = bdata.GetRatings('bradley-terry')
+    assert ranking(fitted) == best_first, 'BT: {0}'.format(ranking(fitted))
+    # each step is a factor of 3: 400*log10(3) ~ 191 points
+    gaps = [ a.Rating-b.Rating for a,b in zip(fitted,fitted[1:]) ]
+    assert all( 120 < gap < 260 for gap in gaps ), 'BT gaps: {0}'.format(gaps)
+    print('[TEST] Bradley-Terry: OK')
+
+    # A new version of the weakest robot is now the strongest.
+    weakest = bdata.GetRobot(name=names[0])
+    bdata.UpdateRobot(lastUpdated='2014-10-21T09:30:00',id=weakest.RobotID)
+    strength[names[0]] = 3.0**6
+    bdata.ScheduleBattles(
+        [ (weakest,r) for r in robots if r.RobotID != weakest.RobotID ]*60)
+    play(bdata,1000,strength)
+    bt.refit(bdata)
+
+    current = bdata.GetRatings('bradley-terry')
+    assert ranking(current)[0] == names[0], ranking(current)
+    assert len(current) == len(names)
+    assert len(bdata.GetRatings('bradley-terry',current=False)) == len(names)+1
+    previous = bdata.GetRating(weakest,'bradley-terry','2014-10-20T09:30:00')
+    assert previous.Rating < current[-1].Rating + 100, previous
+    assert bdata.GetRating(weakest,'elo').Battles == 240
+    print('[TEST] ratings per version: OK')
+
+    print('\n\n[TEST_OK]')
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+'''
+Record battles by Robocode.RecordingPolicy (with the stand-in engine,
+fake_engine.py): never, always, a sample, robot versions' first battles,
+and reruns to record.  Each battle keeps the policy it ran under.
+'''
+
+import sys
+sys.path.append('..')
+
+from BattleRunner import BattleRunner
+from BattleData import BattleDB
+from t_engine import makeArena
+import Robocode
+import itertools
+import os
+import os.path
+import shutil
+import tempfile
+
+def expectError( error, call ):
+    try:
+        call()
+    except error:
+        return
+    assert False, 'Expected {0}'.format(error.__name__)
+
+def recorded( robo ):
+    return sorted( int(name.split('.')[0]) for name in os.listdir(robo.recordings) )
+
+def runAll( bdata, robo ):
+    runner = BattleRunner(bdata,robo,2,claim=3)
+    runner.start()
+    runner.finish()
+
+
+if __name__ == '__main__':
+    fake = [ sys.executable,
+             os.path.join(os.path.dirname(os.path.abspath(__file__)),'fake_engine.py') ]
+    names = [ 'sample.Fake{0:02d}'.format(i) for i in range(4) ]
+    root = tempfile.mkdtemp(prefix='t_recording_policy.')
+    try:
+        arena,robo_dir = makeArena(root,names)
+        properties = BattleDB.defaultProperties
+
+        # The policies
+        for name in ( 'never', 'always', 'sampled:0.25', 'new-version:3', 'rerun' ):
+            assert str(Robocode.RecordingPolicy.parse(name)) == name
+        expectError(ValueError,lambda: Robocode.RecordingPolicy.parse('sometimes'))
+        expectError(ValueError,lambda: Robocode.RecordingPolicy.parse('always:3'))
+        sampled = Robocode.RecordingPolicy('sampled',fraction=0.25)
+        chosen = [ id for id in range(1,10001) if sampled.record(id) ]
+        assert 2300 < len(chosen) < 2700, len(chosen)
+        assert chosen == [ id for id in range(1,10001) if sampled.record(id) ]
+        assert all( Robocode.RecordingPolicy(mode).record(1,rerun=True)
+                    for mode in Robocode.RecordingPolicy.modes )
+        assert not Robocode.RecordingPolicy('new-version').record(1)
+        assert Robocode.RecordingPolicy('new-version').record(1,newVersion=True)
+        print('[TEST] policies: OK')
+
+        # Not recording: no -record at all
+        robo = Robocode.Robocode(arena,robo_dir,engine=fake,recording='never')
+        battle = robo.battle(1,names[:2],properties)
+        battle.run()
+        assert not battle.error and battle.recordFile is None
+        assert battle.dbData()['Recording'] == 'never' and \
+               battle.dbData()['Recorded'] == 0
+        assert recorded(robo) == []
+        battle = robo.battle(2,names[:2],properties,record=True)
+        battle.run()
+        assert recorded(robo) == [ 2 ] and battle.dbData()['Recorded'] == 1
+        os.remove(battle.recordFile)
+        robo.close()
+        print('[TEST] not recording: OK')
+
+        # Through BattleRunner: each battle's policy is kept with it
+        db_file = 't_recording_policy.sqlite3'
+        # always start clean
+        if os.path.isfile(db_file):
+            os.remove(db_file)
+        bdata = BattleDB(db_file)
+        for name in names:
+            bdata.UpdateRobot(name=name,lastUpdated='2014-10-20T09:30:00')
+        matchups = list(itertools.combinations(bdata.GetRobots(),2))
+
+        robo = Robocode.Robocode(arena,robo_dir,engine=fake,recording='sampled:0.5')
+        ids = bdata.ScheduleBattles(matchups*4)
+        runAll(bdata,robo)
+        assert recorded(robo) == [ id for id in ids if robo.recording.record(id) ]
+        assert { b.Recording for b in bdata.GetBattles(BattleID=ids) } == { 'sampled:0.5' }
+        assert [ b.BattleID for b in bdata.GetBattles(BattleID=ids,Recorded=1) ] == \
+               recorded(robo)
+        print('[TEST] sampled: OK')
+
+        # A robot's new version: its first 3 battles are recorded
+        for id in recorded(robo):
+            os.remove(os.path.join(robo.recordings,'{0}.br'.format(id)))
+        robot = bdata.GetRobots()[0]
+        bdata.UpdateRobot(lastUpdated='2014-10-21T09:30:00',id=robot.RobotID)
+        robo = Robocode.Robocode(arena,robo_dir,engine=fake,recording='new-version:3')
+        ids = bdata.ScheduleBattles(matchups*2)
+        runAll(bdata,robo)
+        firsts = sorted( b.BattleID for b in bdata.GetRobotBattles(robot)
+                         if b.BattleID in ids )[:3]
+        assert recorded(robo) == firsts, '{0} != {1}'.format(recorded(robo),firsts)
+        assert { b.Recording for b in bdata.GetBattles(BattleID=ids) } == { 'new-version:3' }
+        print('[TEST] new versions: OK')
+
+        # Reruns are recorded whatever the policy
+        for id in recorded(robo):
+            os.remove(os.path.join(robo.recordings,'{0}.br'.format(id)))
+        robo = Robocode.Robocode(arena,robo_dir,engine=fake,recording='rerun')
+        reruns = [ bdata.ScheduleRecording(battleID) for battleID in ids[:2] ]
+        ids = bdata.ScheduleBattles(matchups)
+        runAll(bdata,robo)
+        assert recorded(robo) == reruns, recorded(robo)
+        assert [ (b.Recording,b.Recorded) for b in bdata.GetBattles(BattleID=reruns) ] == \
+               [ ('rerun',1) ] * 2
+        assert [ (b.Recording,b.Recorded) for b in bdata.GetBattles(BattleID=ids) ] == \
+               [ ('rerun',0) ] * len(ids)
+        print('[TEST] reruns: OK')
+    finally:
+        shutil.rmtree(root)
+
+    print('\n\n[TEST_OK]')
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+'''
+Store battle recordings in a RecordingStore: by content, compressed and
+indexed in the BattleDB, as BattleRunner's workers finish battles.  Read
+them back, and drop them by the retention policy.
+'''
+
+import sys
+sys.path.append('..')
+
+from BattleRunner import BattleRunner
+from BattleData import BattleDB
+from RecordingStore import RecordingStore
+from t_engine import makeArena
+import Robocode
+import gzip
+import hashlib
+import itertools
+import os
+import os.path
+import shutil
+import tempfile
+
+def storedFiles( store ):
+    return sorted( name for dirpath,dirnames,names in os.walk(store.root)
+                   for name in names if name.endswith(store.suffix) )
+
+
+if __name__ == '__main__':
+    fake = [ sys.executable,
+             os.path.join(os.path.dirname(os.path.abspath(__file__)),'fake_engine.py') ]
+    names = [ 'sample.Fake{0:02d}'.format(i) for i in range(4) ]
+    root = tempfile.mkdtemp(prefix='t_recordings.')
+    try:
+        arena,robo_dir = makeArena(root,names)
+        robo = Robocode.Robocode(arena,robo_dir,engine=fake)
+        store = RecordingStore(os.path.join(root,'store'))
+
+        db_file = 't_recordings.sqlite3'
+        # always start clean
+        for name in (db_file,'t_recordings.archive.sqlite3'):
+            if os.path.isfile(name):
+                os.remove(name)
+        bdata = BattleDB(db_file)
+
+        # put(): by content, compressed, once
+        recordFile = os.path.join(root,'1.br')
+        contents = b'turn 1\n'*10000
+        for i in range(2):
+            with open(recordFile,'wb') as out:
+                out.write(contents)
+            digest,size,stored = store.put(recordFile)
+            assert not os.path.exists(recordFile)
+        assert digest == hashlib.sha256(contents).hexdigest()
+        assert size == len(contents) and stored < size/10, (size,stored)
+        assert storedFiles(store) == [ digest+store.suffix ]
+        with gzip.open(store.path(digest),'rb') as recording:
+            assert recording.read() == contents
+        assert not os.listdir(os.path.join(store.root,'tmp'))
+        # ... and read back
+        assert b''.join(store.stream(digest)) == contents
+        with store.open(digest) as recording:
+            assert recording.read(7) == b'turn 1\n'
+        store.extract(digest,recordFile)
+        with open(recordFile,'rb') as replay:
+            assert replay.read() == contents
+        store.remove([ digest ])
+        print('[TEST] store: OK')
+
+        # BattleRunner stores the recordings: each matchup 4 times
+        for name in names:
+            bdata.UpdateRobot(name=name,lastUpdated='2014-10-20T09:30:00')
+        matchups = list(itertools.combinations(bdata.GetRobots(),2))
+        for options in ( { 'claim':3 }, { 'claim':2, 'groupCommit':5 } ):
+            bdata.ScheduleBattles(matchups*2)
+            runner = BattleRunner(bdata,robo,2,recordings=store,**options)
+            runner.start()
+            runner.finish()
+        ids = [ b.BattleID for b in bdata.GetFinishedBattles() ]
+        recordings = bdata.GetRecordings()
+        assert sorted( r.BattleID for r in recordings ) == sorted(ids), \
+            '{0} != {1}'.format(len(recordings),len(ids))
+        assert not os.listdir(robo.recordings), 'Recordings were left behind'
+        assert len(storedFiles(store)) == len(ids)
+        battle = bdata.GetBattle(ids[0])
+        recording = bdata.GetRecording(battle)
+        assert recording.Matchup == ','.join(
+            str(id) for id in sorted( r.RobotID for r in battle.competitors() ))
+        assert recording.Stored < recording.Size
+        with store.openBattle(bdata,battle) as replay:
+            assert replay.readline() == 'fake record of battle {0}\n'.format(
+                battle.BattleID).encode()
+        assert len(bdata.GetRecordings(battle.competitors()[0])) == 3*len(ids)//len(matchups)
+        print('[TEST] BattleRunner: OK')
+
+        # A battle's recording is replaced
+        recordFile = os.path.join(root,'replaced.br')
+        with open(recordFile,'wb') as out:
+            out.write(b'another recording')
+        replaced = store.path(recording.Hash)
+        store.record(bdata,battle.BattleID,recordFile)
+        assert not os.path.exists(replaced)
+        assert len(storedFiles(store)) == len(ids)
+        print('[TEST] replaced: OK')
+
+        # An identical recording (e.g. of a result that couldn't be
+        #   recorded) doesn't take the file with it...
+        with open(recordFile,'wb') as out:
+            out.write(b'another recording')
+        digest,size,stored = store.put(recordFile)
+        assert digest == bdata.GetRecording(battle).Hash
+        store.remove([ digest ],bdata)
+        assert os.path.isfile(store.path(digest))
+        # ... but an unrecorded one goes
+        with open(recordFile,'wb') as out:
+            out.write(b'an unrecorded recording')
+        digest,size,stored = store.put(recordFile)
+        store.remove([ digest ],bdata)
+        assert not os.path.exists(store.path(digest))
+        assert len(storedFiles(store)) == len(ids)
+        print('[TEST] shared files: OK')
+
+        # Retention: the latest 2 of each matchup...
+        assert store.expire(bdata) == 0
+        dropped = store.expire(bdata,keep=2)
+        assert dropped == len(ids)-2*len(matchups), dropped
+        for matchup in { r.Matchup for r in recordings }:
+            kept = sorted( r.BattleID for r in bdata.GetRecordings() if r.Matchup == matchup )
+            assert kept == sorted( r.BattleID for r in recordings
+                                   if r.Matchup == matchup )[-2:], kept
+        assert len(storedFiles(store)) == 2*len(matchups)
+        # ... and none of obsolete battles
+        robot = bdata.GetRobots()[0]
+        bdata.UpdateRobot(lastUpdated='2014-10-21T09:30:00',id=robot.RobotID)
+        assert store.expire(bdata,keep=2) == 2*3
+        assert len(storedFiles(store)) == 2*(len(matchups)-3)
+        assert not bdata.GetRecordings(robot)
+        try:
+            bdata.GetRecording(ids[0])
+        except KeyError:
+            pass
+        else:
+            assert False, 'An obsolete battle\'s recording was kept'
+        print('[TEST] retention: OK')
+
+        # Archived battles' recordings go too
+        robot = bdata.GetRobots()[1]
+        bdata.UpdateRobot(lastUpdated='2014-10-21T09:30:00',id=robot.RobotID)
+        archived = [ r.BattleID for r in bdata.GetRecordings(robot) ]
+        assert len(archived) == 2*2, archived
+        assert bdata.Archive() > len(archived)
+        assert store.expire(bdata) == len(archived)
+        assert len(storedFiles(store)) == 2*(len(matchups)-3-2)
+        assert not set(archived) & { r.BattleID for r in bdata.GetRecordings() }
+        print('[TEST] archived: OK')
+
+        # Robocode's recordings directory, imported
+        for id in (1001,1002):
+            with open(os.path.join(robo.recordings,'{0}.br'.format(id)),'wb') as out:
+                out.write(str(id).encode()*100)
+        assert store.importDirectory(bdata,robo.recordings,progress=None) == 2
+        assert not os.listdir(robo.recordings)
+        assert b''.join(store.stream(bdata.GetRecording(1002).Hash)) == b'1002'*100
+        print('[TEST] import: OK')
+    finally:
+        robo.close()
+        shutil.rmtree(root)
+
+    print('\n\n[TEST_OK]')
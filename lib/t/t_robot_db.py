@@ -31,4 +31,26 @@ for i_id in range(3,10):
 
 print('\nAll Robots:\n  {0}'.format('\n  '.join(list(map(str,bdata.GetRobots())))))
 
+# Every lookup of a robot returns the same object.
+for robot in bdata.GetRobots():
+    assert bdata.GetRobot(id=robot.RobotID) is robot, \
+        'GetRobot(id) returns a different object: {0}'.format(robot)
+    assert bdata.GetRobot(name=robot.Name) is robot, \
+        'GetRobot(name) returns a different object: {0}'.format(robot)
+    stamp = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    assert bdata.UpdateRobot(lastUpdated=stamp,id=robot.RobotID) is robot
+    assert robot.LastUpdated == stamp, 'UpdateRobot() leaves a stale robot: {0}'.format(robot)
+print('[TEST] identity map: OK')
+
+# ... but not one another connection has changed
+other = BattleDB('t_robot_db.sqlite3')
+robot = bdata.GetRobots()[0]
+other.UpdateRobot(lastUpdated='2015-01-01T00:00:00',id=robot.RobotID)
+assert bdata.GetRobot(id=robot.RobotID).LastUpdated == '2015-01-01T00:00:00'
+robot = bdata.GetRobot(id=robot.RobotID)
+bdata.close()
+other.UpdateRobot(lastUpdated='2015-01-02T00:00:00',id=robot.RobotID)
+assert bdata.GetRobot(id=robot.RobotID).LastUpdated == '2015-01-02T00:00:00'
+print('[TEST] identity map, other connections: OK')
+
 print('\n\n[TEST_OK]')
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+'''
+Look robots up through Robocode.RobotRegistry: each robot is read once,
+changes to its directories are noticed, and a battle with a missing or
+invalid competitor fails without starting Robocode.
+'''
+
+import sys
+sys.path.append('..')
+
+from BattleData import BattleDB
+from t_engine import makeArena
+import Robocode
+import os
+import os.path
+import shutil
+import subprocess
+import tempfile
+import time
+
+def touch( path ):
+    # a later mtime than anything before it
+    time.sleep(0.01)
+    with open(path,'ab'):
+        pass
+
+
+if __name__ == '__main__':
+    fake = [ sys.executable,
+             os.path.join(os.path.dirname(os.path.abspath(__file__)),'fake_engine.py') ]
+    names = [ 'sample.Fake{0:02d}'.format(i) for i in range(3) ] + \
+            [ 'nonex.Devel' ]
+    root = tempfile.mkdtemp(prefix='t_robot_registry.')
+    try:
+        arena,robo_dir = makeArena(root,names)
+        robo = Robocode.Robocode(arena,robo_dir,engine=fake)
+        registry = robo.registry()
+        assert registry is Robocode.Robocode(arena,robo_dir).registry()
+
+        # Each robot is looked up once
+        for i in range(10):
+            robots = registry.robots(names)
+        assert [ r.name for r in robots ] == names
+        assert [ r.battleName() for r in robots ][-1] == 'nonex.Devel*'
+        assert registry.lookups == len(names) and \
+               registry.hits == 9*len(names), str(registry)
+        assert robots[0] is registry.robot(names[0])
+        print('[TEST] cached: OK')
+
+        # A changed directory is looked up again
+        jar = os.path.join(robo.robots,names[0]+'.jar')
+        with open(jar,'wb'):
+            pass
+        with open(os.path.join(robo.robots,names[0]+'.robot'),'wt') as robot:
+            print(os.path.basename(jar),file=robot)
+        robot = registry.robot(names[0])
+        assert robot.path == jar and robot is not robots[0], str(robot)
+        # every robot can be a jar in the robot directory
+        assert registry.robot(names[1]).path.endswith('.class')
+        registry.robots(names)
+        assert registry.lookups == 2*len(names), str(registry)
+        # ... but a package directory is only that package's robots'
+        touch(os.path.join(robo.robots,'nonex','Other.class'))
+        registry.robots(names)
+        assert registry.lookups == 2*len(names)+1, str(registry)
+        print('[TEST] revalidated: OK')
+
+        # Missing and invalid robots
+        for name,error in (('nonex.Missing',FileNotFoundError),
+                           ('sample.Empty',ValueError)):
+            if name == 'sample.Empty':
+                touch(os.path.join(robo.robots,'sample','Empty.class'))
+                touch(os.path.join(robo.robots,'sample','Empty.robot'))
+            for i in range(2):
+                try:
+                    registry.robot(name)
+                except error:
+                    pass
+                else:
+                    assert False, '{0} was found'.format(name)
+        try:
+            registry.robots(names+['nonex.Missing','sample.Empty'])
+        except FileNotFoundError as e:
+            assert 'nonex.Missing' in str(e) and 'sample.Empty' in str(e), str(e)
+        else:
+            assert False, 'The invalid robots were accepted'
+        # ... until they're there
+        os.makedirs(os.path.join(robo.robots,'nonex'),exist_ok=True)
+        touch(os.path.join(robo.robots,'nonex','Missing.class'))
+        with open(os.path.join(robo.robots,'nonex','Missing.robot'),'wt') as robot:
+            print('Missing.class',file=robot)
+        assert registry.robot('nonex.Missing').name == 'nonex.Missing'
+        print('[TEST] invalid robots: OK')
+
+        # A battle with an invalid competitor isn't run
+        for robocode in ( robo, Robocode.Robocode(arena,robo_dir) ):
+            battle = robocode.battle(1,[names[1],'sample.Empty'],
+                                     BattleDB.defaultProperties)
+            try:
+                battle.run()
+            except subprocess.CalledProcessError as e:
+                assert b'sample.Empty' in e.output, e.output
+            else:
+                assert False, 'The battle ran'
+            assert battle.error
+            assert not os.path.exists(os.path.join(robo.battles,'1.battle'))
+        assert robo.engine().starts == 0
+        battle = robo.battle(2,names[1:],BattleDB.defaultProperties)
+        battle.run()
+        assert not battle.error and robo.engine().starts == 1
+        robo.close()
+        print('[TEST] battles: OK')
+    finally:
+        shutil.rmtree(root)
+
+    print('\n\n[TEST_OK]')